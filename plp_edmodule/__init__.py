@@ -0,0 +1 @@
+default_app_config = 'plp_edmodule.apps.PlpEdmoduleConfig'
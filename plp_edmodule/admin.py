@@ -1,18 +1,22 @@
 # coding: utf-8
 
 from itertools import groupby
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
 from django.contrib.admin.actions import delete_selected as delete_selected_original
 from django.contrib.admin.utils import quote
 from django.contrib.contenttypes.admin import GenericStackedInline
 from django.http import HttpResponseRedirect
+from django.shortcuts import render
 from django import forms
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _, ungettext_lazy
 from statistics.admin import RemoveDeleteActionMixin
 from plp_extension.apps.course_extension.models import CourseExtendedParameters
 from plp_extension.apps.module_extension.admin import EducationalModuleExtendedInline
-from .utils import generate_promocode
+from .enrollment_import import parse_enrollments_file, import_enrollments, create_import_job
+from .export import enrollments_csv_response
+from .utils import generate_promocode, generate_promocodes, PROMOCODE_SPACE_WARNING
 from .models import (
     EducationalModule,
     EducationalModuleEnrollment,
@@ -21,7 +25,8 @@ from .models import (
     Benefit,
     BenefitLink,
     CoursePromotion,
-    PromoCode
+    PromoCode,
+    EnrollmentImportJob
 )
 
 
@@ -38,15 +43,30 @@ class EducationalModuleAdminForm(forms.ModelForm):
     def clean_courses(self):
         courses = self.cleaned_data.get('courses')
         if courses:
-            proj = CourseExtendedParameters.objects.filter(course__id__in=[i.id for i in courses], is_project=True)
-            if proj:
-                for p in proj:
-                    if EducationalModule.objects.filter(courses=p.course).count() > 0:
-                        raise forms.ValidationError(_('Проект {title} уже содержится в другом модуле').format(
-                            title=p.course.title
-                        ))
+            # проекты из выбранных курсов, которые уже входят в другие модули, одним запросом
+            taken = EducationalModule.courses.through.objects.filter(
+                course_id__in=[i.id for i in courses], course__extended_params__is_project=True)
+            if self.instance.pk:
+                taken = taken.exclude(educationalmodule_id=self.instance.pk)
+            taken = set(taken.values_list('course_id', flat=True))
+            for c in courses:
+                if c.id in taken:
+                    raise forms.ValidationError(_('Проект {title} уже содержится в другом модуле').format(
+                        title=c.title
+                    ))
         return courses
 
+    def _save_m2m(self):
+        # состав модуля сохраняется по разнице с текущим, а не перезаписью всех курсов
+        courses = self.cleaned_data.pop('courses', None)
+        try:
+            super(EducationalModuleAdminForm, self)._save_m2m()
+            if courses is not None:
+                self.instance.set_courses([i.id for i in courses])
+        finally:
+            if courses is not None:
+                self.cleaned_data['courses'] = courses
+
     def clean_subtitle(self):
         val = self.cleaned_data.get('subtitle')
         if val and not (1 <= len([i for i in val.splitlines() if i.strip()]) <= 3):
@@ -54,23 +74,91 @@ class EducationalModuleAdminForm(forms.ModelForm):
         return val
 
 
+class EnrollmentImportForm(forms.Form):
+    file = forms.FileField(label=_('Файл csv или json'), help_text=_(
+        'Поля: username или email, mode (вариант прохождения, если нужна причина записи), payment_type, '
+        'payment_order_id, payment_descriptions, full_paid, promocode'))
+    notify = forms.BooleanField(label=_('Отправить письма о записи'), required=False, initial=True)
+    update_progress = forms.BooleanField(label=_('Обновить прогресс из edx'), required=False, initial=True)
+
+
 class EducationalModuleAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
     form = EducationalModuleAdminForm
     inlines = [EducationalModuleExtendedInline, BenefitLinkInline]
-    readonly_fields = ('sum_ratings', 'count_ratings')
+    list_display = ('__str__', 'status', 'count_enrollments', 'count_paid_enrollments')
+    readonly_fields = ('sum_ratings', 'count_ratings', 'count_enrollments', 'count_paid_enrollments')
+    list_select_related = ('edmodule_counter', )
+    actions = ['import_enrollments']
+
+    def import_enrollments(self, request, queryset):
+        """
+        массовая запись пользователей из файла на выбранный модуль
+        """
+        if queryset.count() != 1:
+            self.message_user(request, _('Выберите один модуль'), level=messages.WARNING)
+            return None
+        module = queryset.first()
+        form = EnrollmentImportForm(request.POST, request.FILES) if 'apply' in request.POST else \
+            EnrollmentImportForm()
+        if form.is_valid():
+            f = form.cleaned_data['file']
+            try:
+                result = import_enrollments(parse_enrollments_file(f, f.name), module=module)
+            except ValueError as e:
+                self.message_user(request, str(e), level=messages.ERROR)
+                return None
+            self.message_user(request, _('Строк: %(rows)s, новых записей: %(created)s, активировано: '
+                                         '%(reactivated)s, причин записи: %(reasons)s, %(speed).0f строк/с') % dict(
+                result, speed=result['rows'] / max(result['seconds'], 1e-6)))
+            for number, error in result['errors'][:20]:
+                self.message_user(request, _('Строка %s: %s') % (number, error), level=messages.WARNING)
+            if len(result['errors']) > 20:
+                self.message_user(request, _('Всего ошибок: %s') % len(result['errors']), level=messages.WARNING)
+            job = create_import_job(result['enrollment_ids'], notify=form.cleaned_data['notify'],
+                                    update_progress=form.cleaned_data['update_progress'],
+                                    payed_reason_ids=result['payed_reason_ids'])
+            if job:
+                self.message_user(request, _('Письма и прогресс будут обработаны заданием #%s '
+                                             '(import_edmodule_enrollments --pending)') % job.id)
+            return None
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            form=form,
+            module=module,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        )
+        return render(request, 'admin/plp_edmodule/educationalmodule/import_enrollments.html', context)
+    import_enrollments.short_description = _('Записать пользователей из файла')
 
 
 class EducationalModuleEnrollmentAdmin(admin.ModelAdmin):
     list_display = ('user', 'module', 'is_active')
+    list_select_related = ('user', 'module')
     raw_id_fields = ('user', 'module')
+    actions = ['export_csv']
 
     def save_model(self, request, obj, form, change):
         super(EducationalModuleEnrollmentAdmin, self).save_model(request, obj, form, change)
 
+    def export_csv(self, request, queryset):
+        return enrollments_csv_response(queryset)
+
+    export_csv.short_description = _('Выгрузить записи, оплаты и прогресс в csv')
+
+
 class EducationalModuleEnrollmentReasonAdmin(admin.ModelAdmin):
     search_fields = ('enrollment__user__username', 'enrollment__user__email')
     list_display = ('enrollment', 'module_enrollment_type', )
+    list_select_related = ('enrollment__user', 'enrollment__module', 'module_enrollment_type__module')
     list_filter = ('enrollment__module__code', )
+    actions = ['export_csv']
+
+    def export_csv(self, request, queryset):
+        return enrollments_csv_response(EducationalModuleEnrollment.objects.filter(
+            id__in=queryset.values('enrollment_id')))
+
+    export_csv.short_description = _('Выгрузить записи, оплаты и прогресс в csv')
 
     def save_model(self, request, obj, form, change):
         super(EducationalModuleEnrollmentReasonAdmin, self).save_model(request, obj, form, change)
@@ -199,6 +287,10 @@ class PromoCodeForm(forms.ModelForm):
 
         return self.cleaned_data
 
+class PromoCodeGenerateForm(forms.Form):
+    count = forms.IntegerField(label=_('Количество промокодов'), min_value=1, max_value=100000)
+
+
 class PromoCodeAdmin(admin.ModelAdmin):
 
     class Media:
@@ -207,6 +299,42 @@ class PromoCodeAdmin(admin.ModelAdmin):
     form = PromoCodeForm
     readonly_fields = ('used',) 
     fields = ('code', 'product_type', 'course', 'edmodule', 'active_till', 'max_usage', 'used', 'use_with_others', 'discount_percent', 'discount_price')
+    actions = ['generate_promocodes']
+
+    def generate_promocodes(self, request, queryset):
+        """
+        создание пачки промокодов с параметрами выбранного промокода
+        """
+        if queryset.count() != 1:
+            self.message_user(request, _('Выберите один промокод-образец'), level=messages.WARNING)
+            return None
+        template = queryset.first()
+        form = PromoCodeGenerateForm(request.POST if 'apply' in request.POST else None)
+        if form.is_valid():
+            try:
+                created, usage = generate_promocodes(template, form.cleaned_data['count'])
+            except ValueError as e:
+                self.message_user(request, str(e), level=messages.ERROR)
+                return None
+            self.message_user(request, _('Создано промокодов: %s') % len(created))
+            if usage >= PROMOCODE_SPACE_WARNING:
+                self.message_user(request, _('Занято %.0f%% возможных промокодов, стоит увеличить длину кода') %
+                                  (usage * 100), level=messages.WARNING)
+            return None
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            form=form,
+            template=template,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        )
+        return render(request, 'admin/plp_edmodule/promocode/generate_promocodes.html', context)
+    generate_promocodes.short_description = _('Создать промокоды по образцу')
+
+class EnrollmentImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'notify', 'update_progress', 'progress_updated', 'finished_at')
+    readonly_fields = ('enrollment_ids', 'created_at')
+
 
 admin.site.register(EducationalModule, EducationalModuleAdmin)
 admin.site.register(EducationalModuleEnrollment, EducationalModuleEnrollmentAdmin)
@@ -215,3 +343,4 @@ admin.site.register(EducationalModuleEnrollmentReason, EducationalModuleEnrollme
 admin.site.register(Benefit, BenefitAdmin)
 admin.site.register(CoursePromotion, CoursePromotionAdmin)
 admin.site.register(PromoCode, PromoCodeAdmin)
+admin.site.register(EnrollmentImportJob, EnrollmentImportJobAdmin)
@@ -0,0 +1,11 @@
+# coding: utf-8
+
+from django.apps import AppConfig
+
+
+class PlpEdmoduleConfig(AppConfig):
+    name = 'plp_edmodule'
+
+    def ready(self):
+        from .models import EdmoduleCourse
+        EdmoduleCourse.install_extended_params_attributes()
@@ -0,0 +1,483 @@
+# coding: utf-8
+
+import gzip
+import hashlib
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import chain
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import strip_tags, strip_spaces_between_tags
+from django.utils.text import Truncator
+from django.utils.translation import get_language
+from plp.models import Course, CourseSession
+from plp_extension.apps.course_extension.models import CourseExtendedParameters, CourseCreator, Category
+from .models import EducationalModule, EdmoduleCourse, PUBLISHED, edmodule_course_additional_fields
+from .signals import CATALOG_COVERS_CACHE_KEY, CATALOG_VERSION_CACHE_KEY, CATALOG_SLICE_CACHE_KEY, \
+    CATALOG_PAYLOAD_CACHE_KEY, CATALOG_META_CACHE_KEY
+from .utils import client, get_category_courses_map, get_categories_for_courses
+
+CATALOG_SLICE_DEFAULT_LIMIT = getattr(settings, 'EDMODULE_CATALOG_SLICE_LIMIT', 24)
+CATALOG_SLICE_MAX_LIMIT = getattr(settings, 'EDMODULE_CATALOG_SLICE_MAX_LIMIT', 100)
+CATALOG_STREAM_CHUNK_SIZE = getattr(settings, 'EDMODULE_CATALOG_STREAM_CHUNK_SIZE', 500)
+
+
+def get_catalog_version():
+    """
+    Версия данных каталога, меняется при любом изменении курсов, сессий, модулей и их состава.
+    Входит в ключи кэша частей каталога, поэтому старые части просто перестают запрашиваться
+    """
+    version = cache.get(CATALOG_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_CACHE_KEY, '%.6f' % time.time(), timeout=None)
+        version = cache.get(CATALOG_VERSION_CACHE_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_VERSION_CACHE_KEY, '%.6f' % time.time(), timeout=None)
+
+
+def _get_time_bucket():
+    # статусы курсов и доступность записи зависят от времени, кэши страниц живут не дольше PAGE_CACHE_TIME
+    return int(time.time() // settings.PAGE_CACHE_TIME)
+
+
+def get_catalog_etag(*parts):
+    """
+    ETag для страниц, построенных по данным каталога: меняется вместе с версией каталога,
+    раз в PAGE_CACHE_TIME и при изменении parts (пользователь, параметры запроса и т.п.)
+    """
+    key = ':'.join(str(i) for i in (get_catalog_version(), _get_time_bucket(), get_language()) + parts)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def get_catalog_last_modified():
+    """
+    Last-Modified, согласованный с get_catalog_etag, для ответов, не зависящих от пользователя
+    """
+    moment = max(float(get_catalog_version()), _get_time_bucket() * settings.PAGE_CACHE_TIME)
+    return datetime.fromtimestamp(moment, timezone.utc)
+
+
+def get_existing_covers(model):
+    """
+    Имена файлов обложек model, которые есть в хранилище
+    """
+    key = CATALOG_COVERS_CACHE_KEY % model._meta.model_name
+    names = cache.get(key)
+    if names is None:
+        cover_path = model._meta.get_field('cover').upload_to
+        try:
+            names = set(default_storage.listdir(cover_path)[1])
+        except OSError:
+            names = set()
+        cache.set(key, names, timeout=settings.PAGE_CACHE_TIME)
+    return names
+
+
+def get_cover(obj, existing_covers):
+    """
+    Обложка объекта, если файл обложки существует
+    """
+    if obj.cover:
+        cover_name = os.path.split(obj.cover.name)[-1]
+        if cover_name in existing_covers:
+            return obj.cover
+        if client:
+            client.captureMessage('Image not found: %s' % str(obj.cover))
+
+
+def _get_creators_for_courses(course_ids):
+    """
+    Авторы и партнеры курсов course_ids запросами к through-таблицам, без загрузки CourseExtendedParameters
+    :return: ({'authors': {id курса: [id, ...]}, 'partners': {id курса: [id, ...]}}, {id: CourseCreator})
+    """
+    creators_for_course = {}
+    for attr in ('authors', 'partners'):
+        field = CourseExtendedParameters._meta.get_field(attr)
+        course_field = '%s__course_id' % field.m2m_field_name()
+        creator_field = '%s_id' % field.m2m_reverse_field_name()
+        rows = field.remote_field.through.objects.filter(**{'%s__in' % course_field: course_ids}).\
+            order_by('%s_id' % field.m2m_field_name(), 'id').values_list(course_field, creator_field)
+        creators_for_course[attr] = defaultdict(list)
+        for course_id, creator_id in rows:
+            creators_for_course[attr][course_id].append(creator_id)
+    creators = CourseCreator.objects.in_bulk(set(chain.from_iterable(
+        chain.from_iterable(i.values()) for i in creators_for_course.values())))
+    return creators_for_course, creators
+
+
+def get_courses_status_params(course_ids):
+    """
+    course_status_params курсов course_ids: статус ближайшей сессии с открытой записью
+    (как choose_closest_session), для курсов без такой сессии - course_status() самого курса
+    :return: {id курса: dict}
+    """
+    from .utils import get_status_dict
+    result = {}
+    sessions = CourseSession.objects.filter(
+        course_id__in=course_ids, datetime_end_enroll__gt=timezone.now(), datetime_starts__isnull=False).\
+        select_related('course').defer('course__description').order_by('datetime_end_enroll')
+    for session in sessions:
+        if session.course_id not in result:
+            result[session.course_id] = get_status_dict(session)
+    missing = set(course_ids) - set(result)
+    if missing:
+        for c in Course.objects.filter(id__in=missing).defer('description'):
+            result[c.id] = c.course_status()
+    return result
+
+
+def get_courses_catalog_data(course_ids, category_for_course=None):
+    """
+    Данные курсов course_ids для каталога (описание формата в edmodule_catalog_view), посчитанные
+    фиксированным числом запросов: поля курсов читаются проекцией values(), авторы и партнеры -
+    из through-таблиц, статусы - одним запросом к сессиям
+    :param category_for_course: categories_for_course из get_category_courses_map; если не задан,
+        категории запрашиваются только для этих курсов
+    :return: {id курса: данные курса}
+    """
+    if category_for_course is None:
+        category_for_course = get_categories_for_courses(course_ids)
+    extended_fields = ['extended_params__%s' % i for i in ('catalog_marker', 'short_description')
+                       if i in edmodule_course_additional_fields]
+    rows = EdmoduleCourse.objects.filter(id__in=course_ids).values(
+        'id', 'title', 'slug', 'description', 'university__slug', 'edmodule_counter__participants',
+        *extended_fields)
+    creators_for_course, creators = _get_creators_for_courses(course_ids)
+    statuses = get_courses_status_params(course_ids)
+    max_length = CourseExtendedParameters._meta.get_field('short_description').max_length
+
+    result = {}
+    for row in rows:
+        course_id = row['id']
+        creator_ids = []
+        for i in chain(creators_for_course['authors'].get(course_id, []),
+                       creators_for_course['partners'].get(course_id, [])):
+            if i in creators and i not in creator_ids:
+                creator_ids.append(i)
+        default_desc = strip_tags(strip_spaces_between_tags(row['description'] or ''))
+        result[course_id] = {
+            'title': row['title'],
+            'url': reverse('course_details', kwargs={'uni_slug': row['university__slug'], 'slug': row['slug']}),
+            'authors_and_partners': [{
+                'url': creators[i].get_absolute_url()
+                if creators[i].status == CourseCreator.STATUS_CHOICES.PUBLISHED else '',
+                'title': creators[i].abbr or creators[i].title
+            } for i in creator_ids],
+            'catalog_marker': row.get('extended_params__catalog_marker') or '',
+            'short_description': row.get('extended_params__short_description') or
+                                 Truncator(default_desc).chars(max_length),
+            'categories': category_for_course.get(course_id, []),
+            'course_status_params': statuses.get(course_id, {}),
+            'participants': row['edmodule_counter__participants'] or 0,
+        }
+    return result
+
+
+def get_modules_catalog_relations(module_ids, category_for_course=None):
+    """
+    Категории, число курсов и авторы с партнерами модулей module_ids, посчитанные фиксированным
+    числом запросов к through-таблицам. Авторы и партнеры упорядочены так же, как
+    в EducationalModule.get_authors_and_partners: по числу курсов модуля, в которых они встречаются
+    :param category_for_course: categories_for_course из get_category_courses_map; если не задан,
+        категории запрашиваются только для курсов этих модулей
+    :return: {id модуля: {
+        'categories': [slug, ...],
+        'count_courses': int,
+        'authors_and_partners': [{'url': str, 'title': str}, ...]
+    }}
+    """
+    module_courses = defaultdict(list)
+    for module_id, course_id in EducationalModule.courses.through.objects.filter(
+            educationalmodule_id__in=module_ids).values_list('educationalmodule_id', 'course_id'):
+        module_courses[module_id].append(course_id)
+    course_ids = set(chain.from_iterable(module_courses.values()))
+    if category_for_course is None:
+        category_for_course = get_categories_for_courses(course_ids)
+
+    creators_for_course, creators = _get_creators_for_courses(course_ids)
+
+    result = {}
+    for module_id in module_ids:
+        courses = module_courses.get(module_id, [])
+        ordered = {}
+        for attr in ('authors', 'partners'):
+            counter = Counter(chain.from_iterable(creators_for_course[attr].get(i, []) for i in courses))
+            for creator_id, cnt in sorted(counter.items(), key=lambda x: x[1], reverse=True):
+                ordered.setdefault(creator_id, None)
+        result[module_id] = {
+            'categories': list(set(chain.from_iterable(category_for_course.get(i, []) for i in courses))),
+            'count_courses': len(courses),
+            'authors_and_partners': [{'url': creators[i].link, 'title': creators[i].abbr or creators[i].title}
+                                     for i in ordered if i in creators],
+        }
+    return result
+
+
+def get_modules_catalog_data(module_ids, category_for_course=None):
+    """
+    Данные модулей module_ids для каталога, описание формата в edmodule_catalog_view.
+    Поля модулей читаются проекцией values(), связи - через get_modules_catalog_relations
+    :return: {id модуля: данные модуля}
+    """
+    relations = get_modules_catalog_relations(module_ids, category_for_course)
+    statuses = {m.id: m.course_status_params()
+                for m in EducationalModule.objects.filter(id__in=module_ids).only('id')}
+    rows = EducationalModule.objects.filter(id__in=module_ids).values(
+        'id', 'title', 'code', 'extended_params__short_description', 'extended_params__catalog_marker',
+        'edmodule_counter__enrollments')
+    result = {}
+    for row in rows:
+        module_id = row['id']
+        result[module_id] = {
+            'title': row['title'],
+            'authors_and_partners': relations[module_id]['authors_and_partners'],
+            'count_courses': relations[module_id]['count_courses'],
+            'short_description': row['extended_params__short_description'],
+            'catalog_marker': row['extended_params__catalog_marker'],
+            'categories': relations[module_id]['categories'],
+            'url': reverse('edmodule-page', kwargs={'code': row['code']}),
+            'course_status_params': statuses.get(module_id, {}),
+            'count_enrollments': row['edmodule_counter__enrollments'] or 0,
+        }
+    return result
+
+
+def get_cover_thumbnail_url(cover, width=275, height=155):
+    """
+    url миниатюры обложки, аналог {% generateimage 'imagekit:thumbnail' %} в шаблоне каталога
+    """
+    from imagekit.cachefiles import ImageCacheFile
+    from imagekit.registry import generator_registry
+    generator = generator_registry.get('imagekit:thumbnail', source=cover, width=width, height=height)
+    return ImageCacheFile(generator).url
+
+
+def build_catalog_slice(kind, category=None, cursor=None, limit=CATALOG_SLICE_DEFAULT_LIMIT):
+    """
+    Страница каталога: курсы или модули (kind - 'courses' или 'modules') с id больше cursor,
+    опционально только из категории category
+    :return: {'items': [{'id': int, 'cover': url или None, ...данные объекта}], 'next_cursor': int или None}
+    """
+    category_for_course = get_category_courses_map()['categories_for_course']
+    if kind == 'modules':
+        model, build = EducationalModule, get_modules_catalog_data
+        qs = EducationalModule.objects.filter(status=PUBLISHED)
+        if category:
+            qs = qs.filter(courses__extended_params__categories__slug=category).distinct()
+    else:
+        model, build = Course, get_courses_catalog_data
+        qs = EdmoduleCourse.objects.filter(status=PUBLISHED)
+        if category:
+            qs = qs.filter(extended_params__categories__slug=category).distinct()
+    if cursor:
+        qs = qs.filter(id__gt=cursor)
+    ids = list(qs.order_by('id').values_list('id', flat=True)[:limit + 1])
+    data = build(ids[:limit], category_for_course)
+    covers = dict(_iter_covers(model, ids[:limit]))
+    items = []
+    for obj_id in ids[:limit]:
+        if obj_id in data:
+            data[obj_id].update({'id': obj_id, 'cover': covers.get(obj_id)})
+            items.append(data[obj_id])
+    return {
+        'items': items,
+        'next_cursor': ids[limit - 1] if len(ids) > limit else None,
+    }
+
+
+def get_catalog_slice(kind, category=None, cursor=None, limit=CATALOG_SLICE_DEFAULT_LIMIT):
+    """
+    build_catalog_slice с кэшированием каждой страницы отдельно
+    """
+    key = CATALOG_SLICE_CACHE_KEY % (get_catalog_version(), kind, category or '', cursor or 0, limit)
+    data = cache.get(key)
+    if data is None:
+        data = build_catalog_slice(kind, category=category, cursor=cursor, limit=limit)
+        cache.set(key, data, timeout=settings.PAGE_CACHE_TIME)
+    return data
+
+
+def build_catalog_data():
+    """
+    Данные всего каталога: {
+        'categories': [{'slug': str, 'title': str}, ...] - категории, имеющие курсы,
+        'courses': {id курса: данные курса},
+        'modules': {id модуля: данные модуля},
+        'course_covers': {id курса: url миниатюры обложки},
+        'module_covers': {id модуля: url миниатюры обложки},
+    }
+    формат данных курсов и модулей описан в edmodule_catalog_view
+    """
+    category_for_course = get_category_courses_map()['categories_for_course']
+    courses, modules = {}, {}
+    course_ids = EdmoduleCourse.objects.filter(status=PUBLISHED).order_by('id').values_list('id', flat=True)
+    for chunk in _iter_chunks(course_ids, CATALOG_STREAM_CHUNK_SIZE):
+        courses.update(get_courses_catalog_data(chunk, category_for_course))
+    module_ids = EducationalModule.objects.filter(status=PUBLISHED).order_by('id').values_list('id', flat=True)
+    for chunk in _iter_chunks(module_ids, CATALOG_STREAM_CHUNK_SIZE):
+        modules.update(get_modules_catalog_data(chunk, category_for_course))
+    course_covers = dict(_iter_covers(Course))
+    module_covers = dict(_iter_covers(EducationalModule))
+
+    category_slugs_with_having_courses = set(chain.from_iterable(
+        i['categories'] for i in chain(courses.values(), modules.values())))
+    categories = Category.objects.filter(slug__in=category_slugs_with_having_courses).values('slug', 'title')
+    return {
+        'categories': list(categories),
+        'courses': courses,
+        'modules': modules,
+        'course_covers': course_covers,
+        'module_covers': module_covers,
+    }
+
+
+def build_catalog_payload():
+    """
+    Готовое к отправке тело скрипта с данными каталога: {
+        'raw': bytes, 'gzip': bytes, 'etag': str - хэш raw,
+        'categories': [{'slug': str, 'title': str}, ...] - для html-страницы каталога
+    }
+    """
+    data = build_catalog_data()
+    raw = ''.join('var %s = %s;\n' % (name, json.dumps(data[key], ensure_ascii=False)) for name, key in (
+        ('COURSE_COVERS', 'course_covers'),
+        ('MODULE_COVERS', 'module_covers'),
+        ('COURSES', 'courses'),
+        ('MODULES', 'modules'),
+    )).encode('utf-8')
+    return {
+        'raw': raw,
+        'gzip': gzip.compress(raw, compresslevel=9),
+        'etag': hashlib.md5(raw).hexdigest(),
+        'categories': data['categories'],
+    }
+
+
+def get_catalog_payload():
+    version = get_catalog_version()
+    key = CATALOG_PAYLOAD_CACHE_KEY % version
+    payload = cache.get(key)
+    if payload is None:
+        payload = build_catalog_payload()
+        cache.set_many({
+            key: payload,
+            CATALOG_META_CACHE_KEY % version: {'etag': payload['etag'], 'categories': payload['categories']},
+        }, timeout=settings.PAGE_CACHE_TIME)
+    return payload
+
+
+def get_catalog_meta():
+    """
+    etag и категории данных каталога без тела скрипта: для html-страницы каталога и ответов 304
+    не нужно читать из кэша весь payload
+    :return: {'etag': str, 'categories': [{'slug': str, 'title': str}, ...]}
+    """
+    key = CATALOG_META_CACHE_KEY % get_catalog_version()
+    meta = cache.get(key)
+    if meta is None:
+        payload = get_catalog_payload()
+        meta = {'etag': payload['etag'], 'categories': payload['categories']}
+        cache.set(key, meta, timeout=settings.PAGE_CACHE_TIME)
+    return meta
+
+
+def _iter_chunks(iterable, size):
+    chunk = []
+    for i in iterable:
+        chunk.append(i)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_ids_in_chunks(queryset, chunk_size):
+    """
+    id объектов queryset порциями по chunk_size, id читаются курсором
+    """
+    return _iter_chunks(queryset.order_by('id').values_list('id', flat=True).iterator(), chunk_size)
+
+
+def _iter_json_object(name, items):
+    """
+    'var name = {"key": value, ...};' по частям из пар (key, value)
+    """
+    yield 'var %s = {' % name
+    separator = ''
+    for key, value in items:
+        yield '%s"%s": %s' % (separator, key, json.dumps(value, ensure_ascii=False))
+        separator = ', '
+    yield '};\n'
+
+
+def _iter_covers(model, ids=None):
+    """
+    Пары (id, url миниатюры обложки) опубликованных объектов model, опционально только с id из ids
+    """
+    existing_covers = get_existing_covers(model)
+    qs = model.objects.filter(status=PUBLISHED)
+    if ids is not None:
+        qs = qs.filter(id__in=ids)
+    for obj in qs.only('id', 'cover').order_by('id').iterator():
+        cover = get_cover(obj, existing_covers)
+        if cover:
+            yield obj.id, get_cover_thumbnail_url(cover)
+
+
+def iter_catalog_script(categories, chunk_size=CATALOG_STREAM_CHUNK_SIZE):
+    """
+    Потоковое построение скрипта с данными каталога (тот же результат, что raw в build_catalog_payload):
+    курсы и модули обрабатываются порциями по chunk_size, категории и связи модулей запрашиваются
+    только для объектов порции, поэтому память не растет с размером каталога
+    :param categories: множество, в которое добавляются slug категорий, имеющих курсы
+    :return: генератор строк
+    """
+    def _courses():
+        for chunk in _iter_ids_in_chunks(EdmoduleCourse.objects.filter(status=PUBLISHED), chunk_size):
+            data = get_courses_catalog_data(chunk)
+            for course_id in chunk:
+                if course_id in data:
+                    categories.update(data[course_id]['categories'])
+                    yield course_id, data[course_id]
+
+    def _modules():
+        for chunk in _iter_ids_in_chunks(EducationalModule.objects.filter(status=PUBLISHED), chunk_size):
+            data = get_modules_catalog_data(chunk)
+            for module_id in chunk:
+                if module_id in data:
+                    categories.update(data[module_id]['categories'])
+                    yield module_id, data[module_id]
+
+    yield from _iter_json_object('COURSE_COVERS', _iter_covers(Course))
+    yield from _iter_json_object('MODULE_COVERS', _iter_covers(EducationalModule))
+    yield from _iter_json_object('COURSES', _courses())
+    yield from _iter_json_object('MODULES', _modules())
+
+
+def write_catalog_script(raw_file, gzip_file, chunk_size=CATALOG_STREAM_CHUNK_SIZE):
+    """
+    Потоковая запись скрипта с данными каталога в файлы raw_file и gzip_file (открытые на запись в бинарном режиме)
+    :return: {'etag': хэш, 'categories': [{'slug': str, 'title': str}, ...]}
+    """
+    categories = set()
+    md5 = hashlib.md5()
+    with gzip.GzipFile(fileobj=gzip_file, mode='wb', compresslevel=9) as compressed:
+        for part in iter_catalog_script(categories, chunk_size=chunk_size):
+            part = part.encode('utf-8')
+            md5.update(part)
+            raw_file.write(part)
+            compressed.write(part)
+    return {
+        'etag': md5.hexdigest(),
+        'categories': list(Category.objects.filter(slug__in=categories).values('slug', 'title')),
+    }
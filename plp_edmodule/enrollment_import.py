@@ -0,0 +1,262 @@
+# coding: utf-8
+
+import csv
+import io
+import json
+import logging
+import time
+from collections import defaultdict
+from django.db import transaction
+from django.utils import timezone
+from plp.models import User
+from .models import EducationalModule, EducationalModuleCounter, EducationalModuleEnrollment, EducationalModuleEnrollmentReason, \
+    EducationalModuleEnrollmentType, EnrollmentImportJob, PromoCode
+from .notifications import EdmoduleEnrolledEmails
+from .signals import edmodule_payed
+from .utils import update_modules_enrollment_progress
+
+IMPORT_BATCH_SIZE = 1000
+PAYMENT_TYPES = [''] + [i[0] for i in EducationalModuleEnrollmentReason.PAYMENT_TYPE.CHOICES]
+MANUAL = EducationalModuleEnrollmentReason.PAYMENT_TYPE.MANUAL
+
+
+def parse_enrollments_file(f, name=''):
+    """
+    Строки импорта записей на модули из csv с заголовком или json со списком объектов.
+    Поля: username или email, module (код модуля), mode (вариант прохождения модуля, если нужна причина записи),
+    payment_type, payment_order_id, payment_descriptions, full_paid, promocode (промокод, использованный при оплате)
+    :return: список словарей
+    """
+    content = f.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    if name.lower().endswith('.json') or content.lstrip().startswith('['):
+        rows = json.loads(content)
+        if not isinstance(rows, list) or not all(isinstance(i, dict) for i in rows):
+            raise ValueError('JSON must be a list of objects')
+        return rows
+    rows = list(csv.DictReader(io.StringIO(content)))
+    if rows and not ({'username', 'email'} & set(rows[0].keys())):
+        raise ValueError('CSV must have a username or email column')
+    return rows
+
+
+def _get_value(row, name):
+    value = row.get(name)
+    return str(value).strip() if value is not None else ''
+
+
+def _get_bool(row, name, default):
+    value = _get_value(row, name).lower()
+    if not value:
+        return default
+    return value in ('1', 'true', 'yes')
+
+
+def _get_users(rows):
+    usernames = {_get_value(r, 'username') for r in rows} - {''}
+    emails = {_get_value(r, 'email') for r in rows if not _get_value(r, 'username')} - {''}
+    by_username = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    by_email = {}
+    for email, user_id in User.objects.filter(email__in=emails).order_by('id').values_list('email', 'id'):
+        by_email.setdefault(email, user_id)
+    return by_username, by_email
+
+
+def import_enrollments(rows, module=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Запись пользователей на модули по строкам parse_enrollments_file. Записи и причины записи создаются
+    через bulk_create порциями по batch_size строк, неактивные записи активируются одним update на порцию,
+    уже существующие причины (та же запись, вариант прохождения и номер договора) не дублируются.
+    Промокод новой причины записи используется через PromoCode.redeem; если он недействителен или
+    исчерпан, причина не создается, а строка попадает в errors.
+    Сигналы сохранения при этом не отправляются: счетчики модулей пересчитываются один раз в конце,
+    а письма и прогресс edx - отдельным шагом, заданием EnrollmentImportJob
+    :param module: модуль для строк без поля module
+    :return: {
+        'rows': количество строк,
+        'created': количество новых записей,
+        'reactivated': количество активированных записей,
+        'reasons': количество новых причин записи,
+        'enrollment_ids': id новых и активированных записей,
+        'payed_reason_ids': id новых причин записи с полной оплатой (для писем об оплате),
+        'errors': [(номер строки, ошибка), ...],
+        'seconds': время импорта,
+    }
+    """
+    start = time.perf_counter()
+    codes = {_get_value(r, 'module') for r in rows} - {''}
+    modules = EducationalModule.objects.in_bulk(codes, field_name='code')
+    module_ids = {m.id for m in modules.values()} | ({module.id} if module else set())
+    types = {(t.module_id, t.mode): t for t in EducationalModuleEnrollmentType.objects.filter(
+        module_id__in=module_ids)}
+    result = {'rows': len(rows), 'created': 0, 'reactivated': 0, 'reasons': 0, 'enrollment_ids': [],
+              'payed_reason_ids': [], 'errors': []}
+    for offset in range(0, len(rows), batch_size):
+        batch = rows[offset:offset + batch_size]
+        by_username, by_email = _get_users(batch)
+        # (user_id, module_id) -> [(вариант прохождения, номер строки, строка), ...]
+        keys = defaultdict(list)
+        for number, row in enumerate(batch, start=offset + 1):
+            username, email = _get_value(row, 'username'), _get_value(row, 'email')
+            user_id = by_username.get(username) if username else by_email.get(email)
+            code = _get_value(row, 'module')
+            row_module = modules.get(code) if code else module
+            mode = _get_value(row, 'mode')
+            if user_id is None:
+                result['errors'].append((number, 'User %s not found' % (username or email)))
+            elif row_module is None:
+                result['errors'].append((number, 'Module %s not found' % code if code else 'Module is not set'))
+            elif mode and (row_module.id, mode) not in types:
+                result['errors'].append((number, 'Module %s has no enrollment type %s' % (row_module.code, mode)))
+            elif _get_value(row, 'payment_type') not in PAYMENT_TYPES:
+                result['errors'].append((number, 'Unknown payment type %s' % _get_value(row, 'payment_type')))
+            else:
+                keys[(user_id, row_module.id)].append((types.get((row_module.id, mode)), number, row))
+        if not keys:
+            continue
+        user_ids = {i[0] for i in keys}
+        batch_module_ids = {i[1] for i in keys}
+        with transaction.atomic():
+            existing = {(e.user_id, e.module_id): e for e in EducationalModuleEnrollment.objects.filter(
+                user_id__in=user_ids, module_id__in=batch_module_ids) if (e.user_id, e.module_id) in keys}
+            inactive = [e.id for e in existing.values() if not e.is_active]
+            if inactive:
+                EducationalModuleEnrollment.objects.filter(id__in=inactive).update(
+                    is_active=True, updated_at=timezone.now())
+            new = [k for k in keys if k not in existing]
+            EducationalModuleEnrollment.objects.bulk_create([
+                EducationalModuleEnrollment(user_id=user_id, module_id=module_id, is_active=True)
+                for user_id, module_id in new
+            ], batch_size=batch_size)
+            enrollments = {(e.user_id, e.module_id): e for e in EducationalModuleEnrollment.objects.filter(
+                user_id__in=user_ids, module_id__in=batch_module_ids) if (e.user_id, e.module_id) in keys}
+            existing_reasons = set(EducationalModuleEnrollmentReason.objects.filter(
+                enrollment_id__in=[e.id for e in enrollments.values()]).values_list(
+                'enrollment_id', 'module_enrollment_type_id', 'payment_order_id'))
+            reasons = []
+            payed_keys = set()
+            for key, items in keys.items():
+                enrollment = enrollments[key]
+                for enrollment_type, number, row in items:
+                    if enrollment_type is None:
+                        continue
+                    payment_order_id = _get_value(row, 'payment_order_id') or None
+                    reason_key = (enrollment.id, enrollment_type.id, payment_order_id)
+                    if reason_key in existing_reasons:
+                        continue
+                    promocode = _get_value(row, 'promocode').upper()
+                    if promocode and not PromoCode.redeem(promocode, enrollment.module_id, 'edmodule'):
+                        result['errors'].append((number, 'Promocode %s is not valid' % promocode))
+                        continue
+                    existing_reasons.add(reason_key)
+                    full_paid = _get_bool(row, 'full_paid', True)
+                    if full_paid:
+                        payed_keys.add(reason_key)
+                    reasons.append(EducationalModuleEnrollmentReason(
+                        enrollment=enrollment,
+                        module_enrollment_type=enrollment_type,
+                        payment_type=_get_value(row, 'payment_type') or MANUAL,
+                        payment_order_id=payment_order_id,
+                        payment_descriptions=_get_value(row, 'payment_descriptions') or None,
+                        full_paid=full_paid,
+                    ))
+            EducationalModuleEnrollmentReason.objects.bulk_create(reasons, batch_size=batch_size)
+            if payed_keys:
+                # bulk_create заполняет id не на всех базах, поэтому id новых причин читаются по их ключам
+                result['payed_reason_ids'].extend(
+                    reason_id for reason_id, enrollment_id, type_id, order_id in
+                    EducationalModuleEnrollmentReason.objects.filter(
+                        enrollment_id__in={i[0] for i in payed_keys}, full_paid=True).values_list(
+                        'id', 'enrollment_id', 'module_enrollment_type_id', 'payment_order_id')
+                    if (enrollment_id, type_id, order_id) in payed_keys)
+        result['created'] += len(new)
+        result['reactivated'] += len(inactive)
+        result['reasons'] += len(reasons)
+        result['enrollment_ids'].extend(inactive)
+        result['enrollment_ids'].extend(enrollments[k].id for k in new)
+    EducationalModuleCounter.recount(module_ids)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def create_import_job(enrollment_ids, notify=True, update_progress=True, payed_reason_ids=()):
+    """
+    задание на действия после импорта или None, если делать ничего не нужно
+    :param payed_reason_ids: id причин записи с полной оплатой, по которым нужны письма об оплате
+    """
+    payed_reason_ids = list(payed_reason_ids) if notify else []
+    if not (enrollment_ids or payed_reason_ids) or not (notify or update_progress):
+        return None
+    return EnrollmentImportJob.objects.create(enrollment_ids=list(enrollment_ids), notify=notify,
+                                              update_progress=update_progress, payed_reason_ids=payed_reason_ids)
+
+
+def _send_payed_notifications(job):
+    """
+    письма об оплате (edmodule_payed, как при оплате через магазин) для причин записи задания;
+    в задании остаются только причины, письмо по которым отправить не удалось
+    :return: количество отправленных писем
+    """
+    reasons = EducationalModuleEnrollmentReason.objects.filter(id__in=job.payed_reason_ids).select_related(
+        'enrollment__user', 'enrollment__module')
+    failed = []
+    for reason in reasons:
+        errors = [r for _, r in edmodule_payed.send_robust(sender=EducationalModuleEnrollmentReason, instance=reason)
+                  if isinstance(r, Exception)]
+        if errors:
+            logging.error('Enrollment import job %s: failed to send payment email for reason %s: %s' % (
+                job.id, reason.id, errors[0]))
+            failed.append(reason.id)
+    sent = len(job.payed_reason_ids) - len(failed)
+    job.payed_reason_ids = failed
+    job.save(update_fields=['payed_reason_ids'])
+    return sent
+
+
+def run_import_side_effects(job):
+    """
+    Действия, которые при записи через edmodule_enroll выполняются для каждой записи отдельно:
+    получение прогресса из edx, письмо о записи на модуль (одна параллельная рассылка на модуль)
+    и письма об оплате для импортированных оплаченных записей.
+    После каждого шага состояние сохраняется в задании; рассылка при повторном запуске продолжается
+    с места остановки (ParallelMassSendMixin). Задание считается выполненным, только если
+    все письма отправлены, иначе неотправленные письма повторяются при следующем запуске
+    :return: {'progress': количество записей с обновленным прогрессом, 'sent': количество отправленных писем}
+    """
+    enrollments = list(EducationalModuleEnrollment.objects.filter(id__in=job.enrollment_ids).select_related(
+        'user', 'module'))
+    result = {'progress': 0, 'sent': 0}
+    if job.update_progress and not job.progress_updated:
+        result['progress'] = update_modules_enrollment_progress(enrollments)
+        job.progress_updated = True
+        job.save(update_fields=['progress_updated'])
+    failed = 0
+    if job.notify:
+        by_module = defaultdict(list)
+        for e in enrollments:
+            by_module[e.module].append(e.id)
+        for module, ids in by_module.items():
+            emails = EdmoduleEnrolledEmails(module, ids)
+            result['sent'] += emails.send_parallel()
+            failed += emails.failed_count
+        if job.payed_reason_ids:
+            result['sent'] += _send_payed_notifications(job)
+            failed += len(job.payed_reason_ids)
+    if failed:
+        logging.warning('Enrollment import job %s: %s messages failed, job will be retried' % (job.id, failed))
+    else:
+        job.finished_at = timezone.now()
+        job.save(update_fields=['finished_at'])
+    logging.info('Enrollment import job %s: progress updated for %s enrollments, %s messages sent' % (
+        job.id, result['progress'], result['sent']))
+    return result
+
+
+def run_pending_import_jobs():
+    """
+    выполнение всех невыполненных заданий
+    :return: [(задание, результат), ...]
+    """
+    return [(job, run_import_side_effects(job))
+            for job in EnrollmentImportJob.objects.filter(finished_at__isnull=True).order_by('id')]
@@ -0,0 +1,109 @@
+# coding: utf-8
+
+import csv
+import json
+from collections import defaultdict
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from .models import EducationalModuleEnrollment, EducationalModuleEnrollmentReason, EducationalModuleProgress
+
+EXPORT_CHUNK_SIZE = 2000
+
+ENROLLMENTS_HEADER = [
+    'enrollment_id', 'username', 'email', 'module', 'is_active', 'is_paid', 'is_graduated', 'enrolled_at',
+    'reason_id', 'mode', 'price', 'payment_type', 'payment_order_id', 'full_paid', 'paid_at', 'progress',
+]
+
+
+class Echo(object):
+    """
+    "файл" для csv.writer, который возвращает записанную строку вместо записи
+    """
+    def write(self, value):
+        return value
+
+
+# значения, начинающиеся с этих символов, excel и другие табличные редакторы считают формулами
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def escape_formula(value):
+    """
+    Защита от подстановки формул через csv: перед строкой, похожей на формулу, добавляется апостроф
+    """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _format_datetime(value):
+    return timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S') if value else ''
+
+
+def _iter_enrollment_chunks(queryset, chunk_size):
+    """
+    Записи на модуль порциями по возрастанию id. Каждая порция - отдельный запрос с id > последнего
+    прочитанного, поэтому память и время жизни запроса не зависят от общего количества записей
+    """
+    queryset = queryset.select_related('user', 'module', 'progress').order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id)[:chunk_size].iterator())
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def iter_enrollment_rows(queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Строки выгрузки записей на модули: по строке на каждую причину записи (оплату),
+    для записей без причин - одна строка с пустыми полями причины.
+    Строковые значения экранируются escape_formula
+    """
+    if queryset is None:
+        queryset = EducationalModuleEnrollment.objects.all()
+    yield ENROLLMENTS_HEADER
+    for chunk in _iter_enrollment_chunks(queryset, chunk_size):
+        reasons = defaultdict(list)
+        for r in EducationalModuleEnrollmentReason.objects.filter(enrollment_id__in=[e.id for e in chunk]).\
+                select_related('module_enrollment_type').order_by('id').iterator():
+            reasons[r.enrollment_id].append(r)
+        for e in chunk:
+            try:
+                progress = json.dumps(e.progress.progress, ensure_ascii=False)
+            except EducationalModuleProgress.DoesNotExist:
+                progress = ''
+            enrollment = [e.id, e.user.username, e.user.email, e.module.code, int(e.is_active), int(e.is_paid),
+                          int(e.is_graduated), _format_datetime(e._ctime)]
+            for r in reasons.get(e.id) or [None]:
+                if r is None:
+                    reason = [''] * 7
+                else:
+                    reason = [r.id, r.module_enrollment_type.mode, r.module_enrollment_type.price,
+                              r.payment_type or '', r.payment_order_id or '', int(r.full_paid),
+                              _format_datetime(r.created_at)]
+                yield [escape_formula(i) for i in enrollment + reason + [progress]]
+
+
+def write_enrollments_csv(f, queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    :return: количество записанных строк без заголовка
+    """
+    writer = csv.writer(f)
+    count = -1
+    for row in iter_enrollment_rows(queryset, chunk_size):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def enrollments_csv_response(queryset=None, filename='edmodule_enrollments.csv'):
+    """
+    Потоковая выгрузка записей на модули в csv: строки формируются по мере отправки ответа
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in iter_enrollment_rows(queryset)),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
@@ -0,0 +1,247 @@
+# coding: utf-8
+
+import logging
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from plp.models import CourseSession, SessionEnrollmentType
+from plp_extension.apps.course_extension.models import CourseExtendedParameters
+from .models import EducationalModule, EdmoduleCourse, PUBLISHED
+from .signals import FACET_INDEX_CACHE_KEY, FACET_INDEX_LOCK_CACHE_KEY
+from .utils import get_next_enroll_boundary, get_timeout_till
+
+# (значение фильтра, от, до включительно); до = None - без ограничения сверху
+PRICE_RANGES = getattr(settings, 'EDMODULE_FILTER_PRICE_RANGES', (
+    ('free', 0, 0),
+    ('0-5000', 1, 5000),
+    ('5000-15000', 5001, 15000),
+    ('15000+', 15001, None),
+))
+# длительность в неделях
+DURATION_RANGES = getattr(settings, 'EDMODULE_FILTER_DURATION_RANGES', (
+    ('0-4', 0, 4),
+    ('5-8', 5, 8),
+    ('9-12', 9, 12),
+    ('13+', 13, None),
+))
+
+
+def _get_range(value, ranges):
+    if value is None:
+        return None
+    for name, low, high in ranges:
+        if value >= low and (high is None or value <= high):
+            return name
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+class FacetIndex(object):
+    """
+    Индекс опубликованных курсов для фильтрации: каждому курсу соответствует бит,
+    для каждого значения каждого фасета хранится битовая маска курсов с этим значением.
+    Внутри фасета значения объединяются по ИЛИ, между фасетами - по И
+    """
+    FACETS = ('university_slug', 'category', 'status', 'enrollable', 'price', 'duration')
+
+    def __init__(self):
+        self.positions = {}
+        # позиция -> [slug курса, slug вуза] или None для удаленных курсов
+        self.courses = []
+        self.bits = {facet: defaultdict(int) for facet in self.FACETS}
+        self.values = {}
+        self.all = 0
+        # код модуля -> маска курсов модуля
+        self.modules = {}
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        courses = cls._get_courses_queryset()
+        prices = cls._get_prices(courses)
+        for c in courses:
+            index.set_course(c.id, cls.get_course_facets(c, prices), [c.slug, c.university.slug])
+        through = EducationalModule.courses.through
+        module_courses = defaultdict(list)
+        for code, course_id in through.objects.filter(educationalmodule__status=PUBLISHED).values_list(
+                'educationalmodule__code', 'course_id'):
+            module_courses[code].append(course_id)
+        for code, course_ids in module_courses.items():
+            index.set_module(code, course_ids)
+        return index
+
+    @staticmethod
+    def _get_courses_queryset():
+        return EdmoduleCourse.objects.filter(status=PUBLISHED).select_related(
+            'university', 'extended_params').prefetch_related('course_sessions', 'extended_params__categories')
+
+    @staticmethod
+    def _get_prices(courses):
+        return dict(SessionEnrollmentType.objects.filter(
+            session__course__in=courses, mode='verified').values_list('session_id', 'price'))
+
+    @staticmethod
+    def get_course_facets(course, prices):
+        """
+        значения фасетов курса: {фасет: [значения]}
+        """
+        session = course.get_next_session()
+        try:
+            categories = [i.slug for i in course.extended_params.categories.all()]
+        except CourseExtendedParameters.DoesNotExist:
+            categories = []
+        if session:
+            duration = session.get_duration() or course.duration
+            price = prices.get(session.id, 0)
+        else:
+            duration = course.duration
+            price = None
+        return {
+            'university_slug': [course.university.slug],
+            'category': categories,
+            'status': [course.course_status_params().get('status') or ''],
+            'enrollable': ['true' if any(s.allow_enrollments() for s in course.course_sessions.all()) else 'false'],
+            'price': [i for i in [_get_range(price, PRICE_RANGES)] if i],
+            'duration': [i for i in [_get_range(duration, DURATION_RANGES)] if i],
+        }
+
+    def set_course(self, course_id, facets, data):
+        self.remove_course(course_id)
+        pos = self.positions.get(course_id)
+        if pos is None:
+            pos = len(self.courses)
+            self.positions[course_id] = pos
+            self.courses.append(None)
+        bit = 1 << pos
+        self.courses[pos] = data
+        self.values[course_id] = facets
+        for facet, values in facets.items():
+            for value in values:
+                self.bits[facet][value] |= bit
+        self.all |= bit
+
+    def remove_course(self, course_id):
+        pos = self.positions.get(course_id)
+        if pos is None or self.courses[pos] is None:
+            return
+        bit = 1 << pos
+        for facet, values in self.values.pop(course_id, {}).items():
+            for value in values:
+                self.bits[facet][value] &= ~bit
+                if not self.bits[facet][value]:
+                    del self.bits[facet][value]
+        self.courses[pos] = None
+        self.all &= ~bit
+
+    def set_module(self, code, course_ids):
+        mask = 0
+        for i in course_ids:
+            pos = self.positions.get(i)
+            if pos is not None:
+                mask |= 1 << pos
+        self.modules[code] = mask
+
+    def remove_module(self, code):
+        self.modules.pop(code, None)
+
+    def update_course(self, course_id):
+        """
+        пересчет значений фасетов одного курса после его изменения
+        """
+        c = self._get_courses_queryset().filter(id=course_id).first()
+        if c is None:
+            self.remove_course(course_id)
+            return
+        self.set_course(c.id, self.get_course_facets(c, self._get_prices([c])), [c.slug, c.university.slug])
+        bit = 1 << self.positions[course_id]
+        for code in EducationalModule.objects.filter(status=PUBLISHED, courses__id=course_id).values_list(
+                'code', flat=True):
+            self.modules[code] = self.modules.get(code, 0) | bit
+
+    def update_module(self, module):
+        if module.status == PUBLISHED:
+            self.set_module(module.code, module.courses.values_list('id', flat=True))
+        else:
+            self.remove_module(module.code)
+
+    def _match(self, filters, skip=None):
+        result = self.all
+        for facet, values in filters.items():
+            if facet == skip or not values:
+                continue
+            mask = 0
+            for value in values:
+                mask |= self.bits[facet].get(value, 0)
+            result &= mask
+        return result
+
+    def query(self, filters):
+        """
+        :param filters: {фасет: [значения]}
+        :return: {
+            'courses': [[slug курса, slug вуза], ...],
+            'modules': [код модуля, ...],
+            'facets': {фасет: {значение: количество курсов}}
+        }
+        количество курсов для значения фасета считается с учетом фильтров по остальным фасетам
+        """
+        filters = {k: v for k, v in filters.items() if k in self.FACETS}
+        result = self._match(filters)
+        courses = []
+        bits, pos = result, 0
+        while bits:
+            if bits & 1:
+                courses.append(self.courses[pos])
+            bits >>= 1
+            pos += 1
+        facets = {}
+        for facet in self.FACETS:
+            base = self._match(filters, skip=facet)
+            facets[facet] = {value: _popcount(mask & base) for value, mask in self.bits[facet].items()
+                             if mask & base}
+        return {
+            'courses': courses,
+            'modules': sorted(code for code, mask in self.modules.items() if mask & result),
+            'facets': facets,
+        }
+
+
+def _get_index_timeout():
+    # статус курса и доступность записи зависят от времени
+    boundary = get_next_enroll_boundary(CourseSession.objects.filter(course__status=PUBLISHED))
+    return get_timeout_till(boundary, settings.PAGE_CACHE_TIME)
+
+
+def get_facet_index():
+    index = cache.get(FACET_INDEX_CACHE_KEY)
+    if index is None:
+        index = FacetIndex.build()
+        # add, а не set: индекс, который успели построить и обновить другие запросы, не перезаписывается
+        cache.add(FACET_INDEX_CACHE_KEY, index, timeout=_get_index_timeout())
+    return index
+
+
+def update_facet_index(course_id=None, module=None):
+    """
+    Инкрементальное обновление индекса, если он уже построен. Вызывается после фиксации транзакции.
+    Чтение, изменение и запись индекса выполняются под блокировкой в кэше, чтобы одновременные
+    обновления не затирали друг друга. Блокировка не ожидается: если ее держит другой процесс,
+    индекс сбрасывается и будет построен заново при следующем запросе
+    """
+    if not cache.add(FACET_INDEX_LOCK_CACHE_KEY, 1, timeout=30):
+        logging.info('Facet index is locked, dropping the index')
+        cache.delete(FACET_INDEX_CACHE_KEY)
+        return
+    try:
+        index = cache.get(FACET_INDEX_CACHE_KEY)
+        if index is None:
+            return
+        if course_id:
+            index.update_course(course_id)
+        if module is not None:
+            index.update_module(module)
+        cache.set(FACET_INDEX_CACHE_KEY, index, timeout=_get_index_timeout())
+    finally:
+        cache.delete(FACET_INDEX_LOCK_CACHE_KEY)
@@ -0,0 +1,16 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.snapshot import write_catalog_snapshot, CATALOG_SNAPSHOT_DIR
+
+
+class Command(BaseCommand):
+    help = 'Сохранение снимка каталога на диск, страница каталога отдает его без обращения к базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=CATALOG_SNAPSHOT_DIR, help='Папка для снимков')
+        parser.add_argument('--keep', type=int, default=3, help='Количество хранимых версий')
+
+    def handle(self, *args, **options):
+        name = write_catalog_snapshot(options['dir'], keep=max(options['keep'], 1))
+        self.stdout.write('Catalog snapshot %s written to %s' % (name, options['dir']))
@@ -0,0 +1,348 @@
+# coding: utf-8
+
+import itertools
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory
+from plp.models import Course
+from plp_extension.apps.course_extension.models import Category
+from plp_edmodule.catalog import (build_catalog_data, build_catalog_payload, get_catalog_payload, get_existing_covers,
+    get_cover, write_catalog_script)
+from plp_edmodule.models import EdmoduleCourse, EducationalModule, PromoCode, PUBLISHED, HIDDEN, \
+    edmodule_course_additional_fields
+from plp_edmodule.search import SearchIndex, COURSE, MODULE
+from plp_edmodule.signals import CATEGORY_COURSES_CACHE_KEY, CATALOG_COVERS_CACHE_KEY
+from plp_edmodule.snapshot import write_catalog_snapshot, get_catalog_snapshot
+from plp_edmodule.utils import generate_promocode
+from plp_edmodule.views import catalog_payload_response, promocode_quote_view
+
+
+# часть прежнего шаблона каталога, которая рендерилась при каждом попадании в кэш
+LEGACY_CATALOG_TEMPLATE = '''{% load imagekit %}
+var COURSE_COVERS = {
+    {% for pk, c in course_covers.items %}{% generateimage 'imagekit:thumbnail' source=c width=275 height=155 as img %}'{{ pk }}':'{{ img.url }}'{% if not forloop.last %},{% endif %}{% endfor %}
+};
+var MODULE_COVERS = {
+    {% for pk, c in module_covers.items %}{% generateimage 'imagekit:thumbnail' source=c width=275 height=155 as img %}'{{ pk }}':'{{ img.url }}'{% if not forloop.last %},{% endif %}{% endfor %}
+};
+var COURSES = {{ courses|safe }};
+var MODULES = {{ modules|safe }};
+{% for cat in categories %}{{ cat.slug }}{{ cat.title }}{% endfor %}
+'''
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.))]
+
+
+@contextmanager
+def _test_database():
+    """
+    временная тестовая база, как при manage.py test; после выхода удаляется
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def _timeit(fn, repeat):
+    """
+    лучшее время из repeat запусков fn, в секундах
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _legacy_getattr(obj, item):
+    """
+    доступ к атрибуту через прежний EdmoduleCourse.__getattribute__: каждое обращение сверяется
+    со списком полей CourseExtendedParameters
+    """
+    if item in edmodule_course_additional_fields:
+        return getattr(obj.extended_params, item)
+    return object.__getattribute__(obj, item)
+
+
+class Command(BaseCommand):
+    help = 'Микробенчмарки plp_edmodule'
+    benchmarks = ('attributes', 'search', 'catalog', 'snapshot', 'stream', 'redeem', 'quote')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=self.benchmarks)
+        parser.add_argument('--limit', type=int, default=None, help='Количество объектов каталога')
+        parser.add_argument('--repeat', type=int, default=5, help='Количество повторов замера')
+
+    def handle(self, *args, **options):
+        getattr(self, 'bench_%s' % options['benchmark'])(options)
+
+    def report(self, name, seconds, operations):
+        self.stdout.write('%-40s %10.1f ns/op %10.2f ms total' % (
+            name, seconds / max(operations, 1) * 1e9, seconds * 1000))
+
+    def bench_attributes(self, options):
+        """
+        стоимость доступа к атрибутам EdmoduleCourse: дескрипторы против прежнего __getattribute__
+        """
+        courses = list(EdmoduleCourse.objects.filter(status=PUBLISHED, extended_params__isnull=False).
+                       select_related('extended_params')[:options['limit'] or 2000])
+        attrs = ['id', 'title', 'slug', 'status'] + list(edmodule_course_additional_fields)[:4]
+        operations = len(courses) * len(attrs)
+
+        def _run(getter):
+            def _inner():
+                for obj in courses:
+                    for attr in attrs:
+                        getter(obj, attr)
+            return _inner
+
+        self.stdout.write('%s courses, attributes: %s' % (len(courses), ', '.join(attrs)))
+        self.report('__getattribute__ (legacy)', _timeit(_run(_legacy_getattr), options['repeat']), operations)
+        self.report('descriptors', _timeit(_run(getattr), options['repeat']), operations)
+
+    def bench_search(self, options):
+        """
+        задержка поиска на синтетическом каталоге из --limit объектов (по умолчанию 50000)
+        """
+        size = options['limit'] or 50000
+        rnd = random.Random(0)
+        # словарь из случайных слов с распределением частот, близким к естественному языку
+        letters = 'абвгдежзийклмнопрстуфхцчшщыэюя'
+        vocabulary = list({''.join(rnd.choices(letters, k=rnd.randint(4, 11))) for _ in range(20000)})
+        cum_weights = list(itertools.accumulate(1. / (i + 1) for i in range(len(vocabulary))))
+
+        def _text(n):
+            return ' '.join(rnd.choices(vocabulary, cum_weights=cum_weights, k=n))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index = SearchIndex(os.path.join(tmp, 'search.sqlite3'))
+            start = time.perf_counter()
+            batch = []
+            for i in range(size):
+                kind = MODULE if i % 10 == 0 else COURSE
+                batch.append((kind, i, '/%s/%s/' % (kind, i), _text(5), _text(10), _text(80)))
+                if len(batch) == 1000:
+                    index.update(batch)
+                    batch = []
+            if batch:
+                index.update(batch)
+            index.optimize()
+            self.stdout.write('Indexed %s items in %.1f s' % (size, time.perf_counter() - start))
+            queries = []
+            for _ in range(200):
+                words = rnd.choices(vocabulary[:2000], k=rnd.randint(1, 3))
+                words[-1] = words[-1][:rnd.randint(3, len(words[-1]))]
+                queries.append(' '.join(words))
+            latencies = []
+            for _ in range(options['repeat']):
+                for q in queries:
+                    start = time.perf_counter()
+                    index.search(q)
+                    latencies.append(time.perf_counter() - start)
+            self.stdout.write('%s queries: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+                len(latencies), _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000,
+                max(latencies) * 1000))
+
+    def bench_catalog(self, options):
+        """
+        попадание в кэш каталога: прежний контекст с моделями и queryset и рендерингом шаблона
+        против заранее сериализованных и сжатых байтов
+        """
+        data = build_catalog_data()
+        course_covers, module_covers = {}, {}
+        for model, covers in ((Course, course_covers), (EducationalModule, module_covers)):
+            existing = get_existing_covers(model)
+            for obj in model.objects.filter(status=PUBLISHED).only('id', 'cover'):
+                cover = get_cover(obj, existing)
+                if cover:
+                    covers[obj.pk] = cover
+        legacy = pickle.dumps({
+            'chosen_category': None,
+            'categories': Category.objects.filter(slug__in=[i['slug'] for i in data['categories']]),
+            'courses': json.dumps(data['courses'], ensure_ascii=False),
+            'modules': json.dumps(data['modules'], ensure_ascii=False),
+            'course_covers': course_covers,
+            'module_covers': module_covers,
+        }, pickle.HIGHEST_PROTOCOL)
+        payload = pickle.dumps(build_catalog_payload(), pickle.HIGHEST_PROTOCOL)
+        template = engines['django'].from_string(LEGACY_CATALOG_TEMPLATE)
+        hits = options['limit'] or 100
+
+        def _legacy():
+            for _ in range(hits):
+                HttpResponse(template.render(pickle.loads(legacy)))
+
+        def _payload():
+            for _ in range(hits):
+                HttpResponse(pickle.loads(payload)['gzip'])
+
+        self.stdout.write('%s courses, %s modules; cached size: context %s bytes, payload %s bytes' % (
+            len(data['courses']), len(data['modules']), len(legacy), len(payload)))
+        self.report('context + template (legacy)', _timeit(_legacy, options['repeat']), hits)
+        self.report('pre-serialized bytes', _timeit(_payload, options['repeat']), hits)
+
+    def bench_snapshot(self, options):
+        """
+        пропускная способность выдачи данных каталога: из кэша против снимка на диске
+        """
+        hits = options['limit'] or 1000
+        request = RequestFactory().get('/catalog/data.js', HTTP_ACCEPT_ENCODING='gzip')
+        get_catalog_payload()
+        with tempfile.TemporaryDirectory() as tmp:
+            write_catalog_snapshot(tmp)
+
+            def _cache():
+                for _ in range(hits):
+                    catalog_payload_response(request, get_catalog_payload()).close()
+
+            def _snapshot():
+                for _ in range(hits):
+                    catalog_payload_response(request, get_catalog_snapshot(tmp)).close()
+
+            for name, fn in (('cache', _cache), ('snapshot', _snapshot)):
+                seconds = _timeit(fn, options['repeat'])
+                self.report(name, seconds, hits)
+                self.stdout.write('%-40s %10.0f requests/s' % ('', hits / seconds))
+
+    def bench_stream(self, options):
+        """
+        пиковая память построения каталога (tracemalloc): целиком в памяти против потоковой записи в файлы
+        на половине каталога и на всем каталоге, чтобы было видно, растет ли память с его размером.
+        Кэши карты категорий и списков обложек сбрасываются перед каждым замером и входят в него.
+        --limit задает размер порции потокового построения
+        """
+        def _in_memory():
+            build_catalog_payload()
+
+        def _stream():
+            with tempfile.TemporaryFile() as raw_file, tempfile.TemporaryFile() as gzip_file:
+                write_catalog_script(raw_file, gzip_file, chunk_size=options['limit'] or 500)
+
+        def _measure():
+            self.stdout.write('%s courses, %s modules' % (
+                Course.objects.filter(status=PUBLISHED).count(),
+                EducationalModule.objects.filter(status=PUBLISHED).count()))
+            for name, fn in (('in memory', _in_memory), ('streaming', _stream)):
+                cache.delete_many([CATEGORY_COURSES_CACHE_KEY, CATALOG_COVERS_CACHE_KEY % 'course',
+                                   CATALOG_COVERS_CACHE_KEY % 'educationalmodule'])
+                tracemalloc.start()
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stdout.write('%-40s %10.1f MB peak %10.2f s' % (name, peak / 1024. / 1024, elapsed))
+
+        # половина каталога: каждый второй курс и модуль временно снимается с публикации, изменения откатываются
+        with transaction.atomic():
+            for model in (Course, EducationalModule):
+                ids = list(model.objects.filter(status=PUBLISHED).order_by('id').values_list('id', flat=True))
+                model.objects.filter(id__in=ids[::2]).update(status=HIDDEN)
+            _measure()
+            transaction.set_rollback(True)
+        _measure()
+
+    def bench_redeem(self, options):
+        """
+        нагрузочная проверка PromoCode.redeem: --limit потоков (по умолчанию 16) одновременно используют
+        промокод с max_usage = 50, успешных использований должно быть ровно max_usage.
+        Потоки работают в своих соединениях, поэтому проверка идет во временной тестовой базе, а не в рабочей
+        """
+        workers = options['limit'] or 16
+        max_usage = 50
+        with _test_database():
+            promo = PromoCode.objects.create(
+                code=generate_promocode(), product_type='course', max_usage=max_usage, used=0,
+                active_till=date.today() + timedelta(days=1), discount_percent=10,
+            )
+            results = []
+            barrier = threading.Barrier(workers)
+
+            def _worker():
+                try:
+                    barrier.wait()
+                    for _ in range(max_usage):
+                        results.append(PromoCode.redeem(promo.code))
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=_worker) for _ in range(workers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            used = PromoCode.objects.get(id=promo.id).used
+        self.report('redeem', elapsed, len(results))
+        self.stdout.write('%s attempts, %s successful, used = %s, max_usage = %s' % (
+            len(results), sum(results), used, max_usage))
+        if sum(results) != max_usage or used != max_usage:
+            raise CommandError('Promocode over- or under-redeemed')
+
+    def bench_quote(self, options):
+        """
+        задержка расчета цены модуля с промокодом: прежний пересчет цен модуля при каждом запросе
+        против кэшированных цен, и задержка эндпоинта promocode_quote_view (--limit запросов)
+        """
+        module = EducationalModule.objects.filter(status=PUBLISHED).first()
+        if module is None:
+            raise CommandError('No published modules to quote')
+        hits = options['limit'] or 200
+        factory = RequestFactory()
+        code = generate_promocode()
+        request = factory.get('/promocode/quote/', {'code': code, 'product_id': module.id,
+                                                    'product_type': 'edmodule', 'only_first_course': 'false'})
+
+        def _legacy():
+            for _ in range(hits):
+                m = EducationalModule.objects.get(id=module.id)
+                m.get_price_list()
+                m.get_first_session_to_buy(None)
+
+        def _cached():
+            for _ in range(hits):
+                EducationalModule.get_promocode_price_data(module.id)
+
+        # промокод существует только внутри откатываемой транзакции
+        with transaction.atomic():
+            PromoCode.objects.create(
+                code=code, product_type='edmodule', edmodule=module, max_usage=1000000, used=0,
+                active_till=date.today() + timedelta(days=1), discount_percent=10,
+            )
+            EducationalModule.get_promocode_price_data(module.id)
+            self.report('get_price_list (legacy)', _timeit(_legacy, options['repeat']), hits)
+            self.report('cached price data', _timeit(_cached, options['repeat']), hits)
+            latencies = []
+            for i in range(hits):
+                # у каждого запроса свой адрес, чтобы замер не упирался в ограничение частоты
+                request.META['REMOTE_ADDR'] = '10.0.%s.%s' % (i // 256 % 256, i % 256)
+                start = time.perf_counter()
+                response = promocode_quote_view(request)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise CommandError('Unexpected response status %s' % response.status_code)
+            self.stdout.write('%s quote requests: p50 %.2f ms, p99 %.2f ms' % (
+                len(latencies), _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000))
+            transaction.set_rollback(True)
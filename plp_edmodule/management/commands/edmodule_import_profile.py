@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import json
+import os
+import pkgutil
+import subprocess
+import sys
+from django.core.management.base import BaseCommand, CommandError
+import plp_edmodule
+
+# выполняется в отдельном процессе, чтобы каждый модуль импортировался "с нуля"
+PROFILE_SCRIPT = '''
+import contextlib, importlib, json, sys, time
+from django.db import connections
+
+queries = []
+
+def wrapper(execute, sql, params, many, context):
+    queries.append(sql)
+    return execute(sql, params, many, context)
+
+with contextlib.ExitStack() as stack:
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(wrapper))
+    import django
+    start = time.perf_counter()
+    django.setup()
+    setup_time = time.perf_counter() - start
+    setup_queries = len(queries)
+    name = sys.argv[1]
+    loaded_by_setup = name in sys.modules
+    start = time.perf_counter()
+    importlib.import_module(name)
+    import_time = time.perf_counter() - start
+
+print(json.dumps({
+    'setup_time': setup_time,
+    'setup_queries': setup_queries,
+    'loaded_by_setup': loaded_by_setup,
+    'import_time': import_time,
+    'import_queries': len(queries) - setup_queries,
+    'sql': queries,
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Время импорта и количество sql-запросов при импорте каждого модуля plp_edmodule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-queries', action='store_true', default=False,
+                            help='Завершиться с ошибкой, если импорт приложения выполняет sql-запросы')
+
+    def get_module_names(self):
+        names = [plp_edmodule.__name__]
+        for info in pkgutil.walk_packages(plp_edmodule.__path__, prefix=plp_edmodule.__name__ + '.'):
+            if '.migrations' in info.name or '.management' in info.name:
+                continue
+            names.append(info.name)
+        return names
+
+    def profile(self, name):
+        result = subprocess.run(
+            [sys.executable, '-c', PROFILE_SCRIPT, name],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ.copy()
+        )
+        if result.returncode:
+            raise CommandError('Import of %s failed:\n%s' % (name, result.stderr.decode('utf-8', 'replace')))
+        return json.loads(result.stdout.decode('utf-8').strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        with_queries = []
+        setup_reported = False
+        for name in self.get_module_names():
+            data = self.profile(name)
+            if not setup_reported:
+                self.stdout.write('%-50s %8.1f ms %4s queries' % (
+                    'django.setup()', data['setup_time'] * 1000, data['setup_queries']))
+                setup_reported = True
+                if data['setup_queries']:
+                    with_queries.append('django.setup()')
+            note = ' (loaded by django.setup())' if data['loaded_by_setup'] else ''
+            self.stdout.write('%-50s %8.1f ms %4s queries%s' % (
+                name, data['import_time'] * 1000, data['import_queries'], note))
+            if data['import_queries']:
+                with_queries.append(name)
+                for sql in data['sql'][data['setup_queries']:]:
+                    self.stdout.write('    %s' % sql)
+        if with_queries and options['fail_on_queries']:
+            raise CommandError('SQL issued while importing: %s' % ', '.join(with_queries))
@@ -0,0 +1,32 @@
+# coding: utf-8
+
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.export import write_enrollments_csv, EXPORT_CHUNK_SIZE
+from plp_edmodule.models import EducationalModule, EducationalModuleEnrollment
+
+
+class Command(BaseCommand):
+    help = 'Выгрузка записей на модули с оплатами и прогрессом в csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', action='append', help='Код модуля (можно указать несколько раз)')
+        parser.add_argument('--output', help='csv-файл, по умолчанию stdout')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Размер порции выборки')
+
+    def handle(self, *args, **options):
+        queryset = EducationalModuleEnrollment.objects.all()
+        if options['module']:
+            found = set(EducationalModule.objects.filter(code__in=options['module']).values_list('code', flat=True))
+            missing = set(options['module']) - found
+            if missing:
+                raise CommandError('Modules not found: %s' % ', '.join(sorted(missing)))
+            queryset = queryset.filter(module__code__in=options['module'])
+        start = time.perf_counter()
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                count = write_enrollments_csv(f, queryset, chunk_size=options['chunk_size'])
+        else:
+            count = write_enrollments_csv(sys.stdout, queryset, chunk_size=options['chunk_size'])
+        self.stderr.write('Exported %s rows in %.1f s' % (count, time.perf_counter() - start))
@@ -0,0 +1,35 @@
+# coding: utf-8
+
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.models import PromoCode
+from plp_edmodule.utils import generate_promocodes, PROMOCODE_SPACE_WARNING
+
+
+class Command(BaseCommand):
+    help = 'Создание пачки промокодов с параметрами промокода-образца'
+
+    def add_arguments(self, parser):
+        parser.add_argument('template_id', type=int, help='id промокода-образца')
+        parser.add_argument('count', type=int, help='Количество промокодов')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер порции bulk_create')
+        parser.add_argument('--output', help='csv-файл для списка созданных кодов')
+
+    def handle(self, *args, **options):
+        template = PromoCode.objects.filter(id=options['template_id']).first()
+        if not template:
+            raise CommandError('Promocode %s not found' % options['template_id'])
+        if options['count'] < 1:
+            raise CommandError('count must be positive')
+        try:
+            created, usage = generate_promocodes(template, options['count'], batch_size=options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['code'])
+                writer.writerows([i.code] for i in created)
+        self.stdout.write('Created %s promocodes' % len(created))
+        if usage >= PROMOCODE_SPACE_WARNING:
+            self.stderr.write('Warning: %.0f%% of promocode space is used' % (usage * 100))
@@ -0,0 +1,50 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.enrollment_import import parse_enrollments_file, import_enrollments, create_import_job, \
+    run_pending_import_jobs, IMPORT_BATCH_SIZE
+from plp_edmodule.models import EducationalModule
+
+
+class Command(BaseCommand):
+    help = 'Массовая запись пользователей на модули из csv или json и выполнение заданий после импорта'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='csv или json файл')
+        parser.add_argument('--module', help='Код модуля для строк без поля module')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Размер порции записи')
+        parser.add_argument('--no-notify', action='store_true', help='Не отправлять письма о записи')
+        parser.add_argument('--no-progress', action='store_true', help='Не обновлять прогресс из edx')
+        parser.add_argument('--pending', action='store_true',
+                            help='Выполнить невыполненные задания (письма и прогресс), в том числе созданные в админке')
+
+    def handle(self, *args, **options):
+        if not options['path'] and not options['pending']:
+            raise CommandError('Specify a file to import or --pending')
+        if options['path']:
+            self.import_file(options)
+        for job, result in run_pending_import_jobs():
+            self.stdout.write('Job %s: progress updated for %s enrollments, %s messages sent' % (
+                job.id, result['progress'], result['sent']))
+
+    def import_file(self, options):
+        module = None
+        if options['module']:
+            module = EducationalModule.objects.filter(code=options['module']).first()
+            if not module:
+                raise CommandError('Module %s not found' % options['module'])
+        try:
+            with open(options['path'], 'rb') as f:
+                rows = parse_enrollments_file(f, options['path'])
+            result = import_enrollments(rows, module=module, batch_size=options['batch_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        for number, error in result['errors']:
+            self.stderr.write('Row %s: %s' % (number, error))
+        self.stdout.write('%s rows in %.1f s (%.0f rows/s): %s enrollments created, %s reactivated, '
+                          '%s reasons created, %s errors' % (
+                              result['rows'], result['seconds'], result['rows'] / max(result['seconds'], 1e-6),
+                              result['created'], result['reactivated'], result['reasons'], len(result['errors'])))
+        # задание сохраняется до выполнения, поэтому прерванную обработку продолжит запуск с --pending
+        create_import_job(result['enrollment_ids'], notify=not options['no_notify'],
+                          update_progress=not options['no_progress'], payed_reason_ids=result['payed_reason_ids'])
@@ -0,0 +1,12 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Полное перестроение поискового индекса модулей и курсов'
+
+    def handle(self, *args, **options):
+        count = rebuild_search_index()
+        self.stdout.write('Indexed %s items' % count)
@@ -0,0 +1,13 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.models import EducationalModuleCounter, CourseParticipantsCounter
+
+
+class Command(BaseCommand):
+    help = 'Сверка счетчиков участников курсов и записей на модули с фактическими данными'
+
+    def handle(self, *args, **options):
+        courses = CourseParticipantsCounter.recount()
+        modules = EducationalModuleCounter.recount()
+        self.stdout.write('Fixed counters: %s courses, %s modules' % (courses, modules))
@@ -0,0 +1,20 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_extension.apps.course_extension.models import CourseCreator
+from plp_edmodule.models import CourseCreatorStats
+
+
+class Command(BaseCommand):
+    help = 'Пересчет статистики страниц организаций, по умолчанию только устаревшей или отсутствующей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False, help='Пересчитать статистику всех организаций')
+
+    def handle(self, *args, **options):
+        creators = CourseCreator.objects.all() if options['all'] else CourseCreatorStats.get_outdated()
+        count = 0
+        for creator in creators.iterator():
+            CourseCreatorStats.refresh(creator)
+            count += 1
+        self.stdout.write('Refreshed stats of %s organizations' % count)
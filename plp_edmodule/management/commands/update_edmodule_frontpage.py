@@ -0,0 +1,12 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.utils import build_frontpage_pool
+
+
+class Command(BaseCommand):
+    help = 'Пересчет пула кандидатов для главной страницы (запускать периодически)'
+
+    def handle(self, *args, **options):
+        pool = build_frontpage_pool()
+        self.stdout.write('Frontpage pool updated: %s categories' % len(pool))
@@ -0,0 +1,50 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:00
+
+import importlib
+import pkgutil
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+def _course_creator_migration():
+    """
+    миграция course_extension, которая создает CourseCreator
+    """
+    package = importlib.import_module('plp_extension.apps.course_extension.migrations')
+    for name in sorted(i.name for i in pkgutil.iter_modules(package.__path__)):
+        migration = importlib.import_module('%s.%s' % (package.__name__, name)).Migration
+        for operation in migration.operations:
+            if isinstance(operation, migrations.CreateModel) and operation.name == 'CourseCreator':
+                return name
+    raise LookupError('course_extension has no migration creating CourseCreator')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course_extension', _course_creator_migration()),
+        ('plp_edmodule', '0015_edmodulecourse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseCreatorStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('courses_rating', models.FloatField(default=0, verbose_name='Рейтинг курсов')),
+                ('modules_rating', models.FloatField(default=0, verbose_name='Рейтинг модулей')),
+                ('course_ids', jsonfield.fields.JSONField(default=list, verbose_name='Курсы')),
+                ('module_ids', jsonfield.fields.JSONField(default=list, verbose_name='Модули')),
+                ('instructor_ids', jsonfield.fields.JSONField(default=list, verbose_name='Преподаватели')),
+                ('popular_programs', jsonfield.fields.JSONField(default=list, help_text='[["em" или "course", id], ...]', verbose_name='Популярные программы')),
+                ('is_stale', models.BooleanField(db_index=True, default=True, verbose_name='Требует пересчета')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('creator', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='edmodule_stats', to='course_extension.CourseCreator', verbose_name='Автор или партнер')),
+            ],
+            options={
+                'verbose_name': 'Статистика организации',
+                'verbose_name_plural': 'Статистика организаций',
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp', '0003_auto_20181022_2004'),
+        ('plp_edmodule', '0016_coursecreatorstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='count_enrollments',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество активных записей'),
+        ),
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='count_paid_enrollments',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество оплаченных записей'),
+        ),
+        migrations.CreateModel(
+            name='CourseParticipantsCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('participants', models.PositiveIntegerField(default=0, verbose_name='Количество участников')),
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='edmodule_counter', to='plp.Course', verbose_name='Курс')),
+            ],
+            options={
+                'verbose_name': 'Счетчик участников курса',
+                'verbose_name_plural': 'Счетчики участников курсов',
+            },
+        ),
+    ]
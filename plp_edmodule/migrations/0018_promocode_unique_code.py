@@ -0,0 +1,53 @@
+# Generated by Django 2.0.5 on 2026-10-18 13:00
+
+import random
+import string
+from django.db import migrations, models
+
+
+def dedupe_codes(apps, schema_editor):
+    """
+    Пустые коды заменяются на NULL и в уникальности не участвуют. Из промокодов с одинаковым
+    непустым кодом код сохраняется у наиболее использованного, остальным выдаются новые уникальные коды
+    """
+    PromoCode = apps.get_model('plp_edmodule', 'PromoCode')
+    PromoCode.objects.filter(code='').update(code=None)
+    alphabet = string.ascii_uppercase + string.digits
+    rnd = random.SystemRandom()
+    existing = set(PromoCode.objects.exclude(code=None).values_list('code', flat=True))
+    duplicates = PromoCode.objects.exclude(code=None).values('code').annotate(cnt=models.Count('id')).\
+        filter(cnt__gt=1).values_list('code', flat=True)
+    for code in list(duplicates):
+        ids = list(PromoCode.objects.filter(code=code).order_by('-used', 'id').values_list('id', flat=True))
+        for pk in ids[1:]:
+            new_code = code
+            while new_code in existing:
+                new_code = ''.join(rnd.choice(alphabet) for _ in range(6))
+            existing.add(new_code)
+            PromoCode.objects.filter(id=pk).update(code=new_code)
+
+
+def restore_blank_codes(apps, schema_editor):
+    PromoCode = apps.get_model('plp_edmodule', 'PromoCode')
+    PromoCode.objects.filter(code=None).update(code='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0017_enrollment_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='promocode',
+            name='code',
+            field=models.CharField(blank=True, max_length=6, null=True, verbose_name='Промокод'),
+        ),
+        migrations.RunPython(dedupe_codes, restore_blank_codes),
+        migrations.AlterField(
+            model_name='promocode',
+            name='code',
+            field=models.CharField(blank=True, max_length=6, null=True, unique=True, verbose_name='Промокод'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.0.5 on 2026-10-18 14:00
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0018_promocode_unique_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnrollmentImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enrollment_ids', jsonfield.fields.JSONField(default=list, verbose_name='Записи на модуль')),
+                ('notify', models.BooleanField(default=True, verbose_name='Отправить письма о записи')),
+                ('update_progress', models.BooleanField(default=True, verbose_name='Обновить прогресс из edx')),
+                ('progress_updated', models.BooleanField(default=False, verbose_name='Прогресс обновлен')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('finished_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Выполнено')),
+            ],
+            options={
+                'verbose_name': 'Задание после импорта записей',
+                'verbose_name_plural': 'Задания после импорта записей',
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 2.0.5 on 2026-10-18 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_counters(apps, schema_editor):
+    EducationalModule = apps.get_model('plp_edmodule', 'EducationalModule')
+    EducationalModuleCounter = apps.get_model('plp_edmodule', 'EducationalModuleCounter')
+    EducationalModuleCounter.objects.bulk_create([
+        EducationalModuleCounter(module_id=pk, enrollments=enrollments, paid_enrollments=paid_enrollments)
+        for pk, enrollments, paid_enrollments in EducationalModule.objects.values_list(
+            'id', 'count_enrollments', 'count_paid_enrollments')
+    ], batch_size=1000)
+
+
+def copy_counters_back(apps, schema_editor):
+    EducationalModule = apps.get_model('plp_edmodule', 'EducationalModule')
+    EducationalModuleCounter = apps.get_model('plp_edmodule', 'EducationalModuleCounter')
+    for module_id, enrollments, paid_enrollments in EducationalModuleCounter.objects.values_list(
+            'module_id', 'enrollments', 'paid_enrollments'):
+        EducationalModule.objects.filter(id=module_id).update(
+            count_enrollments=enrollments, count_paid_enrollments=paid_enrollments)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0019_enrollmentimportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enrollments', models.PositiveIntegerField(default=0, verbose_name='Количество активных записей')),
+                ('paid_enrollments', models.PositiveIntegerField(default=0, verbose_name='Количество оплаченных записей')),
+                ('module', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='edmodule_counter', to='plp_edmodule.EducationalModule', verbose_name='Образовательный модуль')),
+            ],
+            options={
+                'verbose_name': 'Счетчик записей на модуль',
+                'verbose_name_plural': 'Счетчики записей на модули',
+            },
+        ),
+        migrations.RunPython(copy_counters, copy_counters_back),
+        migrations.RemoveField(
+            model_name='educationalmodule',
+            name='count_enrollments',
+        ),
+        migrations.RemoveField(
+            model_name='educationalmodule',
+            name='count_paid_enrollments',
+        ),
+    ]
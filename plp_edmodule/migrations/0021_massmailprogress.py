@@ -0,0 +1,27 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:00
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0020_educationalmodulecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MassMailProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('progress_key', models.CharField(db_index=True, max_length=255, verbose_name='Рассылка')),
+                ('emails', jsonfield.fields.JSONField(default=list, verbose_name='Адреса')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+            ],
+            options={
+                'verbose_name': 'Прогресс массовой рассылки',
+                'verbose_name_plural': 'Прогресс массовых рассылок',
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:00
+
+from django.db import migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0021_massmailprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enrollmentimportjob',
+            name='payed_reason_ids',
+            field=jsonfield.fields.JSONField(
+                default=list, verbose_name='Оплаченные причины записи без письма об оплате'),
+        ),
+    ]
@@ -1,13 +1,15 @@
 # coding: utf-8
 
-import random
+import copy
 from collections import defaultdict
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core import validators
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed
 from django.utils import timezone
 from django.utils.functional import cached_property, SimpleLazyObject
 from django.utils.translation import ugettext_lazy as _
@@ -15,13 +17,17 @@ from jsonfield import JSONField
 from sortedm2m.fields import SortedManyToManyField
 from imagekit.models import ImageSpecField
 from imagekit.processors import Resize
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
-from plp.models import Course, User, SessionEnrollmentType, Participant, CourseSession, EnrollmentReason
+from plp.models import Course, User, SessionEnrollmentType, Participant, CourseSession, EnrollmentReason, Instructor
 from plp_extension.apps.module_extension.models import DEFAULT_COVER_SIZE
-from plp_extension.apps.course_extension.models import CourseExtendedParameters
+from plp_extension.apps.course_extension.models import CourseExtendedParameters, CourseCreator
 from .signals import edmodule_enrolled, edmodule_enrolled_handler, edmodule_payed, edmodule_payed_handler, \
-    edmodule_unenrolled, edmodule_unenrolled_handler
+    edmodule_unenrolled, edmodule_unenrolled_handler, course_promotion_changed_handler, catalog_changed_handler, \
+    module_may_enroll_handler, course_may_enroll_handler, MAY_ENROLL_CACHE_KEY, facet_index_course_handler, \
+    facet_index_module_handler, search_index_handler, creator_stats_handler, participants_counter_handler, \
+    module_enrollments_counter_handler, MODULE_PRICE_CACHE_KEY, \
+    CREATOR_STATS_LOCK_CACHE_KEY
 
 HIDDEN = 'hidden'
 DIRECT = 'direct'
@@ -66,6 +72,67 @@ class EducationalModule(models.Model):
     def __str__(self):
         return '%s - %s' % (self.code, ', '.join(self.courses.values_list('slug', flat=True)))
 
+    def _get_counter_value(self, field):
+        try:
+            return getattr(self.edmodule_counter, field)
+        except EducationalModuleCounter.DoesNotExist:
+            return 0
+
+    @property
+    def count_enrollments(self):
+        """
+        количество активных записей на модуль (EducationalModuleCounter)
+        """
+        return self._get_counter_value('enrollments')
+
+    @property
+    def count_paid_enrollments(self):
+        """
+        количество полностью оплаченных записей на модуль (EducationalModuleCounter)
+        """
+        return self._get_counter_value('paid_enrollments')
+
+    def set_courses(self, course_ids):
+        """
+        Сохранение состава модуля в порядке course_ids с изменением только отличающихся строк.
+        В отличие от setattr (sortedm2m очищает и заново записывает все курсы), удаляются только
+        убранные курсы, добавляются только новые, а sort_value меняется только у строк, нарушающих порядок.
+        Если состав и порядок не изменились, ни запросов на запись, ни сигналов (и сброса кэшей) нет
+        :return: True, если что-то изменилось
+        """
+        through = self.__class__.courses.through
+        sort_field = through._sort_field_name
+        course_ids = list(course_ids)
+        with transaction.atomic():
+            current = list(through.objects.filter(educationalmodule_id=self.id).order_by(sort_field).
+                           values_list('course_id', flat=True))
+            if current == course_ids:
+                return False
+            existing = set(current)
+            removed = existing - set(course_ids)
+            added = [i for i in course_ids if i not in existing]
+            if removed:
+                self.courses.remove(*removed)
+            if added:
+                self.courses.add(*added)
+            rows = dict((course_id, (pk, sort_value)) for pk, course_id, sort_value in through.objects.filter(
+                educationalmodule_id=self.id).values_list('id', 'course_id', sort_field))
+            reordered, previous = False, None
+            for course_id in course_ids:
+                pk, sort_value = rows[course_id]
+                if previous is not None and sort_value <= previous:
+                    sort_value = previous + 1
+                    through.objects.filter(id=pk).update(**{sort_field: sort_value})
+                    reordered = True
+                previous = sort_value
+            if reordered and not (removed or added):
+                # перестановка курсов не вызывает m2m_changed, а порядок курсов влияет на каталог
+                # и на возможность записи на модуль; кэши сбрасываются после фиксации, чтобы параллельный
+                # запрос не закэшировал прежний порядок
+                transaction.on_commit(catalog_changed_handler)
+                transaction.on_commit(lambda: module_may_enroll_handler(instance=self))
+        return True
+
     @cached_property
     def duration(self):
         """
@@ -169,20 +236,30 @@ class EducationalModule(models.Model):
 
     def get_related(self):
         """
-        получение похожих курсов и специализаций (от 0 до 2)
+        получение похожих курсов и специализаций (от 0 до 2); списки кандидатов кэшируются
+        до изменения каталога (get_related_ids), на запрос остаются только выборка и загрузка объектов
         """
-        categories = self.categories
-        if not categories:
-            return []
-        modules = EducationalModule.objects.exclude(id=self.id).filter(
-            courses__extended_params__categories__in=categories,status='published').distinct()
-        courses = EdmoduleCourse.objects.exclude(id__in=self.courses.values_list('id', flat=True)).filter(
-            extended_params__categories__in=categories,status='published').distinct()
+        from .utils import sample_objects, get_related_ids
+
+        def _build():
+            categories = self.categories
+            if not categories:
+                return [], []
+            modules = EducationalModule.objects.exclude(id=self.id).filter(
+                courses__extended_params__categories__in=categories,status='published').distinct()
+            courses = EdmoduleCourse.objects.exclude(id__in=self.courses.values_list('id', flat=True)).filter(
+                extended_params__categories__in=categories,status='published').distinct()
+            return modules.order_by().values_list('id', flat=True), courses.order_by().values_list('id', flat=True)
+
+        module_ids, course_ids = get_related_ids('module:%s' % self.id, _build)
         related = []
-        if modules:
-            related.append({'type': 'em', 'item': random.sample(list(modules), 1)[0]})
-        if courses:
-            sample = random.sample(list(courses), min(len(courses), 2))
+        if module_ids:
+            # выбранный модуль мог быть удален после кэширования кандидатов
+            sample = sample_objects(EducationalModule.objects.all(), module_ids, 1)
+            if sample:
+                related.append({'type': 'em', 'item': sample[0]})
+        if course_ids:
+            sample = sample_objects(EdmoduleCourse.objects.all(), course_ids, 2)
             for i in range(2 - len(related)):
                 try:
                     related.append({'type': 'course', 'item': sample[i]})
@@ -284,6 +361,36 @@ class EducationalModule(models.Model):
         })
         return result
 
+    @classmethod
+    def get_promocode_price_data(cls, module_id):
+        """
+        Цены модуля без учета пользователя, нужные для расчета промокода (PromoCode.calculate).
+        Кэшируются до изменения версии каталога, но не дольше, чем до ближайшего открытия или закрытия
+        записи на сессии курсов модуля: от этого зависит выбор сессий и цена
+        :return: {'price', 'whole_price', 'discount' - как в get_price_list,
+            'first_course_price' - цена первого курса, который можно купить, или None}
+            или None, если модуля нет
+        """
+        from .catalog import get_catalog_version
+        from .utils import get_next_enroll_boundary, get_timeout_till
+        key = MODULE_PRICE_CACHE_KEY % (get_catalog_version(), module_id)
+        data = cache.get(key)
+        if data is None:
+            module = cls.objects.filter(id=module_id).first()
+            if module is None:
+                return None
+            price = module.get_price_list()
+            first_session = module.get_first_session_to_buy(None)
+            data = {
+                'price': price['price'],
+                'whole_price': price['whole_price'],
+                'discount': price['discount'],
+                'first_course_price': first_session[1] if first_session else None,
+            }
+            boundary = get_next_enroll_boundary(CourseSession.objects.filter(course__in=module.courses.all()))
+            cache.set(key, data, timeout=get_timeout_till(boundary, settings.PAGE_CACHE_TIME))
+        return dict(data)
+
     def get_start_date(self):
         """
         дата старта первого курса модуля
@@ -320,9 +427,23 @@ class EducationalModule(models.Model):
 
     def may_enroll(self):
         """
-        Проверка того, что пользователь может записаться на модуль
+        Проверка того, что пользователь может записаться на модуль.
+        Результат кэшируется до ближайшего открытия или закрытия записи на одну из сессий модуля
         :return: bool
         """
+        from .utils import get_next_enroll_boundary, get_timeout_till
+        if not self.pk:
+            return self._may_enroll()
+        key = MAY_ENROLL_CACHE_KEY % self.id
+        value = cache.get(key)
+        if value is None:
+            value = self._may_enroll()
+            boundary = get_next_enroll_boundary(CourseSession.objects.filter(course__in=self.courses.all()))
+            max_timeout = getattr(settings, 'EDMODULE_MAY_ENROLL_MAX_TIMEOUT', 24 * 3600)
+            cache.set(key, value, timeout=get_timeout_till(boundary, max_timeout))
+        return value
+
+    def _may_enroll(self):
         courses = self.courses_with_closest_sessions
         return all(i[1] and i[1].allow_enrollments() for i in courses)
 
@@ -546,7 +667,8 @@ class PromoCode(models.Model):
         verbose_name = _('Промокод')
         verbose_name_plural = _('Промокоды')
  
-    code = models.CharField(_('Промокод'), max_length=6, blank=True, null=False)
+    # пустой код хранится как NULL: такие промокоды не участвуют в уникальности и не могут быть использованы
+    code = models.CharField(_('Промокод'), max_length=6, blank=True, null=True, unique=True)
     product_type = models.CharField(_('Тип продукта'), max_length=10, choices=PRODUCTS, default='course', blank=False, null=False)
     course = models.ForeignKey(Course, verbose_name=_('Курс'), blank=True, null=True, on_delete=models.CASCADE)
     edmodule = models.ForeignKey(EducationalModule, related_name='edmodule', verbose_name=_('Специализация'),
@@ -568,12 +690,12 @@ class PromoCode(models.Model):
             а также сообщение, содержащие суть ошибки """
 
         msg = 'данному курсу' if product_type == self.PRODUCTS[0][0] else 'данной специализации'
-        if self.product_type == self.PRODUCTS[1][0] and not self.product_type == product_type and not self.edmodule.id == product_id:
+        if self.product_type == self.PRODUCTS[1][0] and not self.product_type == product_type and not self.edmodule_id == product_id:
             return {
                 'status': 1,
                 'message': str(_('Промокод не принадлежит ' + msg))
             }
-        elif self.product_type == self.PRODUCTS[0][0] and not self.product_type == product_type and not self.course.id == product_id:
+        elif self.product_type == self.PRODUCTS[0][0] and not self.product_type == product_type and not self.course_id == product_id:
             return {
                 'status': 1,
                 'message': str(_('Промокод не принадлежит ' + msg))
@@ -597,6 +719,24 @@ class PromoCode(models.Model):
             'message': str(_('Промокод действителен'))
         }
 
+    @classmethod
+    def redeem(cls, code, product_id=None, product_type=None):
+        """
+        Использование промокода при оплате (в том числе при импорте оплат, enrollment_import).
+        Поиск идет по уникальному индексу code, а used увеличивается одним условным UPDATE,
+        только пока лимит не исчерпан и срок действия не истек, поэтому параллельные оплаты
+        не могут превысить max_usage. used нужно менять только через этот метод
+        :return: True, если промокод использован
+        """
+        if not code:
+            return False
+        qs = cls.objects.filter(code=code, used__lt=models.F('max_usage'), active_till__gte=datetime.now().date())
+        if product_type == cls.PRODUCTS[0][0]:
+            qs = qs.filter(product_type=product_type, course_id=product_id)
+        elif product_type == cls.PRODUCTS[1][0]:
+            qs = qs.filter(product_type=product_type, edmodule_id=product_id)
+        return qs.update(used=models.F('used') + 1) == 1
+
     def calculate(self, product_id=None, only_first_course=None, session_id=None):
         """ Производит расчет по переданным параметрам и, в соответствие, с логикой задачи OP-614 """
             
@@ -607,18 +747,20 @@ class PromoCode(models.Model):
             }   
 
         if self.product_type == self.PRODUCTS[1][0]:
-            try:
-                edmodule = EducationalModule.objects.get(id=product_id)
-            except ObjectDoesNotExist:
+            price = EducationalModule.get_promocode_price_data(product_id)
+            if price is None:
                 return {
                     'status': 1,
                     'message': str(_('Не удалось найти специализацию'))
                 }
 
-            price = edmodule.get_price_list()
-
             if only_first_course == True:
-                first_course_price = edmodule.get_first_session_to_buy(None)[1]
+                first_course_price = price['first_course_price']
+                if first_course_price is None:
+                    return {
+                        'status': 1,
+                        'message': str(_('Не удалось найти курс'))
+                    }
                 price['price'] = first_course_price
                 price['whole_price'] = first_course_price * (1 - price['discount'] / 100.)
             
@@ -660,6 +802,293 @@ class PromoCode(models.Model):
             }  
 
 
+class CourseCreatorStats(models.Model):
+    """
+    Предрасчитанные данные страницы организации (organization_view). Помечаются устаревшими
+    при изменении участников, рейтингов и состава курсов и модулей организации и пересчитываются
+    командой refresh_edmodule_creator_stats; страница до пересчета показывает последние данные
+    """
+    creator = models.OneToOneField(CourseCreator, verbose_name=_('Автор или партнер'), related_name='edmodule_stats',
+                                   on_delete=models.CASCADE)
+    courses_rating = models.FloatField(_('Рейтинг курсов'), default=0)
+    modules_rating = models.FloatField(_('Рейтинг модулей'), default=0)
+    course_ids = JSONField(_('Курсы'), default=list)
+    module_ids = JSONField(_('Модули'), default=list)
+    instructor_ids = JSONField(_('Преподаватели'), default=list)
+    popular_programs = JSONField(_('Популярные программы'), default=list,
+                                 help_text=_('[["em" или "course", id], ...]'))
+    is_stale = models.BooleanField(_('Требует пересчета'), default=True, db_index=True)
+    updated_at = models.DateTimeField(_('Обновлено'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Статистика организации')
+        verbose_name_plural = _('Статистика организаций')
+
+    def __str__(self):
+        return str(self.creator)
+
+    @classmethod
+    def get_for_creator(cls, creator):
+        """
+        Последние рассчитанные данные, даже если они помечены устаревшими. Пересчет при запросе
+        только для организации, у которой данных еще нет, и только в одном процессе одновременно
+        """
+        stats = cls.objects.filter(creator=creator).first()
+        if stats is not None:
+            return stats
+        lock = CREATOR_STATS_LOCK_CACHE_KEY % creator.id
+        if cache.add(lock, 1, timeout=60):
+            try:
+                return cls.refresh(creator)
+            finally:
+                cache.delete(lock)
+        # данные уже считает другой процесс, на этот запрос считаем без сохранения
+        return cls.refresh(creator, save=False)
+
+    @classmethod
+    def get_outdated(cls):
+        """
+        организации, данные которых нужно пересчитать: без данных, помеченные устаревшими
+        и не пересчитывавшиеся дольше EDMODULE_CREATOR_STATS_MAX_AGE секунд
+        """
+        max_age = getattr(settings, 'EDMODULE_CREATOR_STATS_MAX_AGE', 86400)
+        fresh = cls.objects.filter(is_stale=False, updated_at__gte=timezone.now() - timedelta(seconds=max_age))
+        return CourseCreator.objects.exclude(id__in=fresh.values('creator_id'))
+
+    @classmethod
+    def mark_stale(cls, creator_ids):
+        cls.objects.filter(creator_id__in=set(creator_ids)).update(is_stale=True)
+
+    @staticmethod
+    def _get_mark(info):
+        if info['count']:
+            return round(float(info['sum']) / info['count'], 2)
+        return 0
+
+    @classmethod
+    def refresh(cls, creator, save=True):
+        courses = list(Course.objects.filter(
+            models.Q(extended_params__authors=creator) | models.Q(extended_params__partners=creator)
+        ).order_by('id').values_list('id', flat=True).distinct())
+        courses_info = Course.objects.filter(id__in=courses).aggregate(
+            sum=models.Sum('sum_ratings'), count=models.Sum('count_ratings'))
+
+        modules = EducationalModule.objects.filter(courses__id__in=courses).distinct()
+        modules_info = EducationalModule.objects.filter(id__in=modules.values('id')).aggregate(
+            sum=models.Sum('sum_ratings'), count=models.Sum('count_ratings'))
+        module_ids = list(modules.values_list('id', flat=True))
+
+        instructors = list(Instructor.objects.filter(instructor_courses__id__in=courses).distinct().
+                           order_by('id').values_list('id', flat=True))
+        if creator.teacher_order:
+            try:
+                order = {int(i): pos for pos, i in enumerate(creator.teacher_order.split(',')) if i}
+                instructors = sorted(instructors, key=lambda x: order.get(x, 999))
+            except:
+                pass
+
+        values = {
+            'courses_rating': cls._get_mark(courses_info),
+            'modules_rating': cls._get_mark(modules_info),
+            'course_ids': courses,
+            'module_ids': module_ids,
+            'instructor_ids': instructors,
+            'popular_programs': cls.get_popular_programs(courses, module_ids),
+            'is_stale': False,
+        }
+        if not save:
+            return cls(creator=creator, **values)
+        stats, created = cls.objects.update_or_create(creator=creator, defaults=values)
+        return stats
+
+    @staticmethod
+    def get_popular_programs(course_ids, module_ids, limit=3):
+        """
+        Самые популярные программы: модули, в которые входят курсы с наибольшим числом участников,
+        затем сами курсы, не входящие в эти модули
+        :return: [['em' или 'course', id], ...]
+        """
+        popularity = CourseParticipantsCounter.objects.filter(course_id__in=course_ids, participants__gt=0).\
+            order_by('-participants', 'course_id').values_list('course_id', 'participants')
+        module_for_course = {}
+        position = {m: pos for pos, m in enumerate(module_ids)}
+        for module_id, course_id in EducationalModule.courses.through.objects.filter(
+                educationalmodule_id__in=module_ids).values_list('educationalmodule_id', 'course_id'):
+            if course_id not in module_for_course or position[module_id] < position[module_for_course[course_id]]:
+                module_for_course[course_id] = module_id
+        popular_modules, popular_courses = [], []
+        for course_id, cnt in popularity:
+            module_id = module_for_course.get(course_id)
+            if module_id is None:
+                popular_courses.append(['course', course_id])
+            elif ['em', module_id] not in popular_modules:
+                popular_modules.append(['em', module_id])
+        return (popular_modules + popular_courses)[:limit]
+
+
+
+class EnrollmentImportJob(models.Model):
+    """
+    Действия после массовой записи на модули (enrollment_import.run_import_side_effects): получение прогресса
+    из edx, письма о записи и об оплате. Создается при импорте и выполняется командой import_edmodule_enrollments --pending;
+    прерванное выполнение продолжается при следующем запуске команды
+    """
+    enrollment_ids = JSONField(_('Записи на модуль'), default=list)
+    notify = models.BooleanField(_('Отправить письма о записи'), default=True)
+    update_progress = models.BooleanField(_('Обновить прогресс из edx'), default=True)
+    progress_updated = models.BooleanField(_('Прогресс обновлен'), default=False)
+    payed_reason_ids = JSONField(_('Оплаченные причины записи без письма об оплате'), default=list)
+    created_at = models.DateTimeField(_('Создано'), auto_now_add=True)
+    finished_at = models.DateTimeField(_('Выполнено'), null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name = _('Задание после импорта записей')
+        verbose_name_plural = _('Задания после импорта записей')
+
+    def __str__(self):
+        return '%s - %s' % (self.created_at, len(self.enrollment_ids))
+
+
+class MassMailProgress(models.Model):
+    """
+    Адреса одной отправленной пачки массовой рассылки (notifications.ParallelMassSendMixin).
+    По записям с ключом рассылки прерванная рассылка продолжается без повторной отправки;
+    после отправки всем адресатам записи удаляются
+    """
+    progress_key = models.CharField(_('Рассылка'), max_length=255, db_index=True)
+    emails = JSONField(_('Адреса'), default=list)
+    created_at = models.DateTimeField(_('Создано'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Прогресс массовой рассылки')
+        verbose_name_plural = _('Прогресс массовых рассылок')
+
+    def __str__(self):
+        return '%s - %s' % (self.progress_key, len(self.emails))
+
+
+class CourseParticipantsCounter(models.Model):
+    """
+    Количество участников курса (Participant всех сессий), поддерживается сигналами
+    и сверяется командой reconcile_edmodule_counters
+    """
+    course = models.OneToOneField(Course, verbose_name=_('Курс'), related_name='edmodule_counter',
+                                  on_delete=models.CASCADE)
+    participants = models.PositiveIntegerField(_('Количество участников'), default=0)
+
+    class Meta:
+        verbose_name = _('Счетчик участников курса')
+        verbose_name_plural = _('Счетчики участников курсов')
+
+    def __str__(self):
+        return '%s - %s' % (self.course, self.participants)
+
+    @classmethod
+    def add(cls, course_id, delta):
+        """
+        атомарное изменение счетчика; если строки счетчика нет или он уже нулевой, счетчик пересчитывается
+        """
+        qs = cls.objects.filter(course_id=course_id)
+        if delta < 0:
+            qs = qs.filter(participants__gte=-delta)
+        if not qs.update(participants=models.F('participants') + delta):
+            cls.recount([course_id])
+
+    @classmethod
+    def recount(cls, course_ids=None):
+        """
+        Пересчет счетчиков курсов course_ids (всех, если None) одним сгруппированным запросом
+        :return: количество исправленных счетчиков
+        """
+        participants = Participant.objects.all()
+        courses = Course.objects.all()
+        if course_ids is not None:
+            participants = participants.filter(session__course_id__in=course_ids)
+            courses = courses.filter(id__in=course_ids)
+        counts = dict(participants.values_list('session__course_id').annotate(cnt=models.Count('id')))
+        current = dict(cls.objects.filter(course_id__in=courses.values('id')).values_list('course_id', 'participants'))
+        changed = 0
+        new = []
+        for course_id in courses.values_list('id', flat=True):
+            count = counts.get(course_id, 0)
+            if course_id not in current:
+                new.append(cls(course_id=course_id, participants=count))
+            elif current[course_id] != count:
+                cls.objects.filter(course_id=course_id).update(participants=count)
+                changed += 1
+        for obj in new:
+            # строка могла появиться параллельно, тогда просто выставляем значение
+            cls.objects.update_or_create(course_id=obj.course_id, defaults={'participants': obj.participants})
+        return changed + len(new)
+
+
+class EducationalModuleCounter(models.Model):
+    """
+    Количество активных и оплаченных записей на модуль. Хранится отдельно от модуля, чтобы сохранение
+    модуля целиком (админка, рейтинг) не перезаписывало устаревшими значениями приращения из сигналов.
+    Поддерживается сигналами и сверяется командой reconcile_edmodule_counters
+    """
+    module = models.OneToOneField(EducationalModule, verbose_name=_('Образовательный модуль'),
+                                  related_name='edmodule_counter', on_delete=models.CASCADE)
+    enrollments = models.PositiveIntegerField(_('Количество активных записей'), default=0)
+    paid_enrollments = models.PositiveIntegerField(_('Количество оплаченных записей'), default=0)
+
+    class Meta:
+        verbose_name = _('Счетчик записей на модуль')
+        verbose_name_plural = _('Счетчики записей на модули')
+
+    def __str__(self):
+        return '%s - %s / %s' % (self.module, self.enrollments, self.paid_enrollments)
+
+    @classmethod
+    def add(cls, module_id, enrollments=0, paid_enrollments=0):
+        """
+        Атомарное изменение счетчиков модуля на переданные приращения, через update, без сигналов.
+        Если строки счетчика нет или счетчик ушел бы в минус (значит, он уже разошелся с данными),
+        счетчики модуля пересчитываются
+        """
+        qs = cls.objects.filter(module_id=module_id)
+        values = {}
+        for field, delta in (('enrollments', enrollments), ('paid_enrollments', paid_enrollments)):
+            if delta:
+                if delta < 0:
+                    qs = qs.filter(**{'%s__gte' % field: -delta})
+                values[field] = models.F(field) + delta
+        if values and not qs.update(**values):
+            cls.recount([module_id])
+
+    @classmethod
+    def recount(cls, module_ids=None):
+        """
+        Пересчет счетчиков модулей module_ids (всех, если None) сгруппированными запросами.
+        Для сверки (reconcile_edmodule_counters) и массовых операций, при обычных сохранениях
+        счетчики меняет add
+        :return: количество исправленных счетчиков
+        """
+        enrollments = EducationalModuleEnrollment.objects.all()
+        modules = EducationalModule.objects.all()
+        if module_ids is not None:
+            enrollments = enrollments.filter(module_id__in=module_ids)
+            modules = modules.filter(id__in=module_ids)
+        active = dict(enrollments.filter(is_active=True).values_list('module_id').annotate(
+            cnt=models.Count('id')))
+        paid = dict(enrollments.filter(enrollment_reason__full_paid=True).values_list('module_id').annotate(
+            cnt=models.Count('id', distinct=True)))
+        current = {i[0]: i[1:] for i in cls.objects.filter(module_id__in=modules.values('id')).values_list(
+            'module_id', 'enrollments', 'paid_enrollments')}
+        changed = 0
+        for module_id in modules.values_list('id', flat=True):
+            values = {'enrollments': active.get(module_id, 0), 'paid_enrollments': paid.get(module_id, 0)}
+            if module_id not in current:
+                # строка могла появиться параллельно, тогда просто выставляем значения
+                cls.objects.update_or_create(module_id=module_id, defaults=values)
+                changed += 1
+            elif current[module_id] != (values['enrollments'], values['paid_enrollments']):
+                cls.objects.filter(module_id=module_id).update(**values)
+                changed += 1
+        return changed
+
+
 def _string_splitter(obj, attr):
     try:
         s = getattr(obj, attr)
@@ -674,14 +1103,44 @@ edmodule_course_additional_fields = SimpleLazyObject(
     lambda: [f.name for f in CourseExtendedParameters._meta.fields if not f.auto_created and f.editable])
 
 
+class ExtendedParamsAttribute(object):
+    """
+    Дескриптор, отдающий значение поля связанного CourseExtendedParameters.
+    Запись идет в __dict__ объекта, чтобы не мешать инициализации одноименных полей Course
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(instance.extended_params, self.name)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
 class EdmoduleCourse(Course):
     class Meta:
         proxy = True
 
-    def __getattribute__(self, item):
-        if item in edmodule_course_additional_fields:
-            return getattr(self.extended_params, item)
-        return super().__getattribute__(item)
+    @classmethod
+    def install_extended_params_attributes(cls):
+        """
+        Добавление атрибутов CourseExtendedParameters в класс, вызывается один раз при загрузке приложения
+        """
+        for name in edmodule_course_additional_fields:
+            setattr(cls, name, ExtendedParamsAttribute(name))
+
+    @classmethod
+    def from_course(cls, course):
+        """
+        EdmoduleCourse из уже загруженного объекта Course без дополнительного запроса к базе
+        """
+        obj = cls.__new__(cls)
+        obj.__dict__.update(course.__dict__)
+        obj._state = copy.copy(course._state)
+        return obj
 
     def get_next_session(self):
         from plp_edmodule.utils import choose_closest_session
@@ -724,3 +1183,38 @@ class EdmoduleCourse(Course):
 edmodule_enrolled.connect(edmodule_enrolled_handler, sender=EducationalModuleEnrollment)
 edmodule_unenrolled.connect(edmodule_unenrolled_handler, sender=EducationalModuleEnrollment)
 edmodule_payed.connect(edmodule_payed_handler, sender=EducationalModuleEnrollmentReason)
+post_save.connect(course_promotion_changed_handler, sender=CoursePromotion)
+post_delete.connect(course_promotion_changed_handler, sender=CoursePromotion)
+for sender in (EducationalModule, Course, EdmoduleCourse, CourseSession, CourseExtendedParameters,
+               SessionEnrollmentType):
+    post_save.connect(catalog_changed_handler, sender=sender)
+    post_delete.connect(catalog_changed_handler, sender=sender)
+m2m_changed.connect(catalog_changed_handler, sender=EducationalModule.courses.through)
+post_save.connect(module_may_enroll_handler, sender=EducationalModule)
+m2m_changed.connect(module_may_enroll_handler, sender=EducationalModule.courses.through)
+for sender in (CourseSession, CourseExtendedParameters):
+    post_save.connect(course_may_enroll_handler, sender=sender)
+    post_delete.connect(course_may_enroll_handler, sender=sender)
+m2m_changed.connect(catalog_changed_handler, sender=CourseExtendedParameters.categories.through)
+for sender in (Course, EdmoduleCourse, CourseSession, CourseExtendedParameters, SessionEnrollmentType):
+    post_save.connect(facet_index_course_handler, sender=sender)
+    post_delete.connect(facet_index_course_handler, sender=sender)
+m2m_changed.connect(facet_index_course_handler, sender=CourseExtendedParameters.categories.through)
+post_save.connect(facet_index_module_handler, sender=EducationalModule)
+post_delete.connect(facet_index_module_handler, sender=EducationalModule)
+m2m_changed.connect(facet_index_module_handler, sender=EducationalModule.courses.through)
+for sender in (EducationalModule, Course, EdmoduleCourse, CourseExtendedParameters):
+    post_save.connect(search_index_handler, sender=sender)
+    post_delete.connect(search_index_handler, sender=sender)
+for sender in (Participant, Course, EdmoduleCourse, EducationalModule, CourseCreator):
+    post_save.connect(creator_stats_handler, sender=sender)
+post_delete.connect(creator_stats_handler, sender=Participant)
+for sender in (CourseExtendedParameters.authors.through, CourseExtendedParameters.partners.through,
+               EducationalModule.courses.through):
+    m2m_changed.connect(creator_stats_handler, sender=sender)
+post_save.connect(participants_counter_handler, sender=Participant)
+post_delete.connect(participants_counter_handler, sender=Participant)
+for sender in (EducationalModuleEnrollment, EducationalModuleEnrollmentReason):
+    pre_save.connect(module_enrollments_counter_handler, sender=sender)
+    post_save.connect(module_enrollments_counter_handler, sender=sender)
+    post_delete.connect(module_enrollments_counter_handler, sender=sender)
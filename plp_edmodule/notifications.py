@@ -1,11 +1,153 @@
 # coding: utf-8
 
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection as db_connection
+from django.template.loader import get_template
+from django.utils.html import strip_tags
 from plp.notifications.base import MassSendEmails
-from plp.utils.helpers import get_prefix_and_site
-from .models import EducationalModule, EducationalModuleEnrollment
+from plp.utils.helpers import get_prefix_and_site, get_domain_url
+from .models import EducationalModule, EducationalModuleEnrollment, MassMailProgress
 
 
-class EdmoduleCourseStartsEmails(MassSendEmails):
+class RateLimiter(object):
+    """
+    Ограничение количества отправляемых сообщений в секунду, общее для всех потоков
+    """
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ParallelMassSendMixin(object):
+    """
+    Параллельная рассылка для наследников MassSendEmails: письма рендерятся пачками в пуле потоков,
+    каждый поток держит открытым свое smtp соединение, общая скорость отправки ограничена
+    mail_rate_limit сообщений в секунду. Адреса, на которые письмо уже ушло, после каждой пачки сохраняются
+    в базе отдельной записью MassMailProgress, поэтому прерванная рассылка при повторном запуске
+    продолжается с места остановки. send наследников тоже отправляет письма параллельно.
+
+    Для отладки на локальном smtp-сервере достаточно указать
+    EDMODULE_MASS_MAIL_CONNECTION = {'host': 'localhost', 'port': 1025}
+    """
+    mail_workers = getattr(settings, 'EDMODULE_MASS_MAIL_WORKERS', 4)
+    mail_batch_size = getattr(settings, 'EDMODULE_MASS_MAIL_BATCH_SIZE', 50)
+    mail_rate_limit = getattr(settings, 'EDMODULE_MASS_MAIL_RATE_LIMIT', 10)
+
+    def get_progress_key(self):
+        return 'EdmoduleMassMailProgress:%s' % self.__class__.__name__
+
+    def get_connection_kwargs(self):
+        kwargs = dict(getattr(settings, 'EDMODULE_MASS_MAIL_CONNECTION', {}))
+        if kwargs:
+            kwargs.setdefault('backend', 'django.core.mail.backends.smtp.EmailBackend')
+        return kwargs
+
+    def get_mail_from(self):
+        return settings.EMAIL_NOTIFICATIONS_FROM
+
+    def render_message(self, email, mail_connection):
+        context = self.get_context(email)
+        subject = ' '.join(get_template(self.template_subject).render(context).split())
+        html = get_template(self.template_html).render(context)
+        msg = EmailMultiAlternatives(subject, strip_tags(html), self.get_mail_from(), [email],
+                                     connection=mail_connection)
+        msg.attach_alternative(html, 'text/html')
+        return msg
+
+    def _get_sent(self, progress_key):
+        """
+        адреса, на которые письмо уже ушло: каждая запись MassMailProgress - адреса одной отправленной пачки
+        """
+        sent = set()
+        for emails in MassMailProgress.objects.filter(progress_key=progress_key).values_list('emails', flat=True):
+            sent.update(emails)
+        return sent
+
+    def _clear_sent(self, progress_key):
+        MassMailProgress.objects.filter(progress_key=progress_key).delete()
+
+    def send(self):
+        return self.send_parallel()
+
+    def send_parallel(self):
+        """
+        Параллельная отправка писем всем адресатам get_emails. Количество адресатов, которым отправить
+        письмо не удалось, сохраняется в failed_count
+        :return: количество отправленных в этом запуске писем
+        """
+        progress_key = self.get_progress_key()
+        sent = self._get_sent(progress_key)
+        emails = [i for i in self.get_emails() if i and i not in sent]
+        batches = [emails[i:i + self.mail_batch_size] for i in range(0, len(emails), self.mail_batch_size)]
+        limiter = RateLimiter(self.mail_rate_limit)
+        local = threading.local()
+        connections = []
+        connections_lock = threading.Lock()
+
+        def _get_mail_connection():
+            if getattr(local, 'connection', None) is None:
+                local.connection = get_connection(**self.get_connection_kwargs())
+                local.connection.open()
+                with connections_lock:
+                    connections.append(local.connection)
+            return local.connection
+
+        def _send_batch(batch):
+            delivered = []
+            try:
+                mail_connection = _get_mail_connection()
+                for email in batch:
+                    try:
+                        msg = self.render_message(email, mail_connection)
+                        limiter.wait()
+                        if msg.send():
+                            delivered.append(email)
+                    except Exception as e:
+                        logging.error('Mass mail %s: failed to send to %s: %s' % (progress_key, email, e))
+            finally:
+                db_connection.close()
+            return delivered
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.mail_workers) as executor:
+            futures = [executor.submit(_send_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                delivered = future.result()
+                if not delivered:
+                    continue
+                count += len(delivered)
+                MassMailProgress.objects.create(progress_key=progress_key, emails=delivered)
+        for mail_connection in connections:
+            try:
+                mail_connection.close()
+            except Exception:
+                pass
+        self.failed_count = len(emails) - count
+        if count == len(emails):
+            # все адресаты получили письмо, прогресс больше не нужен
+            self._clear_sent(progress_key)
+        logging.info('Mass mail %s: %s messages sent' % (progress_key, count))
+        return count
+
+
+class EdmoduleCourseStartsEmails(ParallelMassSendMixin, MassSendEmails):
     """
     Класс для массовой рассылки сообщений о начале курса, на который пользователь не записан,
     из образовательного модуля, на который он записан.
@@ -18,10 +160,13 @@ class EdmoduleCourseStartsEmails(MassSendEmails):
         super(EdmoduleCourseStartsEmails, self).__init__()
         self.email_to_username = {}
 
+    def get_progress_key(self):
+        return '%s:%s' % (super(EdmoduleCourseStartsEmails, self).get_progress_key(), self.session.id)
+
     def get_emails(self):
         enrollments = EducationalModuleEnrollment.objects.filter(
             module__in=EducationalModule.objects.filter(courses=self.session.course)
-        )
+        ).select_related('user', 'module')
         self.enrollment_by_email = dict([
             (i.user.email, i) for i in enrollments
         ])
@@ -45,3 +190,32 @@ class EdmoduleCourseEnrollEndsEmails(EdmoduleCourseStartsEmails):
     """
     template_html = 'emails/edmodule_course_enroll_ends_html.html'
     template_subject = 'emails/edmodule_course_enroll_ends_subject.txt'
+
+
+class EdmoduleEnrolledEmails(ParallelMassSendMixin, MassSendEmails):
+    """
+    Письма об успешной записи на модуль (как в edmodule_enrolled_handler) одной рассылкой
+    для записей на модуль, созданных массовым импортом
+    """
+    template_html = 'emails/edmodule_enrolled_html.html'
+    template_subject = 'emails/edmodule_enrolled_subject.txt'
+
+    def __init__(self, module, enrollment_ids):
+        self.module = module
+        self.enrollment_ids = sorted(enrollment_ids)
+        super(EdmoduleEnrolledEmails, self).__init__()
+
+    def get_progress_key(self):
+        digest = hashlib.md5(','.join(map(str, self.enrollment_ids)).encode('utf-8')).hexdigest()
+        return '%s:%s:%s' % (super(EdmoduleEnrolledEmails, self).get_progress_key(), self.module.id, digest)
+
+    def get_emails(self):
+        enrollments = EducationalModuleEnrollment.objects.filter(
+            id__in=self.enrollment_ids, module=self.module).select_related('user')
+        self.user_by_email = dict([(i.user.email, i.user) for i in enrollments])
+        return list(self.user_by_email.keys())
+
+    def get_context(self, email=None):
+        context = {'module': self.module, 'user': self.user_by_email[email], 'site_url': get_domain_url()}
+        context.update(get_prefix_and_site())
+        return context
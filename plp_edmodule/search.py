@@ -0,0 +1,170 @@
+# coding: utf-8
+
+import os
+import re
+import sqlite3
+import threading
+from itertools import chain
+from django.conf import settings
+from django.urls import reverse
+from django.utils.html import strip_tags
+from plp_extension.apps.course_extension.models import CourseExtendedParameters
+from .models import EducationalModule, EdmoduleCourse, PUBLISHED
+
+SEARCH_INDEX_PATH = getattr(settings, 'EDMODULE_SEARCH_INDEX_PATH', None) or \
+    os.path.join(getattr(settings, 'BASE_DIR', ''), 'edmodule_search.sqlite3')
+
+MODULE = 'em'
+COURSE = 'course'
+
+_local = threading.local()
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchIndex(object):
+    """
+    Локальный полнотекстовый индекс модулей и курсов на sqlite fts5.
+    rowid строки однозначно определяется типом и id объекта, поэтому обновление
+    и удаление отдельного объекта не требуют просмотра таблицы
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=10)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA cache_size=-65536')
+        self.connection.execute('PRAGMA mmap_size=268435456')
+        self.connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS items USING fts5("
+            "kind UNINDEXED, object_id UNINDEXED, url UNINDEXED, title, subtitle, body, "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        # заголовок важнее подзаголовка, подзаголовок важнее описания
+        self.connection.execute("INSERT INTO items(items, rank) VALUES('rank', 'bm25(0, 0, 0, 10.0, 5.0, 1.0)')")
+        self.connection.commit()
+
+    @staticmethod
+    def get_rowid(kind, object_id):
+        return object_id * 2 + (1 if kind == MODULE else 0)
+
+    def update(self, items):
+        """
+        :param items: [(kind, object_id, url, title, subtitle, body), ...]
+        """
+        with self.connection:
+            self.connection.executemany('DELETE FROM items WHERE rowid = ?',
+                                        [(self.get_rowid(i[0], i[1]), ) for i in items])
+            self.connection.executemany(
+                'INSERT INTO items(rowid, kind, object_id, url, title, subtitle, body) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(self.get_rowid(i[0], i[1]), ) + tuple(i) for i in items]
+            )
+
+    def remove(self, kind, object_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM items WHERE rowid = ?', (self.get_rowid(kind, object_id), ))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM items')
+
+    def optimize(self):
+        with self.connection:
+            self.connection.execute("INSERT INTO items(items) VALUES('optimize')")
+
+    @staticmethod
+    def make_query(text):
+        """
+        Запрос fts5 из пользовательской строки: все слова обязательны,
+        последнее слово ищется по префиксу
+        """
+        words = _word_re.findall(text.lower())
+        if not words:
+            return None
+        terms = ['"%s"' % w for w in words]
+        if len(words[-1]) >= 2:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, text, limit=20):
+        """
+        Сначала ищем по заголовкам и подзаголовкам, их совпадений мало и они важнее,
+        затем, если результатов не хватает, по всем полям
+        """
+        query = self.make_query(text)
+        if not query:
+            return []
+        sql = 'SELECT rowid, kind, object_id, url, title FROM items WHERE items MATCH ? ORDER BY rank LIMIT ?'
+        rows = self.connection.execute(sql, ('{title subtitle} : (%s)' % query, limit)).fetchall()
+        if len(rows) < limit:
+            found = {i[0] for i in rows}
+            rows.extend(i for i in self.connection.execute(sql, (query, limit)) if i[0] not in found)
+        return [{'type': kind, 'id': object_id, 'url': url, 'title': title}
+                for rowid, kind, object_id, url, title in rows[:limit]]
+
+
+def get_search_index():
+    """
+    Индекс с соединением, отдельным для каждого потока
+    """
+    index = getattr(_local, 'index', None)
+    if index is None:
+        index = SearchIndex(SEARCH_INDEX_PATH)
+        _local.index = index
+    return index
+
+
+def _clean(value):
+    return strip_tags(value or '').strip()
+
+
+def module_to_item(module):
+    return (MODULE, module.id, reverse('edmodule-page', kwargs={'code': module.code}),
+            module.title, _clean(module.subtitle), _clean(module.about))
+
+
+def course_to_item(course):
+    try:
+        short_description = course.extended_params.short_description
+    except CourseExtendedParameters.DoesNotExist:
+        short_description = ''
+    return (COURSE, course.id, reverse('course_details', kwargs={'uni_slug': course.university.slug,
+                                                                'slug': course.slug}),
+            course.title, _clean(short_description), _clean(course.description))
+
+
+def index_module(module):
+    if module.status == PUBLISHED:
+        get_search_index().update([module_to_item(module)])
+    else:
+        get_search_index().remove(MODULE, module.id)
+
+
+def index_course(course):
+    if course.status == PUBLISHED:
+        get_search_index().update([course_to_item(course)])
+    else:
+        get_search_index().remove(COURSE, course.id)
+
+
+def rebuild_search_index(chunk_size=1000):
+    """
+    Полное перестроение индекса по опубликованным модулям и курсам
+    :return: количество проиндексированных объектов
+    """
+    index = get_search_index()
+    index.clear()
+    count = 0
+    batch = []
+    modules = EducationalModule.objects.filter(status=PUBLISHED).iterator()
+    courses = EdmoduleCourse.objects.filter(status=PUBLISHED).select_related('university', 'extended_params').\
+        iterator()
+    for item in chain(map(module_to_item, modules), map(course_to_item, courses)):
+        batch.append(item)
+        if len(batch) >= chunk_size:
+            index.update(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        index.update(batch)
+        count += len(batch)
+    index.optimize()
+    return count
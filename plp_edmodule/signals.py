@@ -1,6 +1,8 @@
 # coding: utf-8
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import Signal
 from django.template.loader import get_template
 from emails.django import Message
@@ -10,6 +12,34 @@ edmodule_enrolled = Signal(providing_args=['instance'])
 edmodule_unenrolled = Signal(providing_args=['instance'])
 edmodule_payed = Signal(providing_args=['instance'])
 
+PROMOTED_COURSES_CACHE_KEY = 'EdmodulePromotedCourses'
+FRONTPAGE_POOL_CACHE_KEY = 'EdmoduleFrontpagePool'
+FRONTPAGE_POOL_LOCK_CACHE_KEY = 'EdmoduleFrontpagePoolLock'
+PUBLISHED_IDS_CACHE_KEY = 'EdmodulePublishedIds:%s'
+RELATED_IDS_CACHE_KEY = 'EdmoduleRelatedIds:%s:%s'
+MAY_ENROLL_CACHE_KEY = 'EdmoduleMayEnroll:%s'
+CATEGORY_COURSES_CACHE_KEY = 'EdmoduleCategoryCourses'
+FACET_INDEX_CACHE_KEY = 'EdmoduleFacetIndex'
+FACET_INDEX_LOCK_CACHE_KEY = 'EdmoduleFacetIndexLock'
+CATALOG_COVERS_CACHE_KEY = 'EdmoduleCatalogCovers:%s'
+CATALOG_VERSION_CACHE_KEY = 'EdmoduleCatalogVersion'
+CATALOG_SLICE_CACHE_KEY = 'EdmoduleCatalogSlice:%s:%s:%s:%s:%s'
+CATALOG_PAYLOAD_CACHE_KEY = 'EdmoduleCatalogPayload:%s'
+CATALOG_META_CACHE_KEY = 'EdmoduleCatalogMeta:%s'
+MODULE_PRICE_CACHE_KEY = 'EdmoduleModulePrice:%s:%s'
+RATE_LIMIT_CACHE_KEY = 'EdmoduleRateLimit:%s:%s:%s'
+CREATOR_STATS_LOCK_CACHE_KEY = 'EdmoduleCreatorStatsLock:%s'
+
+# ключи кэша, которые зависят от состава и статусов курсов, модулей и сессий
+CATALOG_CACHE_KEYS = [
+    PROMOTED_COURSES_CACHE_KEY,
+    PUBLISHED_IDS_CACHE_KEY % 'edmodulecourse',
+    PUBLISHED_IDS_CACHE_KEY % 'educationalmodule',
+    CATEGORY_COURSES_CACHE_KEY,
+    CATALOG_COVERS_CACHE_KEY % 'course',
+    CATALOG_COVERS_CACHE_KEY % 'educationalmodule',
+]
+
 
 def edmodule_enrolled_handler(**kwargs):
     """
@@ -73,3 +103,225 @@ def edmodule_payed_handler(**kwargs):
         }
         context.update(get_prefix_and_site())
         msg.send(context={'context': context})
+
+
+def course_promotion_changed_handler(**kwargs):
+    """
+    сброс кэша продвигаемых на главной курсов и модулей при изменении CoursePromotion
+    """
+    cache.delete(PROMOTED_COURSES_CACHE_KEY)
+
+
+def catalog_changed_handler(**kwargs):
+    """
+    сброс кэшей каталога при изменении курсов, сессий, модулей и их состава.
+    Пул кандидатов главной здесь не перестраивается: смена версии каталога помечает его устаревшим,
+    и его перестраивает первый запрос (get_frontpage_pool) или update_edmodule_frontpage
+    """
+    from .catalog import bump_catalog_version
+    cache.delete_many(CATALOG_CACHE_KEYS)
+    bump_catalog_version()
+
+
+def module_may_enroll_handler(instance=None, reverse=False, pk_set=None, **kwargs):
+    """
+    сброс закэшированного EducationalModule.may_enroll при изменении модуля или его состава
+    """
+    if reverse:
+        ids = pk_set or []
+    else:
+        ids = [instance.id]
+    cache.delete_many([MAY_ENROLL_CACHE_KEY % i for i in ids])
+
+
+def course_may_enroll_handler(instance=None, **kwargs):
+    """
+    сброс закэшированного EducationalModule.may_enroll модулей, содержащих курс сессии
+    или курс CourseExtendedParameters
+    """
+    from .models import EducationalModule
+    course_id = getattr(instance, 'course_id', None)
+    if course_id:
+        ids = EducationalModule.objects.filter(courses__id=course_id).values_list('id', flat=True)
+        cache.delete_many([MAY_ENROLL_CACHE_KEY % i for i in ids])
+
+
+def facet_index_course_handler(instance=None, reverse=False, pk_set=None, **kwargs):
+    """
+    обновление индекса фильтров каталога при изменении курса, его параметров, сессий и их цен;
+    индекс обновляется после фиксации транзакции, чтобы в него не попадали откаченные изменения
+    """
+    from django.db import transaction
+    from plp.models import Course, CourseSession
+    from plp_extension.apps.course_extension.models import CourseExtendedParameters
+    from .facets import update_facet_index
+    action = kwargs.get('action')
+    if action and not action.startswith('post_'):
+        return
+    if reverse:
+        course_ids = CourseExtendedParameters.objects.filter(id__in=pk_set or []).values_list('course_id', flat=True)
+    elif isinstance(instance, Course):
+        # у Course есть метод course_id, поэтому проверка по типу должна идти раньше проверки атрибута
+        course_ids = [instance.id]
+    elif hasattr(instance, 'session_id'):
+        course_ids = CourseSession.objects.filter(id=instance.session_id).values_list('course_id', flat=True)
+    elif hasattr(instance, 'course_id'):
+        course_ids = [instance.course_id]
+    else:
+        course_ids = [instance.id]
+    course_ids = list(course_ids)
+
+    def _update():
+        for course_id in course_ids:
+            update_facet_index(course_id=course_id)
+
+    transaction.on_commit(_update)
+
+
+def facet_index_module_handler(instance=None, reverse=False, pk_set=None, **kwargs):
+    """
+    обновление индекса фильтров каталога при изменении модуля или его состава после фиксации транзакции
+    """
+    from django.db import transaction
+    from .facets import update_facet_index
+    from .models import EducationalModule
+    action = kwargs.get('action')
+    if action and not action.startswith('post_'):
+        return
+    if reverse:
+        module_ids = list(pk_set or [])
+
+        def _update():
+            for module in EducationalModule.objects.filter(id__in=module_ids):
+                update_facet_index(module=module)
+
+        transaction.on_commit(_update)
+        return
+    if kwargs.get('signal') is post_delete:
+        instance.status = None
+    transaction.on_commit(lambda: update_facet_index(module=instance))
+
+
+def search_index_handler(sender=None, instance=None, **kwargs):
+    """
+    обновление поискового индекса при изменении или удалении модуля, курса или его параметров.
+    Индекс обновляется после фиксации транзакции, чтобы в него не попадали откаченные изменения
+    """
+    from django.db import transaction
+    from plp.models import Course
+    from .models import EducationalModule
+    from . import search
+    deleted = kwargs.get('signal') is post_delete
+    # id запоминаются сразу: после удаления django обнуляет pk объекта
+    if isinstance(instance, EducationalModule):
+        kind, object_id = search.MODULE, instance.id
+    elif isinstance(instance, Course):
+        kind, object_id = search.COURSE, instance.id
+    else:
+        kind, object_id, deleted = search.COURSE, instance.course_id, False
+    transaction.on_commit(lambda: _update_search_index(kind, object_id, deleted))
+
+
+def _update_search_index(kind, object_id, deleted):
+    from .models import EducationalModule, EdmoduleCourse
+    from . import search
+    if deleted:
+        search.get_search_index().remove(kind, object_id)
+        return
+    if kind == search.MODULE:
+        obj = EducationalModule.objects.filter(id=object_id).first()
+        if obj:
+            search.index_module(obj)
+    else:
+        obj = EdmoduleCourse.objects.filter(id=object_id).select_related('university', 'extended_params').first()
+        if obj:
+            search.index_course(obj)
+
+
+def creator_stats_handler(sender=None, instance=None, reverse=False, pk_set=None, **kwargs):
+    """
+    пометка устаревшей статистики организаций (CourseCreatorStats) при появлении участников курсов,
+    изменении рейтингов, авторов и партнеров курсов и состава модулей
+    """
+    from plp.models import Course, CourseSession, Participant
+    from plp_extension.apps.course_extension.models import CourseCreator, CourseExtendedParameters
+    from .models import CourseCreatorStats, EducationalModule
+    action = kwargs.get('action')
+    if action and action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    creator_ids, course_ids = set(), set()
+    if isinstance(instance, CourseCreator):
+        creator_ids.add(instance.id)
+    elif isinstance(instance, CourseExtendedParameters):
+        creator_ids.update(pk_set or [])
+        course_ids.add(instance.course_id)
+    elif isinstance(instance, Participant):
+        if kwargs.get('signal') is post_save and not kwargs.get('created'):
+            return
+        course_ids.update(CourseSession.objects.filter(id=instance.session_id).values_list('course_id', flat=True))
+    elif isinstance(instance, EducationalModule):
+        course_ids.update(instance.courses.values_list('id', flat=True))
+        if action:
+            course_ids.update(pk_set or [])
+    elif isinstance(instance, Course):
+        course_ids.add(instance.id)
+        if action:
+            course_ids.update(EducationalModule.courses.through.objects.filter(
+                educationalmodule_id__in=pk_set or []).values_list('course_id', flat=True))
+    if course_ids:
+        for attr in ('authors', 'partners'):
+            creator_ids.update(CourseExtendedParameters.objects.filter(course_id__in=course_ids).
+                               exclude(**{attr: None}).values_list(attr, flat=True))
+    if creator_ids:
+        CourseCreatorStats.mark_stale(creator_ids)
+
+
+def participants_counter_handler(instance=None, created=False, **kwargs):
+    """
+    изменение счетчика участников курса при записи на сессию и удалении записи
+    """
+    from plp.models import CourseSession
+    from .models import CourseParticipantsCounter
+    deleted = kwargs.get('signal') is post_delete
+    if not created and not deleted:
+        return
+    for course_id in CourseSession.objects.filter(id=instance.session_id).values_list('course_id', flat=True):
+        CourseParticipantsCounter.add(course_id, -1 if deleted else 1)
+
+
+def module_enrollments_counter_handler(sender=None, instance=None, created=False, **kwargs):
+    """
+    изменение счетчиков записей модуля атомарными приращениями при активации и деактивации записи на модуль,
+    появлении и снятии полной оплаты; прежнее состояние записи или причины записи читается в pre_save
+    """
+    from .models import EducationalModuleCounter, EducationalModuleEnrollment, EducationalModuleEnrollmentReason
+    signal = kwargs.get('signal')
+    is_enrollment = isinstance(instance, EducationalModuleEnrollment)
+    if signal is pre_save:
+        fields = ('module_id', 'is_active') if is_enrollment else ('enrollment_id', 'full_paid')
+        instance._edmodule_counter_old = sender.objects.filter(pk=instance.pk).values_list(*fields).first() \
+            if instance.pk else None
+        return
+    deleted = signal is post_delete
+    old = None if created or deleted else getattr(instance, '_edmodule_counter_old', None)
+    if is_enrollment:
+        if deleted:
+            if instance.is_active:
+                EducationalModuleCounter.add(instance.module_id, enrollments=-1)
+        elif old and old[0] != instance.module_id:
+            EducationalModuleCounter.recount([old[0], instance.module_id])
+        elif instance.is_active != bool(old and old[1]):
+            EducationalModuleCounter.add(instance.module_id, enrollments=1 if instance.is_active else -1)
+        return
+    was_paid = instance.full_paid if deleted else bool(old and old[1])
+    is_paid = instance.full_paid and not deleted
+    if was_paid == is_paid:
+        return
+    # запись считается оплаченной, пока у нее есть хотя бы одна причина с полной оплатой
+    if EducationalModuleEnrollmentReason.objects.filter(enrollment_id=instance.enrollment_id, full_paid=True).\
+            exclude(pk=instance.pk).exists():
+        return
+    module_id = EducationalModuleEnrollment.objects.filter(id=instance.enrollment_id).\
+        values_list('module_id', flat=True).first()
+    if module_id:
+        EducationalModuleCounter.add(module_id, paid_enrollments=1 if is_paid else -1)
@@ -0,0 +1,106 @@
+# coding: utf-8
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from .catalog import write_catalog_script, CATALOG_STREAM_CHUNK_SIZE
+
+CATALOG_SNAPSHOT_DIR = getattr(settings, 'EDMODULE_CATALOG_SNAPSHOT_DIR', None) or \
+    os.path.join(getattr(settings, 'BASE_DIR', ''), 'edmodule_catalog_snapshot')
+# снимок старше этого времени (в секундах) не используется
+CATALOG_SNAPSHOT_MAX_AGE = getattr(settings, 'EDMODULE_CATALOG_SNAPSHOT_MAX_AGE', 3600)
+
+LATEST = 'latest'
+PREFIX = 'catalog-'
+
+_lock = threading.Lock()
+# путь к каталогу снимков -> (st_mtime_ns указателя, снимок)
+_loaded = {}
+
+
+@contextmanager
+def _atomic_file(path):
+    """
+    Файл для записи, который появляется по пути path только после успешного завершения записи
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _atomic_write(path, content):
+    with _atomic_file(path) as f:
+        f.write(content)
+
+
+def write_catalog_snapshot(directory=CATALOG_SNAPSHOT_DIR, keep=3, chunk_size=CATALOG_STREAM_CHUNK_SIZE):
+    """
+    Сохраняет данные каталога в файлы новой версии снимка и атомарно переключает на нее указатель latest.
+    Оставляет keep последних версий. Данные пишутся в файлы по мере построения, порциями по chunk_size объектов
+    :return: имя версии
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = '%s%s' % (PREFIX, int(time.time()))
+    with _atomic_file(os.path.join(directory, name + '.js')) as raw_file, \
+            _atomic_file(os.path.join(directory, name + '.js.gz')) as gzip_file:
+        meta = write_catalog_script(raw_file, gzip_file, chunk_size=chunk_size)
+    _atomic_write(os.path.join(directory, name + '.json'), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+    _atomic_write(os.path.join(directory, LATEST), name.encode('utf-8'))
+    versions = sorted({i.split('.')[0] for i in os.listdir(directory) if i.startswith(PREFIX)})
+    for old in versions[:-keep]:
+        for suffix in ('.js', '.js.gz', '.json'):
+            try:
+                os.unlink(os.path.join(directory, old + suffix))
+            except OSError:
+                pass
+    return name
+
+
+def _load(directory):
+    with open(os.path.join(directory, LATEST), 'rb') as f:
+        name = f.read().decode('utf-8').strip()
+    with open(os.path.join(directory, name + '.json'), 'rb') as f:
+        meta = json.loads(f.read().decode('utf-8'))
+    return {
+        'raw_path': os.path.join(directory, name + '.js'),
+        'gzip_path': os.path.join(directory, name + '.js.gz'),
+        'etag': meta['etag'],
+        'categories': meta['categories'],
+    }
+
+
+def get_catalog_snapshot(directory=CATALOG_SNAPSHOT_DIR):
+    """
+    Последний снимок каталога: {'raw_path': str, 'gzip_path': str, 'etag': str, 'categories': [...]},
+    тело скрипта отдается из файлов raw_path и gzip_path без чтения в память процесса.
+    Метаданные перечитываются только после смены указателя, поэтому запрос не обращается ни к базе, ни к кэшу
+    :return: снимок или None, если снимка нет или он устарел
+    """
+    try:
+        stat = os.stat(os.path.join(directory, LATEST))
+    except OSError:
+        return None
+    if time.time() - stat.st_mtime > CATALOG_SNAPSHOT_MAX_AGE:
+        return None
+    loaded = _loaded.get(directory)
+    if loaded and loaded[0] == stat.st_mtime_ns:
+        return loaded[1]
+    with _lock:
+        loaded = _loaded.get(directory)
+        if loaded and loaded[0] == stat.st_mtime_ns:
+            return loaded[1]
+        try:
+            snapshot = _load(directory)
+        except (OSError, ValueError, KeyError):
+            return None
+        _loaded[directory] = (stat.st_mtime_ns, snapshot)
+        return snapshot
@@ -2,23 +2,17 @@
 
 from django import template
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
-from plp.models import Participant, EnrollmentReason, CourseSession
-from ..models import EducationalModuleEnrollmentReason, EducationalModuleEnrollment, EdmoduleCourse
-from ..utils import STARTED, ENDED
+from ..models import EdmoduleCourse
+from ..utils import STARTED, ENDED, get_user_enrollment_snapshot
 
 register = template.Library()
 
-try:
-    course_session_content_type = ContentType.objects.get_for_model(CourseSession)
-except RuntimeError:
-    pass
-
 
 @register.inclusion_tag('course/_enroll_button.html', takes_context=True)
 def enroll_button(context, course, session=None, html_location=None):
     """
-    отрисовка кнопки записи для курса
+    отрисовка кнопки записи для курса; запись и оплата пользователя проверяются по UserEnrollmentSnapshot,
+    общему для всех кнопок страницы
     """
     user = context['request'].user
     authenticated = user.is_authenticated
@@ -28,24 +22,12 @@ def enroll_button(context, course, session=None, html_location=None):
     honor_accepted, enrolled = False, False
     has_module = getattr(course, 'has_module', False)
     if session and authenticated:
-        p = Participant.objects.filter(session=session, user=user)
-        if p:
-            enrolled = True
-            honor_accepted = p[0].honor_code_accepted
-        enr_reason = EnrollmentReason.objects.filter(
-            participant__user__id=user.id,
-            participant__session__id=session.id,
-            session_enrollment_type__mode='verified'
-        )
-        module_payment = EducationalModuleEnrollmentReason.objects.filter(
-            enrollment__module__courses__id=session.course_id,
-            enrollment__user__id=user.id,
-            full_paid=True
-        )
-        has_paid = enr_reason.exists() or module_payment.exists()
+        snapshot = get_user_enrollment_snapshot(context['request'])
+        enrolled = snapshot.is_enrolled(session)
+        honor_accepted = snapshot.honor_accepted(session)
+        has_paid = snapshot.has_paid(session)
         if not hasattr(course, 'has_module'):
-            has_module = EducationalModuleEnrollment.objects.filter(
-                user=user, is_active=True, module__courses__id=course.id).exists()
+            has_module = snapshot.has_module(course)
     else:
         has_paid = False
         has_module = False
@@ -54,7 +36,7 @@ def enroll_button(context, course, session=None, html_location=None):
     else:
         materials_available = False
     if course._meta.model is not EdmoduleCourse:
-        course = EdmoduleCourse.objects.get(id=course.id)
+        course = EdmoduleCourse.from_course(course)
     return {
         'status': status,
         'session': session,
@@ -0,0 +1,428 @@
+# coding: utf-8
+
+import csv
+import importlib
+import io
+import json
+import random
+import sys
+import threading
+import time
+import unittest
+from datetime import date, timedelta
+from unittest import mock
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from plp.models import Course, User
+from . import utils
+from .catalog import bump_catalog_version, get_catalog_version, build_catalog_data
+from .enrollment_import import create_import_job, run_import_side_effects
+from .export import write_enrollments_csv, ENROLLMENTS_HEADER
+from .facets import update_facet_index
+from .models import PromoCode, EducationalModule, EducationalModuleCounter, EducationalModuleEnrollment, \
+    EnrollmentImportJob, MassMailProgress, PUBLISHED
+from .notifications import ParallelMassSendMixin
+from .signals import catalog_changed_handler, facet_index_course_handler, FRONTPAGE_POOL_CACHE_KEY, \
+    FACET_INDEX_CACHE_KEY, FACET_INDEX_LOCK_CACHE_KEY
+from .utils import UserEnrollmentSnapshot, get_user_enrollment_snapshot, get_related_ids, get_client_ip, \
+    get_frontpage_pool, generate_promocodes, PROMOCODE_ALPHABET, DEFAULT_PROMOCODE_LENGTH
+from .views import promocode_quote_view
+
+
+class FacetIndexHandlerTestCase(TestCase):
+    def tearDown(self):
+        cache.delete_many([FACET_INDEX_CACHE_KEY, FACET_INDEX_LOCK_CACHE_KEY])
+
+    def test_course_save_and_delete_pass_course_id(self):
+        # у Course есть метод course_id, в индекс должен попадать id курса, а не метод
+        course = Course(id=42)
+        for signal in (post_save, post_delete):
+            with mock.patch('plp_edmodule.facets.update_facet_index') as update, \
+                    mock.patch('django.db.transaction.on_commit') as on_commit:
+                facet_index_course_handler(sender=Course, instance=course, signal=signal, created=False)
+                # до фиксации транзакции индекс не меняется
+                update.assert_not_called()
+                on_commit.call_args[0][0]()
+            update.assert_called_once_with(course_id=42)
+
+    def test_update_without_index_is_noop(self):
+        update_facet_index(course_id=42)
+        self.assertIsNone(cache.get(FACET_INDEX_CACHE_KEY))
+        self.assertIsNone(cache.get(FACET_INDEX_LOCK_CACHE_KEY))
+
+    def test_update_drops_index_if_locked(self):
+        cache.set(FACET_INDEX_CACHE_KEY, 'index')
+        cache.set(FACET_INDEX_LOCK_CACHE_KEY, 1)
+        update_facet_index(course_id=42)
+        self.assertIsNone(cache.get(FACET_INDEX_CACHE_KEY))
+
+
+class _TestMassSend(ParallelMassSendMixin):
+    mail_workers = 3
+    mail_batch_size = 4
+    mail_rate_limit = 0
+
+    def __init__(self, emails, failing=()):
+        self.emails = emails
+        self.failing = set(failing)
+
+    def get_emails(self):
+        return self.emails
+
+    def get_mail_from(self):
+        return 'noreply@example.com'
+
+    def render_message(self, email, mail_connection):
+        if email in self.failing:
+            raise RuntimeError('smtp error')
+        return EmailMessage('subject', 'body', self.get_mail_from(), [email], connection=mail_connection)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EDMODULE_MASS_MAIL_CONNECTION={})
+class ParallelMassSendTestCase(TestCase):
+    def setUp(self):
+        self.emails = ['user%s@example.com' % i for i in range(30)]
+        self.progress_key = _TestMassSend([]).get_progress_key()
+        mail.outbox = []
+
+    def _delivered(self):
+        return [m.to[0] for m in mail.outbox]
+
+    def test_send_all(self):
+        self.assertEqual(_TestMassSend(self.emails).send_parallel(), 30)
+        self.assertEqual(sorted(self._delivered()), sorted(self.emails))
+        self.assertFalse(MassMailProgress.objects.filter(progress_key=self.progress_key).exists())
+
+    def test_resume_without_duplicates(self):
+        failing = self.emails[5:12]
+        self.assertEqual(_TestMassSend(self.emails, failing=failing).send_parallel(), 23)
+        # прогресс прерванной рассылки хранится в базе пачками и не зависит от кэша
+        self.assertGreater(MassMailProgress.objects.filter(progress_key=self.progress_key).count(), 1)
+        cache.clear()
+        self.assertEqual(_TestMassSend(self.emails).send(), 7)
+        delivered = self._delivered()
+        self.assertEqual(len(delivered), len(set(delivered)))
+        self.assertEqual(sorted(delivered), sorted(self.emails))
+        self.assertFalse(MassMailProgress.objects.filter(progress_key=self.progress_key).exists())
+
+
+@override_settings(EDMODULE_PROMOCODE_QUOTE_RATE_LIMIT=3)
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EDMODULE_MASS_MAIL_CONNECTION={},
+                   EMAIL_NOTIFICATIONS_FROM='noreply@example.com')
+class ImportSideEffectsTestCase(TestCase):
+    def setUp(self):
+        module = EducationalModule.objects.create(code='module', title='module', about='about')
+        user = User.objects.create(username='user', email='user@example.com')
+        self.enrollment = EducationalModuleEnrollment.objects.create(user=user, module=module, is_active=True)
+        mail.outbox = []
+
+    def test_failed_emails_keep_job_pending(self):
+        job = create_import_job([self.enrollment.id], update_progress=False)
+        with mock.patch('plp_edmodule.notifications.EdmoduleEnrolledEmails.render_message',
+                        side_effect=RuntimeError('smtp error')):
+            self.assertEqual(run_import_side_effects(job)['sent'], 0)
+        self.assertIsNone(EnrollmentImportJob.objects.get(id=job.id).finished_at)
+
+        def render_message(emails, email, mail_connection):
+            return EmailMessage('subject', 'body', 'noreply@example.com', [email], connection=mail_connection)
+
+        with mock.patch('plp_edmodule.notifications.EdmoduleEnrolledEmails.render_message', render_message):
+            self.assertEqual(run_import_side_effects(job)['sent'], 1)
+        self.assertIsNotNone(EnrollmentImportJob.objects.get(id=job.id).finished_at)
+        self.assertEqual([m.to[0] for m in mail.outbox], ['user@example.com'])
+
+
+class PromocodeQuoteViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        PromoCode.objects.create(code='ABC123', product_type='course', max_usage=10, used=0,
+                                 active_till=date.today() + timedelta(days=1), discount_price=100)
+
+    def _get(self, **params):
+        return promocode_quote_view(self.factory.get('/edmodule/promocode/quote/', params))
+
+    def test_invalid_params(self):
+        self.assertEqual(self._get(code='ABC123', product_id='x', product_type='course').status_code, 400)
+        self.assertEqual(self._get(code='ABC123', product_id=1, product_type='course', session_id='x').status_code,
+                         400)
+
+    def test_quote(self):
+        response = self._get(code='abc123', product_id=1, product_type='course')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['validate']['status'], 0)
+        self.assertEqual(float(data['calculate']['new_price']), 100)
+
+    def test_unknown_code(self):
+        response = self._get(code='NOPE00', product_id=1, product_type='course')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['validate']['status'], 1)
+        self.assertIsNone(data['calculate'])
+
+    def test_rate_limit(self):
+        for _ in range(3):
+            self.assertEqual(self._get(code='NOPE00', product_id=1, product_type='course').status_code, 200)
+        self.assertEqual(self._get(code='NOPE00', product_id=1, product_type='course').status_code, 429)
+
+    def test_forwarded_for_does_not_bypass_rate_limit(self):
+        for i in range(3):
+            promocode_quote_view(self.factory.get('/edmodule/promocode/quote/', {'code': 'NOPE00', 'product_id': 1},
+                                                  HTTP_X_FORWARDED_FOR='10.0.0.%s' % i))
+        response = promocode_quote_view(self.factory.get('/edmodule/promocode/quote/', {'code': 'NOPE00'},
+                                                         HTTP_X_FORWARDED_FOR='10.0.0.99'))
+        self.assertEqual(response.status_code, 429)
+
+    @override_settings(EDMODULE_TRUSTED_PROXY_COUNT=1)
+    def test_client_ip_behind_proxy(self):
+        request = self.factory.get('/', HTTP_X_FORWARDED_FOR='1.1.1.1, 2.2.2.2', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(get_client_ip(request), '2.2.2.2')
+
+
+class GeneratePromocodesTestCase(TestCase):
+    def setUp(self):
+        self.template = PromoCode.objects.create(code='TMPL01', product_type='course', max_usage=1, used=0,
+                                                 active_till=date.today() + timedelta(days=1), discount_price=100)
+
+    def test_collision_is_retried(self):
+        # код, занятый параллельно после загрузки множества существующих кодов
+        rnd = random.Random(0)
+        taken = ''.join(rnd.choice(PROMOCODE_ALPHABET) for _ in range(DEFAULT_PROMOCODE_LENGTH))
+        PromoCode.objects.filter(id=self.template.id).update(code=taken)
+        with mock.patch('plp_edmodule.utils.random.SystemRandom', return_value=random.Random(0)), \
+                mock.patch.object(PromoCode.objects, 'values_list', return_value=[]):
+            created, usage = generate_promocodes(self.template, 3)
+        codes = [p.code for p in created]
+        self.assertEqual(len(set(codes)), 3)
+        self.assertNotIn(taken, codes)
+        self.assertEqual(PromoCode.objects.count(), 4)
+
+    def test_error_leaves_no_partial_batch(self):
+        create_batch = utils._create_promocodes_batch
+        calls = []
+
+        def _create(*args):
+            calls.append(1)
+            if len(calls) > 1:
+                raise ValueError('error')
+            return create_batch(*args)
+
+        with mock.patch('plp_edmodule.utils._create_promocodes_batch', side_effect=_create):
+            with self.assertRaises(ValueError):
+                generate_promocodes(self.template, 5, batch_size=2)
+        self.assertEqual(PromoCode.objects.count(), 1)
+
+
+class PromoCodeRedeemTestCase(TestCase):
+    def setUp(self):
+        self.promo = PromoCode.objects.create(code='ABC123', product_type='edmodule', edmodule_id=None, max_usage=2,
+                                              used=0, active_till=date.today(), discount_percent=10)
+
+    def test_redeem_up_to_max_usage(self):
+        self.assertEqual([PromoCode.redeem('ABC123') for _ in range(3)], [True, True, False])
+        self.promo.refresh_from_db()
+        self.assertEqual(self.promo.used, 2)
+
+    def test_redeem_checks_product_and_date(self):
+        self.assertFalse(PromoCode.redeem('ABC123', 1, 'edmodule'))
+        PromoCode.objects.filter(id=self.promo.id).update(active_till=date.today() - timedelta(days=1))
+        self.assertFalse(PromoCode.redeem('ABC123'))
+        self.promo.refresh_from_db()
+        self.assertEqual(self.promo.used, 0)
+
+    def test_blank_codes(self):
+        for i in range(2):
+            PromoCode.objects.create(code=None, product_type='edmodule', max_usage=1, used=0,
+                                     active_till=date.today(), discount_percent=10)
+        self.assertFalse(PromoCode.redeem(''))
+        self.assertFalse(PromoCode.redeem(None))
+        self.assertEqual(PromoCode.objects.filter(code=None, used=0).count(), 2)
+
+
+@unittest.skipIf(connection.vendor == 'sqlite', 'sqlite сериализует запись, гонки не воспроизводятся')
+class PromoCodeRedeemRaceTestCase(TransactionTestCase):
+    THREADS = 8
+
+    def test_parallel_redeem_does_not_exceed_max_usage(self):
+        promo = PromoCode.objects.create(code='RACE01', product_type='edmodule', max_usage=3, used=0,
+                                         active_till=date.today(), discount_percent=10)
+        barrier = threading.Barrier(self.THREADS)
+        results = []
+
+        def redeem():
+            try:
+                barrier.wait()
+                results.append(PromoCode.redeem('RACE01'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=redeem) for _ in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.count(True), 3)
+        promo.refresh_from_db()
+        self.assertEqual(promo.used, 3)
+
+
+class EnrollmentsExportTestCase(TestCase):
+    def _export(self, chunk_size=2):
+        f = io.StringIO()
+        count = write_enrollments_csv(f, chunk_size=chunk_size)
+        return count, list(csv.reader(io.StringIO(f.getvalue())))
+
+    def test_empty_export_has_header_only(self):
+        count, rows = self._export()
+        self.assertEqual(count, 0)
+        self.assertEqual(rows, [ENROLLMENTS_HEADER])
+
+    def test_chunks_and_formula_escaping(self):
+        module = EducationalModule.objects.create(code='module', title='module', about='about')
+        users = [User.objects.create(username='=user%s' % i, email='user%s@example.com' % i) for i in range(5)]
+        EducationalModuleEnrollment.objects.bulk_create([
+            EducationalModuleEnrollment(user=u, module=module, is_active=True) for u in users])
+        # по запросу записей и причин на каждую из трех порций и пустой запрос в конце
+        with self.assertNumQueries(7):
+            count, rows = self._export(chunk_size=2)
+        self.assertEqual(count, 5)
+        ids = [int(r[0]) for r in rows[1:]]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([r[1] for r in rows[1:]], ["'=user%s" % i for i in range(5)])
+
+
+class UserEnrollmentSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user', email='user@example.com')
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def test_queries(self):
+        with self.assertNumQueries(4):
+            snapshot = get_user_enrollment_snapshot(self.request)
+        session = mock.Mock(id=1, course_id=1)
+        course = mock.Mock(id=1)
+        with self.assertNumQueries(0):
+            self.assertIs(get_user_enrollment_snapshot(self.request), snapshot)
+            for _ in range(10):
+                self.assertFalse(snapshot.is_enrolled(session))
+                self.assertFalse(snapshot.honor_accepted(session))
+                self.assertFalse(snapshot.has_paid(session))
+                self.assertFalse(snapshot.has_module(course))
+
+    def test_anonymous_user_makes_no_queries(self):
+        with self.assertNumQueries(0):
+            UserEnrollmentSnapshot(mock.Mock(is_authenticated=False))
+
+
+class RelatedIdsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_ids_are_cached_per_catalog_version(self):
+        build = mock.Mock(return_value=([1, 2], [3]))
+        self.assertEqual([list(i) for i in get_related_ids('module:1', build)], [[1, 2], [3]])
+        get_related_ids('module:1', build)
+        self.assertEqual(build.call_count, 1)
+        bump_catalog_version()
+        get_related_ids('module:1', build)
+        self.assertEqual(build.call_count, 2)
+
+    def test_deleted_candidate_is_skipped(self):
+        module = EducationalModule.objects.create(code='module', title='module', about='about')
+        with mock.patch('plp_edmodule.utils.get_related_ids', return_value=([module.id + 1], [])):
+            self.assertEqual(module.get_related(), [])
+
+
+class FrontpagePoolTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_catalog_change_marks_pool_stale(self):
+        with mock.patch('plp_edmodule.utils.build_frontpage_pool', return_value=[]) as build:
+            for _ in range(10):
+                catalog_changed_handler()
+            build.assert_not_called()
+        cache.set(FRONTPAGE_POOL_CACHE_KEY, {'pool': ['old'], 'version': 'old', 'built_at': time.time()})
+        with mock.patch('plp_edmodule.utils.build_frontpage_pool', return_value=['new']) as build:
+            self.assertEqual(get_frontpage_pool(), ['new'])
+        build.assert_called_once_with()
+        cache.set(FRONTPAGE_POOL_CACHE_KEY, {'pool': ['new'], 'version': get_catalog_version(),
+                                             'built_at': time.time()})
+        with mock.patch('plp_edmodule.utils.build_frontpage_pool') as build:
+            self.assertEqual(get_frontpage_pool(), ['new'])
+        build.assert_not_called()
+
+
+class EducationalModuleCounterTestCase(TestCase):
+    def test_delta_survives_module_save(self):
+        module = EducationalModule.objects.create(code='module', title='module', about='about')
+        stale = EducationalModule.objects.get(id=module.id)
+        for i in range(2):
+            user = User.objects.create(username='user%s' % i, email='user%s@example.com' % i)
+            EducationalModuleEnrollment.objects.create(user=user, module=module, is_active=True)
+            # сохранение целиком устаревшего экземпляра модуля не трогает счетчики
+            stale.title = 'title %s' % i
+            stale.save()
+            self.assertEqual(EducationalModuleCounter.objects.get(module=module).enrollments, i + 1)
+        self.assertEqual(EducationalModule.objects.get(id=module.id).count_enrollments, 2)
+        self.assertEqual(EducationalModuleCounter.recount([module.id]), 0)
+
+
+class CatalogDataQueriesTestCase(TestCase):
+    def _count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            data = build_catalog_data()
+        return len(ctx.captured_queries), data
+
+    @mock.patch.object(EducationalModule, 'course_status_params', return_value={})
+    def test_queries_do_not_grow_with_modules(self, _):
+        for i in range(2):
+            EducationalModule.objects.create(code='module%s' % i, title='module', about='about', status=PUBLISHED)
+        count, data = self._count_queries()
+        self.assertEqual(len(data['modules']), 2)
+        for i in range(2, 6):
+            EducationalModule.objects.create(code='module%s' % i, title='module', about='about', status=PUBLISHED)
+        self.assertEqual(self._count_queries()[0], count)
+
+
+class ImportQueriesTestCase(TestCase):
+    # models и admin не перезагружаются: повторный импорт заново регистрирует модели и их админку
+    MODULES = [
+        'plp_edmodule.views', 'plp_edmodule.urls', 'plp_edmodule.signals', 'plp_edmodule.utils',
+        'plp_edmodule.catalog', 'plp_edmodule.facets', 'plp_edmodule.search', 'plp_edmodule.snapshot',
+        'plp_edmodule.notifications', 'plp_edmodule.export', 'plp_edmodule.enrollment_import',
+        'plp_edmodule.templatetags.edmodule_tags',
+    ]
+    LAZY_MODULES = ['plp_edmodule.catalog', 'plp_edmodule.facets', 'plp_edmodule.search', 'plp_edmodule.snapshot']
+
+    def test_import_makes_no_queries(self):
+        queries = []
+
+        def wrapper(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        saved = {name: sys.modules.pop(name) for name in self.MODULES if name in sys.modules}
+        try:
+            with connection.execute_wrapper(wrapper):
+                importlib.import_module('plp_edmodule.views')
+                # модули каталога, фильтров и поиска загружаются только при первом запросе к ним
+                self.assertEqual([i for i in self.LAZY_MODULES if i in sys.modules], [])
+                for name in self.MODULES:
+                    importlib.import_module(name)
+        finally:
+            for name in self.MODULES:
+                sys.modules.pop(name, None)
+            sys.modules.update(saved)
+            for name, module in saved.items():
+                parent, child = name.rsplit('.', 1)
+                setattr(sys.modules[parent], child, module)
+        self.assertEqual(queries, [])
@@ -12,6 +12,12 @@ urlpatterns = [
     url(r'^get-honor-text/?$', views.get_honor_text, name='get-honor-text'),
     url(r'^course/filter/?$', views.edmodule_filter_view, name='edmodule-filter'),
     url(r'^catalog/?$', views.edmodule_catalog_view, name='edmodule-catalog'),
+    url(r'^catalog/data\.js$', views.edmodule_catalog_data_view, name='edmodule-catalog-data'),
+    url(r'^catalog/api/?$', views.edmodule_catalog_api_view, name='edmodule-catalog-api'),
+    url(r'^catalog/api/(?P<category>[-\w]+)/?$', views.edmodule_catalog_api_view,
+        name='edmodule-catalog-api-category'),
+    url(r'^search/?$', views.edmodule_search_view, name='edmodule-search'),
+    url(r'^promocode/quote/?$', views.promocode_quote_view, name='edmodule-promocode-quote'),
     # url(r'^catalog/(?P<category>[-\w]+)/?$', views.edmodule_catalog_view, name='edmodule-catalog'),
     url(r'^org/(?P<code>[-\w]+)/?$', views.organization_view, name='edmodule-organisation'),
     url(r'^course/(?P<uni_slug>[-\w]*)/(?P<slug>[-\w]*)/$', views.CoursePage.as_view(), name='course_details'),
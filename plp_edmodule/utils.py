@@ -5,28 +5,46 @@ import requests
 import types
 import random
 import string
+import time
+from array import array
 from collections import defaultdict
-from django.db.models import Count, Sum
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Sum, Min, Q
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import ugettext as _
-from raven import Client
 from plp.utils.edx_enrollment import EDXEnrollment, EDXNotAvailable, EDXCommunicationError, EDXEnrollmentError
-from plp.models import CourseSession, Participant
-from plp_extension.apps.course_extension.models import CourseExtendedParameters
+from plp.models import CourseSession, Participant, EnrollmentReason
+from plp_extension.apps.course_extension.models import CourseExtendedParameters, Category
 from plp_extension.apps.module_extension.models import EducationalModuleExtendedParameters
-from .models import PromoCode, EducationalModuleProgress, EducationalModule, EducationalModuleEnrollment
+from .models import PromoCode, EducationalModuleProgress, EducationalModule, EducationalModuleEnrollment, \
+    EducationalModuleEnrollmentReason, EdmoduleCourse, PUBLISHED
+from .signals import FRONTPAGE_POOL_CACHE_KEY, PUBLISHED_IDS_CACHE_KEY, CATEGORY_COURSES_CACHE_KEY, \
+    RATE_LIMIT_CACHE_KEY, FRONTPAGE_POOL_LOCK_CACHE_KEY, RELATED_IDS_CACHE_KEY
 
 RAVEN_CONFIG = getattr(settings, 'RAVEN_CONFIG', {})
-client = None
 
-if RAVEN_CONFIG:
-    client = Client(RAVEN_CONFIG.get('dsn'))
+
+def _get_raven_client():
+    if RAVEN_CONFIG:
+        from raven import Client
+        return Client(RAVEN_CONFIG.get('dsn'))
+    return None
+
+
+# клиент создается при первом обращении, а не при импорте модуля
+client = SimpleLazyObject(_get_raven_client)
 
 REQUEST_TIMEOUT = 10
 DEFAULT_PROMOCODE_LENGTH = 6
+PROMOCODE_ALPHABET = string.ascii_uppercase + string.digits
+# доля занятого пространства кодов, после которой выводится предупреждение
+PROMOCODE_SPACE_WARNING = getattr(settings, 'EDMODULE_PROMOCODE_SPACE_WARNING', 0.5)
+PROMOCODE_INSERT_RETRIES = 5
 STARTED = 'started'
 SCHEDULED = 'scheduled'
 ENDED = 'ended'
@@ -103,18 +121,26 @@ class EDXEnrollmentExtension(EDXEnrollment):
         )
 
 
+def _get_progress_course_ids(module):
+    sessions = CourseSession.objects.filter(course__in=module.courses.all())
+    return [s.get_absolute_slug_v1() for s in sessions if s.course_status().get('code') == STARTED]
+
+
+def _get_edx_progress(edx, username, course_ids):
+    data = edx.get_courses_progress(username, course_ids).json()
+    now = timezone.now().strftime('%H:%M:%S %Y-%m-%d')
+    for k, v in data.items():
+        v['updated_at'] = now
+    return data
+
+
 def update_module_enrollment_progress(enrollment):
     """
     обновление прогресса из edx по сессиям курсов, входящих в модуль, на который записан пользователь
     """
-    module = enrollment.module
-    sessions = CourseSession.objects.filter(course__in=module.courses.all())
-    course_ids = [s.get_absolute_slug_v1() for s in sessions if s.course_status().get('code') == STARTED]
+    course_ids = _get_progress_course_ids(enrollment.module)
     try:
-        data = EDXEnrollmentExtension().get_courses_progress(enrollment.user.username, course_ids).json()
-        now = timezone.now().strftime('%H:%M:%S %Y-%m-%d')
-        for k, v in data.items():
-            v['updated_at'] = now
+        data = _get_edx_progress(EDXEnrollmentExtension(), enrollment.user.username, course_ids)
         try:
             progress = EducationalModuleProgress.objects.get(enrollment=enrollment)
             p = progress.progress or {}
@@ -127,6 +153,47 @@ def update_module_enrollment_progress(enrollment):
         pass
 
 
+def update_modules_enrollment_progress(enrollments, batch_size=500):
+    """
+    update_module_enrollment_progress для многих записей: сессии курсов модуля выбираются один раз на модуль,
+    клиент edx общий, существующий прогресс читается пачкой, новый создается через bulk_create,
+    а существующий обновляется после опроса edx одной транзакцией на пачку
+    :param enrollments: записи на модуль с загруженными user и module
+    :return: количество записей, для которых получен прогресс
+    """
+    course_ids = {}
+    edx = EDXEnrollmentExtension()
+    count = 0
+    for i in range(0, len(enrollments), batch_size):
+        batch = enrollments[i:i + batch_size]
+        existing = {p.enrollment_id: p for p in EducationalModuleProgress.objects.filter(
+            enrollment_id__in=[e.id for e in batch])}
+        new, changed = [], []
+        for e in batch:
+            if e.module_id not in course_ids:
+                course_ids[e.module_id] = _get_progress_course_ids(e.module)
+            try:
+                data = _get_edx_progress(edx, e.user.username, course_ids[e.module_id])
+            except EDXEnrollmentError:
+                continue
+            count += 1
+            progress = existing.get(e.id)
+            if progress is None:
+                new.append(EducationalModuleProgress(enrollment=e, progress=data))
+            else:
+                p = progress.progress or {}
+                p.update(data)
+                progress.progress = p
+                changed.append(progress)
+        now = timezone.now()
+        with transaction.atomic():
+            EducationalModuleProgress.objects.bulk_create(new)
+            for progress in changed:
+                EducationalModuleProgress.objects.filter(id=progress.id).update(
+                    progress=progress.progress, updated_at=now)
+    return count
+
+
 def get_feedback_list(module):
     if getattr(settings, 'ENABLE_EDMODULE_RATING', False):
         from plp_extension.apps.edmodule_review.utils import get_edmodule_feedback_list
@@ -183,6 +250,31 @@ def choose_closest_session(c):
     return None
 
 
+def get_next_enroll_boundary(sessions):
+    """
+    Ближайший момент в будущем, когда у одной из сессий sessions открывается или закрывается запись
+    :param sessions: queryset CourseSession
+    :return: datetime или None
+    """
+    now = timezone.now()
+    data = sessions.aggregate(
+        start=Min('datetime_start_enroll', filter=Q(datetime_start_enroll__gt=now)),
+        end=Min('datetime_end_enroll', filter=Q(datetime_end_enroll__gt=now)),
+    )
+    boundaries = [i for i in data.values() if i]
+    return min(boundaries) if boundaries else None
+
+
+def get_timeout_till(moment, max_timeout):
+    """
+    Время жизни кэша в секундах до moment, но не больше max_timeout
+    """
+    if moment is None:
+        return max_timeout
+    seconds = int((moment - timezone.now()).total_seconds()) + 1
+    return max(1, min(seconds, max_timeout))
+
+
 def button_status_project(session, user):
     """
     хелпер для использования в CourseSession.button_status
@@ -235,8 +327,258 @@ def count_user_score(user):
         'whole_score': course_score + module_score,
     }
 
+
+class UserEnrollmentSnapshot(object):
+    """
+    Все записи пользователя на сессии и модули, загруженные одним набором из четырех запросов.
+    Используется при отрисовке кнопок записи: проверки записи и оплаты по снимку запросов не делают.
+    Запросы самих session.button_status, course_status и access_allowed из plp снимок не заменяет
+    """
+    def __init__(self, user):
+        # session_id -> honor_code_accepted
+        self.participants = {}
+        # id сессий, на которые пользователь записан в verified mode
+        self.verified_sessions = set()
+        # id курсов из полностью оплаченных модулей
+        self.paid_module_courses = set()
+        # id курсов из модулей, на которые пользователь активно записан
+        self.active_module_courses = set()
+        if user.is_authenticated:
+            self.participants = dict(Participant.objects.filter(user=user).values_list(
+                'session__id', 'honor_code_accepted'))
+            self.verified_sessions = set(EnrollmentReason.objects.filter(
+                participant__user__id=user.id,
+                session_enrollment_type__mode='verified'
+            ).values_list('participant__session__id', flat=True))
+            self.paid_module_courses = set(EducationalModuleEnrollmentReason.objects.filter(
+                enrollment__user__id=user.id,
+                full_paid=True
+            ).values_list('enrollment__module__courses__id', flat=True))
+            self.active_module_courses = set(EducationalModuleEnrollment.objects.filter(
+                user=user,
+                is_active=True
+            ).values_list('module__courses__id', flat=True))
+
+    def is_enrolled(self, session):
+        return session.id in self.participants
+
+    def honor_accepted(self, session):
+        return bool(self.participants.get(session.id))
+
+    def has_paid(self, session):
+        return session.id in self.verified_sessions or session.course_id in self.paid_module_courses
+
+    def has_module(self, course):
+        return course.id in self.active_module_courses
+
+
+def get_user_enrollment_snapshot(request):
+    """
+    UserEnrollmentSnapshot текущего пользователя, создается один раз за запрос
+    """
+    snapshot = getattr(request, '_edmodule_enrollment_snapshot', None)
+    if snapshot is None:
+        snapshot = UserEnrollmentSnapshot(request.user)
+        request._edmodule_enrollment_snapshot = snapshot
+    return snapshot
+
+
+def _get_course_categories_query():
+    """
+    (id категории, slug категории, id курса) из through-таблицы категорий в порядке Category
+    """
+    through_model = CourseExtendedParameters._meta.get_field('categories').remote_field.through
+    ordering = []
+    for field in Category._meta.ordering or []:
+        if field.startswith('-'):
+            ordering.append('-category__%s' % field[1:])
+        else:
+            ordering.append('category__%s' % field)
+    return through_model.objects.order_by(*(ordering + ['category_id', 'courseextendedparameters__course__id'])).\
+        values_list('category_id', 'category__slug', 'courseextendedparameters__course__id')
+
+
+def get_categories_for_courses(course_ids):
+    """
+    То же, что categories_for_course из get_category_courses_map, но только для курсов course_ids
+    и без кэша: один запрос, память пропорциональна числу переданных курсов
+    :return: {id курса: [slug категории, ...], ...}
+    """
+    categories_for_course = defaultdict(list)
+    for category_id, slug, course_id in _get_course_categories_query().filter(
+            courseextendedparameters__course__id__in=course_ids):
+        categories_for_course[course_id].append(slug)
+    return dict(categories_for_course)
+
+
+def get_category_courses_map():
+    """
+    Связь категорий и курсов, построенная одним запросом к through-таблице категорий,
+    вместе с множеством курсов с открытой записью. Кэшируется до ближайшего открытия
+    или закрытия записи на одну из сессий опубликованных курсов
+    :return: {
+        'open_course_ids': множество id опубликованных курсов с открытой записью,
+        'courses_by_category': {id категории: [id курсов], ...} в порядке Category,
+        'categories_for_course': {id курса: [slug категории, ...], ...}
+    }
+    """
+    data = cache.get(CATEGORY_COURSES_CACHE_KEY)
+    if data is not None:
+        return data
+    now = timezone.now()
+    sessions = CourseSession.objects.filter(course__status=PUBLISHED)
+    open_course_ids = set(sessions.filter(
+        datetime_start_enroll__lt=now,
+        datetime_end_enroll__gt=now,
+    ).values_list('course__id', flat=True).distinct())
+    courses_by_category = {}
+    categories_for_course = defaultdict(list)
+    for category_id, slug, course_id in _get_course_categories_query():
+        courses_by_category.setdefault(category_id, []).append(course_id)
+        categories_for_course[course_id].append(slug)
+    data = {
+        'open_course_ids': open_course_ids,
+        'courses_by_category': courses_by_category,
+        'categories_for_course': dict(categories_for_course),
+    }
+    timeout = get_timeout_till(get_next_enroll_boundary(sessions), settings.PAGE_CACHE_TIME)
+    cache.set(CATEGORY_COURSES_CACHE_KEY, data, timeout=timeout)
+    return data
+
+
+def build_frontpage_pool():
+    """
+    Кандидаты для главной страницы по категориям: модули, на которые можно записаться,
+    и курсы с открытой записью. Строится периодически (update_edmodule_frontpage) и при запросе,
+    если пул устарел (get_frontpage_pool)
+    :return: [(id категории, [id модулей], [id курсов]), ...] в порядке категорий
+    """
+    from .catalog import get_catalog_version
+    version = get_catalog_version()
+    category_map = get_category_courses_map()
+    open_course_ids = category_map['open_course_ids']
+    modules_for_course = defaultdict(set)
+    for module_id, course_id in EducationalModule.courses.through.objects.filter(
+            educationalmodule__status=PUBLISHED,
+            course__id__in=open_course_ids).values_list('educationalmodule_id', 'course_id'):
+        modules_for_course[course_id].add(module_id)
+    modules = EducationalModule.objects.prefetch_related('courses').in_bulk(
+        set().union(*modules_for_course.values()))
+    enrollable = {m.id for m in modules.values() if m.may_enroll()}
+    pool = []
+    for category_id, course_ids in category_map['courses_by_category'].items():
+        ids = [i for i in course_ids if i in open_course_ids]
+        if not ids:
+            continue
+        module_ids = set()
+        for i in ids:
+            module_ids.update(modules_for_course[i])
+        pool.append((category_id, sorted(module_ids & enrollable), ids))
+    # пул не удаляется при изменении каталога: до построения нового показывается прежний
+    cache.set(FRONTPAGE_POOL_CACHE_KEY, {'pool': pool, 'version': version, 'built_at': time.time()}, timeout=None)
+    return pool
+
+
+def refresh_frontpage_pool():
+    """
+    Перестроение пула не больше чем одним процессом одновременно; если во время построения каталог
+    изменился, пул строится еще раз
+    :return: пул или None, если пул уже перестраивает другой процесс
+    """
+    from .catalog import get_catalog_version
+    if not cache.add(FRONTPAGE_POOL_LOCK_CACHE_KEY, 1, timeout=300):
+        return None
+    try:
+        for _ in range(3):
+            version = get_catalog_version()
+            pool = build_frontpage_pool()
+            if get_catalog_version() == version:
+                break
+        return pool
+    finally:
+        cache.delete(FRONTPAGE_POOL_LOCK_CACHE_KEY)
+
+
+def get_frontpage_pool():
+    """
+    Последний построенный пул. Строится при запросе, только если его еще нет; пул, построенный
+    для прежней версии каталога или старше EDMODULE_FRONTPAGE_POOL_TIMEOUT секунд (открытие и закрытие
+    записи зависит от времени), перестраивается одним запросом, остальные в это время получают прежний
+    """
+    from .catalog import get_catalog_version
+    entry = cache.get(FRONTPAGE_POOL_CACHE_KEY)
+    if not isinstance(entry, dict):
+        return refresh_frontpage_pool() or build_frontpage_pool()
+    timeout = getattr(settings, 'EDMODULE_FRONTPAGE_POOL_TIMEOUT', settings.PAGE_CACHE_TIME)
+    if entry['version'] != get_catalog_version() or time.time() - entry['built_at'] > timeout:
+        return refresh_frontpage_pool() or entry['pool']
+    return entry['pool']
+
+
+def get_published_ids(model):
+    """
+    Закэшированный массив id опубликованных объектов model (EdmoduleCourse или EducationalModule)
+    """
+    key = PUBLISHED_IDS_CACHE_KEY % model._meta.model_name
+    ids = cache.get(key)
+    if ids is None:
+        ids = array('l', model.objects.filter(status=PUBLISHED).values_list('id', flat=True))
+        cache.set(key, ids, timeout=settings.PAGE_CACHE_TIME)
+    return ids
+
+
+def get_related_ids(name, build):
+    """
+    Закэшированные id кандидатов в похожие курсы и модули. Ключ включает версию каталога,
+    поэтому списки перестраиваются только после изменения курсов, модулей или категорий
+    :param name: имя списка, например 'module:<id модуля>'
+    :param build: функция без аргументов, возвращающая (id модулей, id курсов)
+    :return: (array id модулей, array id курсов)
+    """
+    from .catalog import get_catalog_version
+    key = RELATED_IDS_CACHE_KEY % (get_catalog_version(), name)
+    ids = cache.get(key)
+    if ids is None:
+        module_ids, course_ids = build()
+        ids = (array('l', module_ids), array('l', course_ids))
+        cache.set(key, ids, timeout=settings.PAGE_CACHE_TIME)
+    return ids
+
+
+def sample_ids(ids, k, exclude=()):
+    """
+    Равномерная случайная выборка k различных значений из ids без значений из exclude.
+    Для больших ids случайные индексы выбираются с отбрасыванием повторов, поэтому стоимость
+    зависит от k, а не от размера ids
+    """
+    exclude = set(exclude)
+    if k <= 0:
+        return []
+    if len(ids) <= 2 * (k + len(exclude)):
+        candidates = [i for i in ids if i not in exclude]
+        return random.sample(candidates, min(k, len(candidates)))
+    result = []
+    while len(result) < k:
+        i = ids[random.randrange(len(ids))]
+        if i not in exclude:
+            exclude.add(i)
+            result.append(i)
+    return result
+
+
+def sample_objects(queryset, ids, k, exclude=()):
+    """
+    k случайных объектов queryset с id из ids в порядке выборки
+    """
+    chosen = sample_ids(ids, k, exclude)
+    if not chosen:
+        return []
+    objects = queryset.in_bulk(chosen)
+    return [objects[i] for i in chosen if i in objects]
+
+
 def generate_promocode(iter=0):
-    promocode = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(DEFAULT_PROMOCODE_LENGTH))
+    promocode = ''.join(random.choice(PROMOCODE_ALPHABET) for _ in range(DEFAULT_PROMOCODE_LENGTH))
     if iter > 100:
         raise Exception('Can\'t generate unique promocode')
     if PromoCode.objects.filter(code=promocode):
@@ -245,3 +587,95 @@ def generate_promocode(iter=0):
     else:
         return promocode
 
+
+def get_promocode_space_usage(count):
+    """
+    доля пространства кодов длины DEFAULT_PROMOCODE_LENGTH, занятая count кодами
+    """
+    return count / float(len(PROMOCODE_ALPHABET) ** DEFAULT_PROMOCODE_LENGTH)
+
+
+def _generate_free_promocode(rnd, existing):
+    while True:
+        code = ''.join(rnd.choice(PROMOCODE_ALPHABET) for _ in range(DEFAULT_PROMOCODE_LENGTH))
+        if code not in existing:
+            existing.add(code)
+            return code
+
+
+def _create_promocodes_batch(batch, existing, rnd):
+    """
+    bulk_create порции промокодов; если часть кодов успели занять параллельно, они заменяются
+    новыми и вставка повторяется (не больше PROMOCODE_INSERT_RETRIES раз)
+    """
+    for attempt in range(PROMOCODE_INSERT_RETRIES):
+        try:
+            with transaction.atomic():
+                return PromoCode.objects.bulk_create(batch)
+        except IntegrityError:
+            taken = set(PromoCode.objects.filter(code__in=[p.code for p in batch]).values_list('code', flat=True))
+            if not taken:
+                raise
+            existing.update(taken)
+            for p in batch:
+                if p.code in taken:
+                    p.code = _generate_free_promocode(rnd, existing)
+    raise ValueError(_('Не удалось создать уникальные промокоды за %s попыток') % PROMOCODE_INSERT_RETRIES)
+
+
+def generate_promocodes(template, count, batch_size=1000):
+    """
+    Создание count промокодов с уникальными кодами и остальными полями как у template
+    (несохраненного или существующего PromoCode). Уникальность проверяется по множеству
+    существующих кодов, загруженному одним запросом, запись - через bulk_create порциями
+    в одной транзакции: при ошибке не остается части пачки. Коды, созданные параллельно
+    после загрузки множества, заменяются новыми
+    :return: (список созданных PromoCode, доля занятого пространства кодов после создания)
+    """
+    fields = {f.attname: getattr(template, f.attname) for f in PromoCode._meta.concrete_fields
+              if not f.primary_key and f.attname != 'code'}
+    fields['used'] = 0
+    rnd = random.SystemRandom()
+    created = []
+    with transaction.atomic():
+        existing = set(PromoCode.objects.values_list('code', flat=True))
+        space = len(PROMOCODE_ALPHABET) ** DEFAULT_PROMOCODE_LENGTH
+        if len(existing) + count > space:
+            raise ValueError(_('Недостаточно свободных промокодов: занято %s из %s') % (len(existing), space))
+        while len(created) < count:
+            batch = [PromoCode(code=_generate_free_promocode(rnd, existing), **fields)
+                     for _ in range(min(batch_size, count - len(created)))]
+            created.extend(_create_promocodes_batch(batch, existing, rnd))
+    usage = get_promocode_space_usage(len(existing))
+    if usage >= PROMOCODE_SPACE_WARNING:
+        logging.warning('Promocode space is %.0f%% used', usage * 100)
+    return created, usage
+
+
+def get_client_ip(request):
+    """
+    Адрес клиента для ограничения частоты запросов. X-Forwarded-For учитывается только за доверенными
+    прокси (EDMODULE_TRUSTED_PROXY_COUNT, по умолчанию 0): каждый прокси дописывает адрес справа,
+    поэтому адрес клиента - первый справа, добавленный не клиентом. Левые значения может подставить сам клиент
+    """
+    proxies = getattr(settings, 'EDMODULE_TRUSTED_PROXY_COUNT', 0)
+    if proxies:
+        forwarded = [i.strip() for i in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if i.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def is_rate_limited(request, scope, limit, period=60):
+    """
+    Ограничение числа запросов с одного ip: не больше limit за окно в period секунд.
+    Счетчик окна хранится в кэше, увеличивается атомарно через add/incr
+    """
+    key = RATE_LIMIT_CACHE_KEY % (scope, get_client_ip(request), int(time.time() // period))
+    if cache.add(key, 1, timeout=period):
+        return False
+    try:
+        return cache.incr(key) > limit
+    except ValueError:
+        # ключ истек между add и incr
+        return False
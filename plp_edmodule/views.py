@@ -1,36 +1,35 @@
 # coding: utf-8
 
-import os
 import json
-import random
 import logging
+import os
 from collections import defaultdict
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Count, Q, Sum, TextField
+from django.db.models import TextField
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.storage import default_storage
-from django.http import JsonResponse, Http404
-from django.views.decorators.http import require_POST, require_GET
+from django.http import JsonResponse, Http404, HttpResponse, HttpResponseNotModified, FileResponse
+from django.views.decorators.http import require_POST, require_GET, condition
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.html import strip_tags, strip_spaces_between_tags
-from django.utils.text import Truncator
+from django.utils.cache import patch_vary_headers
+from django.utils.translation import ugettext as _
 from django.views.decorators.cache import cache_page
 from plp.models import HonorCode, CourseSession, Course, Participant, EnrollmentReason, SessionEnrollmentType, Instructor
 from plp.utils.edx_enrollment import EDXEnrollmentError
 from plp.views.course import _enroll, CoursePage as CoursePageBase
 from plp.views.frontpage import Index as IndexBase
 from plp.views.student import Cabinet as CabinetBase
-from plp_extension.apps.course_extension.models import CourseExtendedParameters, Category, CourseCreator
+from plp_extension.apps.course_extension.models import CourseExtendedParameters, CourseCreator
 from .models import (
     EducationalModule, EducationalModuleEnrollment, PUBLISHED, HIDDEN, EducationalModuleEnrollmentReason,
-    BenefitLink, CoursePromotion, EdmoduleCourse)
+    BenefitLink, CoursePromotion, EdmoduleCourse, CourseCreatorStats, PromoCode)
 from .utils import (update_module_enrollment_progress, client, get_feedback_list, get_status_dict,
-    count_user_score, update_modules_graduation, choose_closest_session)
-from .signals import edmodule_enrolled
+    count_user_score, update_modules_graduation, choose_closest_session, get_frontpage_pool, get_published_ids,
+    sample_objects, is_rate_limited)
+from .signals import edmodule_enrolled, PROMOTED_COURSES_CACHE_KEY
 from functools import reduce
 
 
@@ -98,6 +97,15 @@ def edmodule_enroll(request):
     return JsonResponse({'status': 1})
 
 
+def _module_page_etag(request, code):
+    # страница зависит от записей пользователя на модуль и курсы, поэтому только для анонимных
+    if request.user.is_authenticated:
+        return None
+    from .catalog import get_catalog_etag
+    return get_catalog_etag('module', code)
+
+
+@condition(etag_func=_module_page_etag)
 def module_page(request, code):
     """
     страница образовательного модуля
@@ -309,13 +317,15 @@ def update_course_details_context(context, user):
                     courses__extended_params__categories__in=categories,status='published').distinct()
                 courses = EdmoduleCourse.objects.exclude(id=context['object'].id).filter(
                     extended_params__categories__in=categories,status='published').distinct()
-                if modules:
+                module_ids = list(modules.order_by().values_list('id', flat=True))
+                course_ids = list(courses.order_by().values_list('id', flat=True))
+                if module_ids:
                     related = [
-                        {'type': 'em', 'item': random.sample(list(modules), 1)[0]},
+                        {'type': 'em', 'item': sample_objects(EducationalModule.objects.all(), module_ids, 1)[0]},
                     ]
-                if courses:
-                    if len(courses) > 1 and len(related):
-                        sample = random.sample(list(courses), 2)
+                if course_ids:
+                    if len(course_ids) > 1 and len(related):
+                        sample = sample_objects(EdmoduleCourse.objects.all(), course_ids, 2)
                         related = [
                             {'type': 'course', 'item': sample[0]},
                             {'type': 'course', 'item': sample[1]}
@@ -343,8 +353,38 @@ def get_promoted_courses(limit=None, sp=None):
     :param limit: int максимум элементов
     :return: [{'type': 'em'/'course', 'item': Course/EducationalModule}, ...]
     """
-    items = []
-    return items
+    items = cache.get(PROMOTED_COURSES_CACHE_KEY)
+    if items is None:
+        promotions = []
+        ids_for_type = defaultdict(set)
+        for content_type_id, object_id in CoursePromotion.objects.order_by('sort').values_list(
+                'content_type_id', 'object_id'):
+            if object_id not in ids_for_type[content_type_id]:
+                promotions.append((content_type_id, object_id))
+                ids_for_type[content_type_id].add(object_id)
+        module_type = ContentType.objects.get_for_model(EducationalModule)
+        course_type = ContentType.objects.get_for_model(Course)
+        resolved = {}
+        # по одному запросу на каждый тип объектов вместо запроса на каждую строку
+        if ids_for_type.get(module_type.id):
+            for m in EducationalModule.objects.filter(id__in=ids_for_type[module_type.id], status=PUBLISHED):
+                resolved[(module_type.id, m.id)] = {'type': 'em', 'item': m}
+        if ids_for_type.get(course_type.id):
+            for c in EdmoduleCourse.objects.filter(id__in=ids_for_type[course_type.id], status=PUBLISHED).\
+                    defer(*get_course_text_fields()):
+                resolved[(course_type.id, c.id)] = {'type': 'course', 'item': c}
+        items = [resolved[i] for i in promotions if i in resolved]
+        cache.set(PROMOTED_COURSES_CACHE_KEY, items, timeout=settings.PAGE_CACHE_TIME)
+    if limit is not None:
+        return items[:limit]
+    return list(items)
+
+
+def get_course_text_fields():
+    """
+    текстовые поля курса, которые не нужны для карточек и откладываются при загрузке
+    """
+    return [i.name for i in Course._meta.fields if isinstance(i, TextField)]
 
 
 class Index(IndexBase):
@@ -367,45 +407,43 @@ def update_frontpage_context(context, request):
             item['type'],
             item['item'].id
         ))
-    exclude_course_fields = [i.name for i in Course._meta.fields if isinstance(i, TextField)]
-    now = timezone.now()
-    course_ids = CourseSession.objects.filter(
-        course__status=PUBLISHED,
-        datetime_start_enroll__lt=now,
-        datetime_end_enroll__gt=now,
-    ).values_list('course__id', flat=True).distinct()
-    by_category, by_category_dpo = {}, {}
-    for c in Category.objects.all():
-        by_category[c.id] = list(CourseExtendedParameters.objects.filter(
-            categories=c, course__id__in=course_ids).values_list('course__id', flat=True))
-
-    for c, ids in by_category.items():
-        if len(objects) >= CNT_COURSES:
+    if len(objects) >= CNT_COURSES:
+        # продвигаемых объектов достаточно, подбор по категориям не нужен
+        context.update({
+            'objects': objects,
+            'objects_dpo': [],
+        })
+        return
+    exclude_course_fields = get_course_text_fields()
+    # выбор по категориям из заранее посчитанного пула кандидатов, без запросов на каждую категорию
+    picked = []
+    for category_id, module_ids, course_ids in get_frontpage_pool():
+        if len(objects) + len(picked) >= CNT_COURSES:
             break
-        modules = EducationalModule.objects.filter(
-            status=PUBLISHED,
-            courses__id__in=ids,
-        ).prefetch_related('courses')
-        added_module = False
-        for m in modules:
-            if m.may_enroll() and ('em', m.id) not in objects_ids:
-                objects.append({'type': 'em', 'item': m})
-                objects_ids.append(('em', m.id))
-                added_module = True
-                break
-        if added_module:
+        module_id = next((i for i in module_ids if ('em', i) not in objects_ids), None)
+        if module_id is not None:
+            picked.append(('em', module_id))
+            objects_ids.append(('em', module_id))
             continue
-        added = [i[1] for i in objects_ids if i[0] == 'course']
-        c = EdmoduleCourse.objects.filter(id__in=ids).exclude(id__in=added).defer(*exclude_course_fields).first()
-        if c and ('course', c.id) not in objects_ids:
-            objects.append({'type': 'course', 'item': c})
-            objects_ids.append(('course', c.id))
+        course_id = next((i for i in course_ids if ('course', i) not in objects_ids), None)
+        if course_id is not None:
+            picked.append(('course', course_id))
+            objects_ids.append(('course', course_id))
+    if picked:
+        modules = EducationalModule.objects.prefetch_related('courses').in_bulk(
+            [i[1] for i in picked if i[0] == 'em'])
+        courses = EdmoduleCourse.objects.defer(*exclude_course_fields).in_bulk(
+            [i[1] for i in picked if i[0] == 'course'])
+        for item_type, item_id in picked:
+            item = (modules if item_type == 'em' else courses).get(item_id)
+            if item:
+                objects.append({'type': item_type, 'item': item})
     num_to_add = CNT_COURSES - len(objects)
     # добавляем рандомные курсы
     if num_to_add:
-        added = [i[1] for i in objects_ids]
-        qs = EdmoduleCourse.objects.filter(status=PUBLISHED).exclude(id__in=added).defer(*exclude_course_fields)
-        for c in qs.order_by('?')[:num_to_add]:
+        added = [i[1] for i in objects_ids if i[0] == 'course']
+        qs = EdmoduleCourse.objects.filter(status=PUBLISHED).defer(*exclude_course_fields)
+        for c in sample_objects(qs, get_published_ids(EdmoduleCourse), num_to_add, exclude=added):
             objects.append({'type': 'course', 'item': c})
 
     context.update({
@@ -414,39 +452,98 @@ def update_frontpage_context(context, request):
     })
 
 
+def _filter_etag(request):
+    from .catalog import get_catalog_etag
+    return get_catalog_etag('filter', request.GET.urlencode())
+
+
+def _filter_last_modified(request):
+    from .catalog import get_catalog_last_modified
+    return get_catalog_last_modified()
+
+
 @require_GET
+@condition(etag_func=_filter_etag, last_modified_func=_filter_last_modified)
 def edmodule_filter_view(request):
     """
     фильтрация курсов и образовательных модулей
     возвращает словарь с ключами
     courses: список списков [код курса, код вуза]
     modules: список кодов образовательных модулей
+    facets: словарь {фасет: {значение: количество курсов}}
+    допустимые фасеты: university_slug, category, status, enrollable, price, duration
     """
-    courses = Course.objects.filter(status=PUBLISHED)
-    modules = EducationalModule.objects.filter(status=PUBLISHED)
-    # допустимые для фильтрации значения и функции фильтрации
-    filters = {
-        'university_slug': lambda x, cs: cs.filter(university__slug__in=x)
-    }
-    for k in list(request.GET.keys()):
-        if k in filters:
-            fn = filters[k]
-            courses = fn(request.GET.getlist(k), courses)
-    courses = courses.distinct()
-    modules = modules.filter(courses__in=courses).distinct()
-    result = {
-        'courses': [[i.slug, i.university.slug] for i in courses],
-        'modules': [i.code for i in modules]
+    from .facets import FacetIndex, get_facet_index
+    filters = {k: request.GET.getlist(k) for k in FacetIndex.FACETS if k in request.GET}
+    return JsonResponse(get_facet_index().query(filters))
+
+
+@require_GET
+def edmodule_search_view(request):
+    """
+    полнотекстовый поиск по модулям и курсам
+    возвращает словарь с ключом results: [{'type': 'em'/'course', 'id': int, 'url': str, 'title': str}, ...]
+    """
+    try:
+        limit = max(min(int(request.GET.get('limit', 20)), 100), 1)
+    except ValueError:
+        limit = 20
+    from .search import get_search_index
+    return JsonResponse({'results': get_search_index().search(request.GET.get('q', ''), limit=limit)})
+
+
+@require_GET
+def promocode_quote_view(request):
+    """
+    проверка промокода и расчет цены с ним одним запросом
+    параметры: code, product_id, product_type (course или edmodule), only_first_course (true/false), session_id
+    возвращает словарь {
+        'validate': результат PromoCode.validate,
+        'calculate': результат PromoCode.calculate или None, если промокод недействителен
     }
-    return JsonResponse(result)
+    """
+    limit = getattr(settings, 'EDMODULE_PROMOCODE_QUOTE_RATE_LIMIT', 60)
+    if is_rate_limited(request, 'promocode-quote', limit):
+        return JsonResponse({'error': 'too many requests'}, status=429)
+    try:
+        product_id = int(request.GET.get('product_id', ''))
+        session_id = int(request.GET['session_id']) if request.GET.get('session_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'invalid product_id or session_id'}, status=400)
+    product_type = request.GET.get('product_type', '')
+    promo = PromoCode.objects.filter(code=request.GET.get('code', '').strip().upper()).first()
+    if promo is None:
+        return JsonResponse({
+            'validate': {'status': 1, 'message': str(_('Промокод не найден'))},
+            'calculate': None,
+        })
+    validate = promo.validate(product_id, product_type)
+    calculate = None
+    if validate['status'] == 0:
+        only_first_course = request.GET.get('only_first_course') in ('true', 'True', '1')
+        calculate = promo.calculate(product_id=product_id, only_first_course=only_first_course,
+                                    session_id=session_id)
+    return JsonResponse({'validate': validate, 'calculate': calculate})
+
+
+def _catalog_etag(request, category=None):
+    # страница наследует base.html с данными пользователя (csrf, сообщения), поэтому только для анонимных
+    if request.user.is_authenticated:
+        return None
+    from .catalog import get_catalog_etag
+    return get_catalog_etag('catalog', category or '')
 
 
+@condition(etag_func=_catalog_etag)
 def edmodule_catalog_view(request, category=None):
     """
     Передаваемый контекст:
     chosen_category: None или slug выбранной категории, имеющие курсы
-    categories: объекты Category с опубликованными курсами
-    courses: словарь, ключ - id курса, значение: {
+    categories: категории с опубликованными курсами, [{'slug': str, 'title': str}, ...]
+    catalog_version: версия каталога для url скрипта edmodule_catalog_data_view
+
+    Сами данные каталога отдает edmodule_catalog_data_view в виде скрипта с переменными
+    COURSES: словарь, ключ - id курса, значение: {
         'title': строка,
         'course_status_params': {
             'status': строка 'scheduled', 'started' или '',
@@ -456,120 +553,94 @@ def edmodule_catalog_view(request, category=None):
         'authors_and_partners': [{'url': str, 'title': str}, ...],
         'catalog_marker': str,
         'short_description': str,
-        'categories': list
+        'categories': list,
+        'participants': число участников курса
         }
     }
-    modules: аналогично courses, с добавлением: {
-        'count_courses': число курсов в модуле
-    }
-    course_covers: словарь, ключ - id курса, значение - объект картинки курса
-    module_covers: аналогично course_covers
+    MODULES: аналогично COURSES, с добавлением: {
+        'count_courses': число курсов в модуле,
+        'count_enrollments': число активных записей на модуль
+    } и без participants
+    COURSE_COVERS: словарь, ключ - id курса, значение - url миниатюры картинки курса
+    MODULE_COVERS: аналогично COURSE_COVERS
     """
-    cache_key = "EdmoduleCourseCatalogContext"
-    context = cache.get(cache_key)
-    if context:
-        return render(request, 'edmodule/catalog.html', context)
+    from .catalog import get_catalog_meta, get_catalog_version
+    from .snapshot import get_catalog_snapshot
+    snapshot = get_catalog_snapshot()
+    if snapshot:
+        categories, version = snapshot['categories'], snapshot['etag']
+    else:
+        categories, version = get_catalog_meta()['categories'], get_catalog_version()
+    return render(request, 'edmodule/catalog.html', {
+        'chosen_category': category,
+        'categories': categories,
+        'catalog_version': version,
+    })
 
-    sp = None
 
-    courses, modules, course_covers, module_covers = {}, {}, {}, {}
-    cover_path = Course._meta.get_field('cover').upload_to
-    try:
-        all_course_covers = default_storage.listdir(cover_path)[1]
-    except OSError:
-        all_course_covers = []
-    cover_path = EducationalModule._meta.get_field('cover').upload_to
-    try:
-        all_module_covers = default_storage.listdir(cover_path)[1]
-    except OSError:
-        all_module_covers = []
-
-    through_model = CourseExtendedParameters._meta.get_field('categories').remote_field.through
-    category_for_course = defaultdict(list)
-    q = through_model.objects.values_list('courseextendedparameters__course__id', 'category__slug')
-    for course, category in q:
-        category_for_course[course].append(category)
-
-    category_slugs_with_having_courses = set()
-    courses_query = EdmoduleCourse.objects.filter(status='published').prefetch_related(
-        'extended_params', 'extended_params__authors', 'course_sessions').distinct()
-    # if not category:
-    #     courses_query = Course.objects.filter(status='published').prefetch_related(
-    #         'extended_params', 'extended_params__authors', 'course_sessions').distinct()
-    # else:
-    #     courses_query = Course.objects.filter(status='published', extended_params__categories__slug=category).\
-    #         prefetch_related('extended_params', 'extended_params__authors', 'course_sessions').distinct()
-    for c in courses_query:
-        if (category_for_course.get(c.id)) is not None:
-            for cat in category_for_course.get(c.id):
-                category_slugs_with_having_courses.add(cat) 
-        if c.cover:
-            cover_name = os.path.split(c.cover.name)[-1]
-            if cover_name in all_course_covers:
-                course_covers[c.pk] = c.cover
-            else:
-                if client:
-                    client.captureMessage('Image not found: %s' % str(c.cover))
-        dic = {
-            'title': c.title,
-            'course_status_params': '',
-            'url': reverse('course_details', kwargs={'uni_slug': c.university.slug, 'slug': c.slug}),
-        }
-        max_length = CourseExtendedParameters._meta.get_field('short_description').max_length
-        default_desc = strip_tags(strip_spaces_between_tags(c.description or ''))
-        dic.update({
-            'authors_and_partners': [{
-                                         'url': i.get_absolute_url() if i.status == CourseCreator.STATUS_CHOICES.PUBLISHED else '',
-                                         'title': i.abbr or i.title
-                                     } for i in c.get_authors_and_partners()],
-            'catalog_marker': getattr(c, 'catalog_marker', ''),
-            'short_description': getattr(c, 'short_description', '') or Truncator(default_desc).chars(max_length),
-            'categories': category_for_course.get(c.id, []),
-        })
-        dic.update({'course_status_params': c.course_status_params()})
-        courses[c.id] = dic
-
-    count_courses_dict = dict(EducationalModule.objects.annotate(cnt=Count('courses')).values_list('code', 'cnt'))
-    edmodule_query = EducationalModule.objects.filter(status='published').\
-        select_related('extended_params')
-    for m in edmodule_query:
-        if m.cover:
-            cover_name = os.path.split(m.cover.name)[-1]
-            if cover_name in all_module_covers:
-                module_covers[m.pk] = m.cover
-            else:
-                if client:
-                    client.captureMessage('Image not found: %s' % str(m.cover))
+@require_GET
+def edmodule_catalog_data_view(request):
+    """
+    данные каталога (см. edmodule_catalog_view), заранее сериализованные и сжатые,
+    из снимка build_edmodule_catalog_snapshot, если он есть и не устарел, иначе из кэша
+    """
+    from .catalog import get_catalog_meta, get_catalog_payload
+    from .snapshot import get_catalog_snapshot
+    snapshot = get_catalog_snapshot()
+    if snapshot:
+        return catalog_payload_response(request, snapshot)
+    meta = get_catalog_meta()
+    if '"%s"' % meta['etag'] in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        # для 304 тело скрипта из кэша не читается
+        return catalog_payload_response(request, meta)
+    return catalog_payload_response(request, get_catalog_payload())
+
+
+def catalog_payload_response(request, payload):
+    """
+    :param payload: build_catalog_payload (raw и gzip - bytes) или снимок get_catalog_snapshot
+        (raw_path и gzip_path - файлы, отдаются потоком без чтения в память)
+    """
+    etag = '"%s"' % payload['etag']
+    content_type = 'application/javascript; charset=utf-8'
+    encoding = 'gzip' if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') else 'raw'
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    elif '%s_path' % encoding in payload:
+        f = open(payload['%s_path' % encoding], 'rb')
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = os.fstat(f.fileno()).st_size
+    else:
+        response = HttpResponse(payload[encoding], content_type=content_type)
+    if encoding == 'gzip' and response.status_code == 200:
+        response['Content-Encoding'] = 'gzip'
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    return response
 
-        try:
-            extended = m.extended_params
-        except:
-            extended = None
-        categories = reduce(lambda x, y: x + y, [category_for_course.get(i.id, []) for i in m.courses.all()], [])
-        categories = list(set(categories))
-        category_slugs_with_having_courses = category_slugs_with_having_courses.union(set(categories))
-        dic = {
-            'title': m.title,
-            'authors_and_partners': [{'url': i.link, 'title': i.abbr or i.title} for i in m.get_authors_and_partners()],
-            'count_courses': count_courses_dict.get(m.code, 0),
-            'short_description': extended and extended.short_description,
-            'catalog_marker': extended and extended.catalog_marker,
-            'categories': categories,
-            'url': reverse('edmodule-page', kwargs={'code': m.code})
-        }
-        dic.update({'course_status_params': m.course_status_params()})
-        modules[m.id] = dic
 
-    context = {
-        'chosen_category': category,
-        'categories': Category.objects.filter(slug__in=category_slugs_with_having_courses),
-        'courses': json.dumps(courses, ensure_ascii=False),
-        'modules': json.dumps(modules, ensure_ascii=False),
-        'course_covers': course_covers,
-        'module_covers': module_covers,
+@require_GET
+def edmodule_catalog_api_view(request, category=None):
+    """
+    постраничная выдача каталога для бесконечной прокрутки
+    параметры: type - courses (по умолчанию) или modules, cursor - next_cursor предыдущей страницы,
+    limit - размер страницы
+    возвращает словарь {
+        'items': [{'id': int, 'cover': url миниатюры или None, ...}, ...] - данные объектов в формате
+            edmodule_catalog_view,
+        'next_cursor': int или None, если страница последняя
     }
-    cache.set(cache_key, context, timeout=settings.PAGE_CACHE_TIME)
-    return render(request, 'edmodule/catalog.html', context)
+    """
+    from .catalog import get_catalog_slice, CATALOG_SLICE_DEFAULT_LIMIT, CATALOG_SLICE_MAX_LIMIT
+    kind = request.GET.get('type', 'courses')
+    if kind not in ('courses', 'modules'):
+        return JsonResponse({'error': 'unknown type'}, status=400)
+    try:
+        cursor = int(request.GET.get('cursor') or 0)
+        limit = min(max(int(request.GET.get('limit', CATALOG_SLICE_DEFAULT_LIMIT)), 1), CATALOG_SLICE_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'invalid cursor or limit'}, status=400)
+    return JsonResponse(get_catalog_slice(kind, category=category, cursor=cursor, limit=limit))
 
 
 def enroll_on_course(session, request):
@@ -636,48 +707,23 @@ def organization_view(request, code):
     if org.status == CourseCreator.STATUS_CHOICES.HIDDEN:
         raise Http404
 
-    all_courses = list(EdmoduleCourse.objects.filter(Q(extended_params__authors=org) |
-                                                     Q(extended_params__partners=org)).distinct())
-    courses = [i.id for i in all_courses]
-    courses_info = Course.objects.filter(id__in=courses).aggregate(sum=Sum('sum_ratings'), count=Sum('count_ratings'))
-    if courses_info['count']:
-        course_mark = round(float(courses_info['sum']) / courses_info['count'], 2)
-    else:
-        course_mark = 0
-
-    modules = EducationalModule.objects.filter(courses__id__in=courses).distinct().prefetch_related('courses')
-    modules_info = modules.aggregate(sum=Sum('sum_ratings'), count=Sum('count_ratings'))
-    if modules_info['count']:
-        modules_mark = round(float(modules_info['sum']) / modules_info['count'], 2)
-    else:
-        modules_mark = 0
+    stats = CourseCreatorStats.get_for_creator(org)
+    all_courses = list(EdmoduleCourse.objects.filter(id__in=stats.course_ids))
+    modules = EducationalModule.objects.filter(id__in=stats.module_ids).prefetch_related('courses')
+    instructors = Instructor.objects.in_bulk(stats.instructor_ids)
+    instructors = [instructors[i] for i in stats.instructor_ids if i in instructors]
 
-    instructors = list(Instructor.objects.filter(instructor_courses__id__in=courses).distinct())
-    if org.teacher_order:
-        try:
-            order = {int(i): pos for pos, i in enumerate(org.teacher_order.split(',')) if i}
-            instructors = sorted(instructors, key=lambda x: order.get(x.id, 999))
-        except:
-            pass
-
-    courses_by_popularity = list(EdmoduleCourse.objects.filter(id__in=courses).annotate(
-        cnt=Count('course_sessions__course_participant')).filter(cnt__gt=0).order_by('-cnt'))
-    popular = []
-    if courses_by_popularity:
-        for pos, course in enumerate(courses_by_popularity):
-            for m in modules:
-                if any(course.id == c.id for c in m.courses.all()):
-                    popular.append({'type': 'em', 'item': m})
-                    courses_by_popularity.pop(pos)
-                    break
-        for course in courses_by_popularity[:3]:
-            popular.append({'type': 'course', 'item': course})
-        popular = popular[:3]
+    items = {
+        'em': {m.id: m for m in modules},
+        'course': {c.id: c for c in all_courses},
+    }
+    popular = [{'type': kind, 'item': items[kind][pk]} for kind, pk in stats.popular_programs
+               if pk in items[kind]]
 
     context = {
         'object': org,
-        'courses_rating': course_mark,
-        'modules_rating': modules_mark,
+        'courses_rating': stats.courses_rating,
+        'modules_rating': stats.modules_rating,
         'instructors': instructors,
         'modules': modules,
         'courses': all_courses,